@@ -5,26 +5,122 @@ from enum import Enum
 number_of_messages_to_keep = int(os.environ.get("number_of_messages_to_keep", "5"))
 system_content = os.environ.get("system_content")
 slack_token = os.environ.get("slack_token")
+slack_api_url = os.environ.get("slack_api_url", "https://www.slack.com/api/")
 max_token = int(os.environ.get("max_token", "2048"))
 
+# Slack streaming updates
+slack_update_interval = float(os.environ.get("slack_update_interval", "1.0"))
+slack_update_chars = int(os.environ.get("slack_update_chars", "300"))
+# Slack rejects messages of around 4000 characters with msg_too_long, so answers continue in a new message before.
+slack_page_chars = int(os.environ.get("slack_page_chars", "3900"))
+slack_rate_limits = os.environ.get("slack_rate_limits", "")  # e.g. chat.update=100,chat.delete=50 (per minute)
+slack_max_retries = int(os.environ.get("slack_max_retries", "5"))
+slack_channel_update_interval = float(os.environ.get("slack_channel_update_interval", "1.0"))
+# Socket Mode: app-level tokens by route, e.g. gpt=xapp-...,random=xapp-... (empty to only use the webhooks)
+slack_app_tokens = os.environ.get("slack_app_tokens", "")
+slack_socket_connections = int(os.environ.get("slack_socket_connections", "2"))
+
+# Input token budget for the conversation history sent to each model
+gpt_context_tokens = int(os.environ.get("gpt_context_tokens", "12000"))
+gemini_context_tokens = int(os.environ.get("gemini_context_tokens", "32000"))
+claude_context_tokens = int(os.environ.get("claude_context_tokens", "32000"))
+
+# Provider routing for /slack/random
+provider_weights = os.environ.get("provider_weights", "gpt=1,gemini=1,claude=1")
+circuit_breaker_failures = int(os.environ.get("circuit_breaker_failures", "5"))
+circuit_breaker_cooldown = float(os.environ.get("circuit_breaker_cooldown", "30"))
+enable_hedging = os.environ.get("enable_hedging", "").lower() in ("1", "true", "yes")
+hedge_deadline_seconds = float(os.environ.get("hedge_deadline_seconds", "3"))
+
+# Thread history cache
+thread_cache_size = int(os.environ.get("thread_cache_size", "1000"))
+thread_cache_ttl = float(os.environ.get("thread_cache_ttl", "300"))
+
+# Response cache for one-shot questions
+enable_response_cache = os.environ.get("enable_response_cache", "").lower() in ("1", "true", "yes")
+response_cache_size = int(os.environ.get("response_cache_size", "1000"))
+response_cache_ttl = float(os.environ.get("response_cache_ttl", "3600"))
+response_cache_exclude_channels = os.environ.get("response_cache_exclude_channels", "")  # e.g. C0123,C0456
+
+# State shared by workers and replicas (dedup keys, thread locks, caches), e.g. redis://localhost:6379/0.
+# Without it every process keeps its own, which is only correct with a single worker.
+state_url = os.environ.get("state_url", "")
+thread_lock_ttl = float(os.environ.get("thread_lock_ttl", "600"))
+thread_lock_timeout = float(os.environ.get("thread_lock_timeout", "120"))
+
+# Event deduplication
+dedup_ttl = float(os.environ.get("dedup_ttl", "600"))
+dedup_max_entries = int(os.environ.get("dedup_max_entries", "10000"))
+
+# Job scheduler
+gpt_concurrency = int(os.environ.get("gpt_concurrency", "8"))
+gemini_concurrency = int(os.environ.get("gemini_concurrency", "8"))
+claude_concurrency = int(os.environ.get("claude_concurrency", "8"))
+max_queue_depth = int(os.environ.get("max_queue_depth", "100"))
+queue_placeholder_seconds = float(os.environ.get("queue_placeholder_seconds", "3"))
+superseded_policy = os.environ.get("superseded_policy", "truncate")  # cancel, truncate or none
+shutdown_grace_seconds = float(os.environ.get("shutdown_grace_seconds", "60"))
+
+# HTTP
+http_pool_size = int(os.environ.get("http_pool_size", "100"))
+http_timeout = float(os.environ.get("http_timeout", "30"))
+
+# Tracing: traces are logged (and exported) with this probability, and always when a step failed
+trace_sample_rate = float(os.environ.get("trace_sample_rate", "1.0"))
+trace_payload_chars = int(os.environ.get("trace_payload_chars", "200"))  # 0 to only log the length of texts
+# OTLP/HTTP collector that sampled traces are also sent to, e.g. http://localhost:4318 (empty to only log them)
+otlp_endpoint = os.environ.get("otlp_endpoint", "")
+otlp_headers = os.environ.get("otlp_headers", "")  # e.g. authorization=Bearer ...
+otlp_service_name = os.environ.get("otlp_service_name", "llm-with-slack")
+
+# OpenAI router
+sse_coalesce_seconds = float(os.environ.get("sse_coalesce_seconds", "0.05"))
+sse_coalesce_chars = int(os.environ.get("sse_coalesce_chars", "256"))
+batch_concurrency = int(os.environ.get("batch_concurrency", "8"))
+batch_max_conversations = int(os.environ.get("batch_max_conversations", "100"))
+
 # For ChatGPT
 openai_token = os.environ.get("openai_token")
 gpt_model = os.environ.get("gpt_model", "gpt-3.5-turbo")
+GPT_VISION_MODELS = ("gpt-4-turbo", "gpt-4o")
 
 # For Gemini
 google_cloud_project_name = os.environ.get("google_cloud_project_name")
 gemini_model = os.environ.get("gemini_model", "gemini-1.5-pro-001")  # or gemini-1.5-flash-001
+gemini_session_cache_size = int(os.environ.get("gemini_session_cache_size", "1000"))
+gemini_session_idle_seconds = float(os.environ.get("gemini_session_idle_seconds", "1800"))
 enable_grounding = os.environ.get("enable_grounding", False)
 
 # For Claude
 claude_model = os.environ.get("claude_model", "claude-3-5-sonnet@20240620")
+# Off until the Vertex AI region in use is known to accept the prompt caching beta header.
+claude_prompt_cache = os.environ.get("claude_prompt_cache", "false").lower() in ("1", "true", "yes")
+
+# For DALL-E ("!" messages to GPT, "!3 ..." asks for 3 images)
+dalle_model = os.environ.get("dalle_model", "dall-e-3")
+dalle_max_images = int(os.environ.get("dalle_max_images", "4"))
 
 
 # Image
-MAX_FILE_BYTES = int(os.environ.get("max_file_bytes", 1_000_000))
+MAX_FILE_BYTES = int(os.environ.get("max_file_bytes", 1_000_000))  # largest image sent to an LLM, after preprocessing
+max_download_bytes = int(os.environ.get("max_download_bytes", 20_000_000))  # largest attachment that is accepted
+image_workers = int(os.environ.get("image_workers", "2"))
+image_quality = int(os.environ.get("image_quality", "85"))
+download_concurrency = int(os.environ.get("download_concurrency", "8"))
+attachment_cache_bytes = int(os.environ.get("attachment_cache_bytes", 64_000_000))
+attachment_cache_dir = os.environ.get("attachment_cache_dir")
+attachment_cache_disk_bytes = int(os.environ.get("attachment_cache_disk_bytes", 512_000_000))
 
 
 class LLMModel(Enum):
     GPT = "gpt"
     GEMINI = "gemini"
     CLAUDE = "claude"
+
+
+# Providers are imported on first use; only the enabled ones are ever loaded. Preloading warms them all at startup,
+# trading the memory of SDKs a deployment may never use for a faster first answer.
+enabled_models = [
+    LLMModel(name.strip()) for name in os.environ.get("enabled_models", "gpt,gemini,claude").split(",") if name.strip()
+]
+preload_providers = os.environ.get("preload_providers", "false").lower() in ("1", "true", "yes")
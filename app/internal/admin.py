@@ -1,8 +1,109 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from starlette.responses import PlainTextResponse
+
+from app.routers.slack_socket import socket_mode
+from app.services.attachments import attachment_cache
+from app.services.dedup import deduplicator
+from app.services.generations import StopPolicy, generations
+from app.services.llm import hedge_stats
+from app.services.provider_stats import provider_router
+from app.services.response_cache import response_cache
+from app.services.scheduler import scheduler
+from app.services.slack_history import history_cache_stats
+from app.services.trace_export import otlp_exporter
+from app.utils import metrics
 
 router = APIRouter()
 
+metrics.CallbackMetric(
+    "cache_hits_total",
+    "Cache hits",
+    "counter",
+    ("cache",),
+    lambda: {
+        "thread_history": history_cache_stats()["hits"],
+        "attachment": attachment_cache.hits,
+        "attachment_disk": attachment_cache.disk_hits,
+    },
+)
+metrics.CallbackMetric(
+    "cache_misses_total",
+    "Cache misses",
+    "counter",
+    ("cache",),
+    lambda: {"thread_history": history_cache_stats()["misses"], "attachment": attachment_cache.misses},
+)
+metrics.CallbackMetric(
+    "attachment_cache_bytes", "Bytes held by the attachment cache", "gauge", (), lambda: {(): attachment_cache.nbytes}
+)
+metrics.CallbackMetric(
+    "slack_duplicate_events_total",
+    "Duplicate Slack deliveries that did not start a generation",
+    "counter",
+    (),
+    lambda: {(): deduplicator.suppressed},
+)
+metrics.CallbackMetric(
+    "queue_depth", "Generations waiting for a worker", "gauge", ("model",), lambda: scheduler.stats()["queued"]
+)
+metrics.CallbackMetric(
+    "queue_rejected_total",
+    "Generations rejected because the queue was full",
+    "counter",
+    (),
+    lambda: {(): scheduler.rejected},
+)
+metrics.CallbackMetric(
+    "generations_in_flight", "Generations queued or running", "gauge", (), lambda: {(): len(generations)}
+)
+metrics.CallbackMetric(
+    "provider_circuit_open",
+    "1 while a provider's circuit breaker is open",
+    "gauge",
+    ("model",),
+    lambda: {model: int(stats["circuit"] == "open") for model, stats in provider_router.to_dict().items()},
+)
+metrics.CallbackMetric(
+    "hedges_total",
+    "Hedged first-token requests",
+    "counter",
+    ("outcome",),
+    lambda: {"fired": hedge_stats.fired, "won": hedge_stats.won},
+)
+
 
 @router.post("/")
 async def root():
     return "coming soon"
+
+
+@router.get("/stats")
+async def stats():
+    return {
+        "thread_history_cache": history_cache_stats(),
+        "attachment_cache": attachment_cache.stats(),
+        "event_dedup": deduplicator.stats(),
+        "scheduler": scheduler.stats(),
+        "providers": provider_router.to_dict(),
+        "hedges": hedge_stats.to_dict(),
+        "socket_mode": socket_mode.stats(),
+        "response_cache": response_cache.stats(),
+        "trace_export": otlp_exporter.stats() if otlp_exporter is not None else None,
+    }
+
+
+@router.get("/generations")
+async def list_generations():
+    return generations.to_list()
+
+
+@router.delete("/generations/{generation_id}")
+async def stop_generation(generation_id: int, policy: StopPolicy = StopPolicy.CANCEL):
+    if (generation := generations.stop(generation_id, policy)) is None:
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return generation.to_dict()
+
+
+@router.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -1,17 +1,44 @@
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 
 import uvicorn
 from platform import system
 from fastapi import FastAPI
 from starlette.responses import Response
 from .routers import chatgpt, slack
+from .routers.slack_socket import socket_mode
 from .internal import admin
+from .config.constants import preload_providers
+from .services.llm import preload_providers as load_providers
+from .services.scheduler import scheduler
+from .services.state import close_state
+from .services.trace_export import close_trace_export
+from .utils.http import close_http_session
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start serving right away and warm the provider SDKs in the background, so the first answer doesn't pay for it.
+    preload = asyncio.create_task(load_providers()) if preload_providers else None
+    await socket_mode.start()
+    yield
+    # Stop taking events before draining the answers in flight.
+    await socket_mode.stop()
+    if preload is not None:
+        await preload
+    # Let in-flight answers finish before the process exits.
+    await scheduler.shutdown()
+    # The last traces go out before the HTTP session they are sent with is closed.
+    await close_trace_export()
+    await close_http_session()
+    await close_state()
 
 
 if system().lower().startswith("darwin"):
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
 else:
-    app = FastAPI(docs_url=None, redoc_url=None)
+    app = FastAPI(docs_url=None, redoc_url=None, lifespan=lifespan)
 app.include_router(chatgpt.router, prefix="/openai", tags=["openai"])
 app.include_router(slack.router, prefix="/slack", tags=["slack"])
 app.include_router(admin.router, prefix="/admin", tags=["admin"], responses={418: {"description": "I'm a teapot"}})
@@ -1,12 +1,24 @@
+import asyncio
+import json
 import logging
 from typing import Annotated
 
 import openai
-from fastapi import APIRouter, Depends
-from starlette.responses import Response
+from fastapi import APIRouter, Depends, HTTPException, Query
+from starlette.responses import Response, StreamingResponse
 
-from app.services.openai_chat import get_chatgpt
+from app.config.constants import batch_concurrency, batch_max_conversations, sse_coalesce_seconds, sse_coalesce_chars
+from app.config.messages import (
+    model_description,
+    max_tokens_description,
+    temperature_description,
+    top_p_description,
+    presence_penalty_description,
+    frequency_penalty_description,
+)
+from app.services.openai_chat import Model, get_chatgpt, complete_chatgpt
 from app.services.openai_images import generate_image
+from app.utils.sse import coalesce, event
 
 router = APIRouter()
 
@@ -16,6 +28,27 @@ ChatGPT = Annotated[str, Depends(get_chatgpt)]
 Images = Annotated[str, Depends(generate_image)]
 
 
+def chat_options(
+    gpt_model: str = Query(Model.GPT_3_5_TURBO.value, description=model_description),
+    max_tokens: int = Query(2048, description=max_tokens_description),
+    temperature: float = Query(0.7, description=temperature_description),
+    top_p: float = Query(1, description=top_p_description),
+    presence_penalty: float = Query(0.5, description=presence_penalty_description),
+    frequency_penalty: float = Query(0.5, description=frequency_penalty_description),
+) -> dict:
+    return {
+        "gpt_model": gpt_model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "top_p": top_p,
+        "presence_penalty": presence_penalty,
+        "frequency_penalty": frequency_penalty,
+    }
+
+
+ChatOptions = Annotated[dict, Depends(chat_options)]
+
+
 @router.get("/models")
 async def models(api_key: str):
     openai.api_key = api_key
@@ -35,3 +68,53 @@ async def images(
     message: Images,
 ):
     return message
+
+
+@router.post("/chatgpt/stream")
+async def chatgpt_stream(messages: list[dict], options: ChatOptions):
+    """Streams the answer as server-sent events: `{"content": ...}` chunks, then `[DONE]`, or an `error` event."""
+
+    async def events():
+        try:
+            async for chunk in coalesce(get_chatgpt(messages, **options), sse_coalesce_seconds, sse_coalesce_chars):
+                yield event({"content": chunk})
+        except Exception as e:
+            yield event({"error": str(e)}, name="error")
+            return
+        yield event("[DONE]")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@router.post("/chatgpt/batch")
+async def chatgpt_batch(
+    conversations: list[list[dict]],
+    options: ChatOptions,
+    concurrency: int = Query(batch_concurrency, ge=1, le=batch_concurrency, description="Conversations run at once"),
+):
+    """
+    Answers every conversation (a list of messages) and streams the results as JSON lines, in the order they finish:
+    `{"index": ..., "content": ..., "finish_reason": ..., "usage": ...}` or `{"index": ..., "error": ...}`.
+    """
+    if len(conversations) > batch_max_conversations:
+        raise HTTPException(status_code=413, detail=f"At most {batch_max_conversations} conversations per batch")
+    slots = asyncio.Semaphore(concurrency)
+
+    async def answer(index: int, messages: list) -> dict:
+        async with slots:
+            try:
+                return {"index": index, **await complete_chatgpt(messages, **options)}
+            except Exception as e:
+                return {"index": index, "error": str(e)}
+
+    async def lines():
+        tasks = [asyncio.create_task(answer(index, messages)) for index, messages in enumerate(conversations)]
+        try:
+            for result in asyncio.as_completed(tasks):
+                yield json.dumps(await result, ensure_ascii=False) + "\n"
+        finally:
+            # The client went away: don't keep paying for answers nobody will read.
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
@@ -1,60 +1,78 @@
-import random
+import logging
+import time
+from typing import Optional
 
-from fastapi import APIRouter, Header, Request
-from starlette.background import BackgroundTasks
+from fastapi import APIRouter, Request
 from starlette.responses import Response
 
-from app.config.constants import LLMModel
-from app.services.slack import message_process
+from app.config.constants import LLMModel, enabled_models
+from app.services.dedup import deduplicator
+from app.services.provider_stats import provider_router
+from app.services import slack_history
+from app.services.scheduler import scheduler
+from app.utils import tracing
+from app.utils.metrics import Histogram
 
 router = APIRouter()
 
+WEBHOOK_SECONDS = Histogram("slack_webhook_seconds", "Time spent handling a Slack event webhook", ("model",))
 
-@router.post("/gpt")
-async def slack(request: Request, message: dict, background_tasks: BackgroundTasks, headers=Header(default=None)):
-    if message.get("challenge"):
-        return message.get("challenge")
 
-    if request.headers.get("x-slack-retry-num") and request.headers.get("x-slack-retry-reason") == "http_timeout":
+async def dispatch(message: dict, llm_model: Optional[LLMModel], failover: bool = False):
+    if llm_model not in enabled_models:
+        logging.warning(f"Ignoring a Slack event for a disabled model: {llm_model}")
         return Response("ok")
-    else:
-        # Because Slack is constrained to give a response in 3 seconds, ChatGPT processing is handled by background_tasks.
-        background_tasks.add_task(message_process, message, LLMModel.GPT)
+    started = time.perf_counter()
+    event = message.get("event") or {}
+    with tracing.trace(
+        "slack.event",
+        model=llm_model.value,
+        event_id=message.get("event_id"),
+        app_id=message.get("api_app_id"),
+        channel=event.get("channel"),
+        thread_ts=event.get("thread_ts") or event.get("ts"),
+        user=event.get("user"),
+        subtype=event.get("subtype"),
+    ) as span:
+        # Plain channel messages, edits and deletions only keep the thread history cache current. They are handled
+        # before deduplication, since the same message may also arrive as the app_mention that has to be answered.
+        if await slack_history.observe_event(event, message.get("api_app_id")):
+            span.set(observed=True)
+        # Slack redelivers events it believes failed, and may deliver one message more than once.
+        # Only the first delivery starts a generation.
+        elif await deduplicator.is_duplicate(message):
+            span.set(duplicate=True)
+        else:
+            # Because Slack is constrained to give a response in 3 seconds, generations run on the job scheduler.
+            scheduler.submit(message, llm_model, failover=failover)
+    WEBHOOK_SECONDS.observe(time.perf_counter() - started, model=llm_model.value)
     return Response("ok")
 
 
+@router.post("/gpt")
+async def slack(request: Request, message: dict):
+    if message.get("challenge"):
+        return message.get("challenge")
+    return await dispatch(message, LLMModel.GPT)
+
+
 @router.post("/gemini")
-async def slack(request: Request, message: dict, background_tasks: BackgroundTasks):
+async def slack(request: Request, message: dict):
     if message.get("challenge"):
         return message.get("challenge")
-    if request.headers.get("x-slack-retry-num") and request.headers.get("x-slack-retry-reason") == "http_timeout":
-        return Response("ok")
-    else:
-        # Because Slack is constrained to give a response in 3 seconds, ChatGPT processing is handled by background_tasks.
-        background_tasks.add_task(message_process, message, LLMModel.GEMINI)
-    return Response("ok")
+    return await dispatch(message, LLMModel.GEMINI)
 
 
 @router.post("/claude")
-async def slack(request: Request, message: dict, background_tasks: BackgroundTasks):
+async def slack(request: Request, message: dict):
     if message.get("challenge"):
         return message.get("challenge")
-    if request.headers.get("x-slack-retry-num") and request.headers.get("x-slack-retry-reason") == "http_timeout":
-        return Response("ok")
-    else:
-        # Because Slack is constrained to give a response in 3 seconds, ChatGPT processing is handled by background_tasks.
-        background_tasks.add_task(message_process, message, LLMModel.CLAUDE)
-    return Response("ok")
+    return await dispatch(message, LLMModel.CLAUDE)
 
 
 @router.post("/random")
-async def slack(request: Request, message: dict, background_tasks: BackgroundTasks):
+async def slack(request: Request, message: dict):
     if message.get("challenge"):
         return message.get("challenge")
-    if request.headers.get("x-slack-retry-num") and request.headers.get("x-slack-retry-reason") == "http_timeout":
-        return Response("ok")
-    else:
-        llm_model = random.choices([LLMModel.GPT, LLMModel.GEMINI, LLMModel.CLAUDE])[0]
-        # Because Slack is constrained to give a response in 3 seconds, ChatGPT processing is handled by background_tasks.
-        background_tasks.add_task(message_process, message, llm_model)
-    return Response("ok")
+    # Send the request to the provider that is currently doing best, and let it fail over to the others.
+    return await dispatch(message, provider_router.choose(), failover=True)
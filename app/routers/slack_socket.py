@@ -0,0 +1,99 @@
+"""
+Slack event ingestion over Socket Mode, as an alternative to the webhook routes in `slack.py`.
+
+Each app token keeps `slack_socket_connections` websockets open to Slack, which spreads the app's events over them
+(up to 10 per app). Envelopes are acknowledged as soon as they arrive and then go through the same dispatch as a
+webhook, so deduplication, model routing and scheduling are shared. The SDK client reconnects by itself when Slack
+asks it to or a connection goes stale. https://api.slack.com/apis/connections/socket
+"""
+import asyncio
+import functools
+import logging
+from typing import Optional
+
+from slack_sdk.socket_mode.aiohttp import SocketModeClient
+from slack_sdk.socket_mode.request import SocketModeRequest
+from slack_sdk.socket_mode.response import SocketModeResponse
+from slack_sdk.web.async_client import AsyncWebClient
+
+from app.config.constants import LLMModel, slack_api_url, slack_app_tokens, slack_socket_connections
+from app.routers.slack import dispatch
+from app.services.provider_stats import provider_router
+from app.utils.http import get_http_session
+from app.utils.metrics import Counter
+
+SOCKET_ENVELOPES = Counter("slack_socket_envelopes_total", "Envelopes received over Socket Mode", ("route", "type"))
+SOCKET_CONNECT_FAILURES = Counter("slack_socket_connect_failures_total", "Failed Socket Mode connections", ("route",))
+
+RANDOM = "random"
+
+
+def parse_app_tokens(value: str) -> list[tuple[str, str]]:
+    """Parses "gpt=xapp-1,random=xapp-2" into (route, app token) pairs."""
+    routes = {llm_model.value for llm_model in LLMModel} | {RANDOM}
+    app_tokens = []
+    for item in filter(None, value.split(",")):
+        route, _, app_token = item.partition("=")
+        if route.strip() not in routes:
+            raise ValueError(f"Unknown Socket Mode route: {route}")
+        app_tokens.append((route.strip(), app_token.strip()))
+    return app_tokens
+
+
+class SocketModeIngestion:
+    def __init__(self, app_tokens: list[tuple[str, str]], connections: int):
+        self.app_tokens = app_tokens
+        self.connections = connections
+        self._clients: list[SocketModeClient] = []
+        self._connecting: list[asyncio.Task] = []
+
+    async def start(self):
+        if not self.app_tokens:
+            return
+        # apps.connections.open is authenticated with the app token, which the SDK passes per call.
+        web_client = AsyncWebClient(base_url=slack_api_url, session=get_http_session())
+        for route, app_token in self.app_tokens:
+            for _ in range(self.connections):
+                client = SocketModeClient(app_token=app_token, web_client=web_client)
+                client.socket_mode_request_listeners.append(functools.partial(self._handle, route))
+                self._clients.append(client)
+                self._connecting.append(asyncio.create_task(self._connect(route, client)))
+
+    async def stop(self):
+        for task in self._connecting:
+            task.cancel()
+        await asyncio.gather(*self._connecting, return_exceptions=True)
+        await asyncio.gather(*(client.close() for client in self._clients), return_exceptions=True)
+        self._clients = []
+        self._connecting = []
+
+    def stats(self) -> dict:
+        return {"connections": len(self._clients), "connecting": sum(not task.done() for task in self._connecting)}
+
+    @staticmethod
+    async def _connect(route: str, client: SocketModeClient):
+        # Only the first connection is retried here; once connected, the client takes care of reconnecting.
+        delay = 1
+        while True:
+            try:
+                await client.connect()
+                logging.info(f"Socket Mode connected for /{route}")
+                return
+            except Exception as e:
+                SOCKET_CONNECT_FAILURES.inc(route=route)
+                logging.warning(f"Failed - Socket Mode connection for /{route}: {e}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    @staticmethod
+    async def _handle(route: str, client: SocketModeClient, request: SocketModeRequest):
+        # Slack redelivers an envelope that isn't acknowledged within 3 seconds, so that comes first.
+        await client.send_socket_mode_response(SocketModeResponse(envelope_id=request.envelope_id))
+        SOCKET_ENVELOPES.inc(route=route, type=request.type)
+        if request.type != "events_api":
+            return
+        llm_model: Optional[LLMModel] = provider_router.choose() if route == RANDOM else LLMModel(route)
+        await dispatch(request.payload, llm_model, failover=route == RANDOM)
+
+
+socket_mode = SocketModeIngestion(parse_app_tokens(slack_app_tokens), slack_socket_connections)
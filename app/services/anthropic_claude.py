@@ -1,75 +1,87 @@
-import logging
-import re
-import tempfile
 
 from anthropic import AsyncAnthropicVertex
 from app.config.constants import (
     google_cloud_project_name,
-    number_of_messages_to_keep,
     claude_model,
-    MAX_FILE_BYTES,
     max_token,
+    claude_prompt_cache,
+    LLMModel,
 )
-from app.utils.file import download_file, encode_image
+from app.services.attachments import load_images
+from app.services.context import select_history
+from app.services.slack_history import get_thread_history
+from app.services.usage import field, record_input_tokens
 
 LOCATION = "europe-west1"  # or "us-east5"
 
 client = AsyncAnthropicVertex(region=LOCATION, project_id=google_cloud_project_name)
 
+# https://docs.anthropic.com/en/docs/build-with-claude/prompt-caching
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+# One breakpoint reads what the previous turn wrote, the other writes the prompt for the next turn.
+CACHE_BREAKPOINTS = 2
+
+
+def mark_cache_breakpoints(messages: list):
+    """
+    Marks the end of the last user turns as cacheable. A thread only grows at the end, so the prompt of the previous
+    turn is a prefix of this one and is read from Claude's prompt cache instead of being processed again.
+    """
+    for message in [message for message in messages if message["role"] == "user"][-CACHE_BREAKPOINTS:]:
+        if isinstance(message["content"], str):
+            message["content"] = [{"type": "text", "text": message["content"]}]
+        message["content"][-1]["cache_control"] = {"type": "ephemeral"}
+
 
 async def build_claude_message(slack_client, channel: str, thread_ts: str):
     # Get past chat history and fit it into the Gemini format.
-    conversations_replies = slack_client.conversations_replies(channel=channel, ts=thread_ts)
-    chat_history = conversations_replies.data.get("messages")[-1 * number_of_messages_to_keep :]
+    chat_history = select_history(await get_thread_history(slack_client, channel, thread_ts), LLMModel.CLAUDE)
+    files = [file for history in chat_history for file in history.get("files", [])]
+    attachments = await load_images(files, LLMModel.CLAUDE)
     messages = []
     images = []
     corpora = []
     content = ""
-    with tempfile.TemporaryDirectory() as dir_path:
-        comment = []
-        corpora.append(comment)
-        for index, history in enumerate(chat_history, start=1):
-            role = "assistant" if "app_id" in history else "user"
-            if not comment or comment[-1]["role"] == role:
-                comment.append({"role": role, "history": history})
-            else:
-                comment = []
-                corpora.append(comment)
-                history["text"] = re.sub(r"<@(.*?)>", "", history.get("text")).lstrip()
-                comment.append({"role": role, "history": history})
+    comment = []
+    corpora.append(comment)
+    for index, history in enumerate(chat_history, start=1):
+        role = "assistant" if "app_id" in history else "user"
+        if not comment or comment[-1]["role"] == role:
+            comment.append({"role": role, "history": history})
+        else:
+            comment = []
+            corpora.append(comment)
+            history["text"] = history.get("text").lstrip()
+            comment.append({"role": role, "history": history})
 
-        for corpus in corpora:
-            for message in corpus:
-                content = f"{content}. {message['history'].get('text')}" if content else message['history'].get("text")
-                if files := message['history'].get("files", []):
-                    for file in files:
-                        if file.get("size") > MAX_FILE_BYTES:
-                            continue
-                        url = file.get("url_private")
-                        filename = f"{dir_path}/{file.get('name')}"
-                        if download_file(url, filename):
-                            images.append(
-                                {
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": file.get("mimetype"),
-                                        "data": encode_image(filename),
-                                    },
-                                }
-                            )
-                        else:
-                            logging.warning("Failed - Download error")
+    for corpus in corpora:
+        for message in corpus:
+            content = f"{content}. {message['history'].get('text')}" if content else message['history'].get("text")
+            if files := message['history'].get("files", []):
+                for file in files:
+                    if (attachment := attachments.get(file.get("url_private"))) is not None:
+                        images.append(
+                            {
+                                "type": "image",
+                                "source": {
+                                    "type": "base64",
+                                    "media_type": attachment.mimetype,
+                                    "data": attachment.base64,
+                                },
+                            }
+                        )
 
-            role = corpus[0].get("role")
-            if images:
-                images.append({"type": "text", "text": content})
-                messages.append({"role": role, "content": images})
-            else:
-                messages.append({"role": role, "content": content})
-            content = ""
-            images = []
+        role = corpus[0].get("role")
+        if images:
+            images.append({"type": "text", "text": content})
+            messages.append({"role": role, "content": images})
+        else:
+            messages.append({"role": role, "content": content})
+        content = ""
+        images = []
 
+    if claude_prompt_cache:
+        mark_cache_breakpoints(messages)
     return messages
 
 
@@ -78,6 +90,17 @@ async def get_claude(messages):
         max_tokens=max_token,
         messages=messages,
         model=claude_model,
+        extra_headers=PROMPT_CACHING_HEADERS if claude_prompt_cache else None,
     ) as stream:
-        async for text in stream.text_stream:
-            yield text
+        async for event in stream:
+            if event.type == "message_start":
+                # Input usage is known before the first token.
+                usage = event.message.usage
+                record_input_tokens(
+                    LLMModel.CLAUDE,
+                    uncached=field(usage, "input_tokens"),
+                    cache_read=field(usage, "cache_read_input_tokens"),
+                    cache_write=field(usage, "cache_creation_input_tokens"),
+                )
+            elif event.type == "text":
+                yield event.text
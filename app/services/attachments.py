@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from app.config.constants import (
+    LLMModel,
+    MAX_FILE_BYTES,
+    max_download_bytes,
+    attachment_cache_bytes,
+    attachment_cache_dir,
+    attachment_cache_disk_bytes,
+)
+from app.utils import tracing
+from app.utils.cache import LRUCache
+from app.utils.file import download_files, encode_image
+from app.utils.image import ImageLimits, preprocess_image
+from app.utils.metrics import Counter, Histogram
+
+# Beyond these the providers downsample images themselves, so sending more only costs upload time.
+# https://platform.openai.com/docs/guides/vision/calculating-costs
+# https://docs.anthropic.com/en/docs/build-with-claude/vision#evaluate-image-size
+# https://cloud.google.com/vertex-ai/generative-ai/docs/multimodal/image-understanding
+IMAGE_LIMITS = {
+    LLMModel.GPT: ImageLimits(max_side=2048, max_short_side=768),
+    LLMModel.CLAUDE: ImageLimits(max_side=1568, max_pixels=1_150_000),
+    LLMModel.GEMINI: ImageLimits(max_side=3072),
+}
+
+IMAGE_BYTES = Counter(
+    "attachment_image_bytes_total", "Bytes of images before and after preprocessing", ("model", "stage")
+)
+IMAGE_PREPROCESS_SECONDS = Histogram(
+    "attachment_image_preprocess_seconds", "Time to downscale and re-encode one image", ("model",)
+)
+
+
+class Attachment:
+    """Raw bytes of a Slack file plus every encoding a provider has asked for so far."""
+
+    def __init__(self, digest: str, data: bytes, mimetype: Optional[str], parent: Optional["Attachment"] = None):
+        self.digest = digest
+        self.data = data
+        self.mimetype = mimetype
+        self.nbytes = len(data)
+        self._encodings: dict[Hashable, Any] = {}
+        self._cache: Optional["AttachmentCache"] = None
+        # A preprocessed image is cached as part of the original, which is charged for it.
+        self._parent = parent
+
+    @property
+    def base64(self) -> str:
+        return self.encode("base64", encode_image, size=lambda encoded: len(encoded))
+
+    def encode(self, name: Hashable, encoder: Callable[[bytes], Any], size: Callable[[Any], int] = None) -> Any:
+        # Provider objects (e.g. a Gemini Part) keep a reference to the raw bytes, so they are charged that size.
+        if name not in self._encodings:
+            with tracing.span("attachment.encode", encoding=str(name), bytes=len(self.data)):
+                encoded = self._encodings[name] = encoder(self.data)
+            self._grow(size(encoded) if size else len(self.data))
+        return self._encodings[name]
+
+    async def image(self, llm_model: LLMModel) -> Optional["Attachment"]:
+        """
+        The image downscaled to what `llm_model` makes use of and re-encoded without metadata, or None when it is
+        not an image or still larger than `MAX_FILE_BYTES`.
+        """
+        name = ("image", llm_model)
+        if name not in self._encodings:
+            with IMAGE_PREPROCESS_SECONDS.time(model=llm_model.value), tracing.span(
+                "attachment.preprocess", model=llm_model.value, bytes=len(self.data)
+            ):
+                result = await preprocess_image(self.data, IMAGE_LIMITS[llm_model], MAX_FILE_BYTES)
+            image = None
+            if result is not None and len(result[0]) <= MAX_FILE_BYTES:
+                data, mimetype = result
+                if data is self.data and mimetype == self.mimetype:
+                    image = self
+                else:
+                    image = Attachment(self.digest, data, mimetype, parent=self)
+                IMAGE_BYTES.inc(len(self.data), model=llm_model.value, stage="original")
+                IMAGE_BYTES.inc(len(data), model=llm_model.value, stage="preprocessed")
+            # Another builder may have finished the same image while this one was waiting for the pool.
+            if name not in self._encodings:
+                self._encodings[name] = image
+                if image is not None and image is not self:
+                    self._grow(image.nbytes)
+        return self._encodings[name]
+
+    def _grow(self, nbytes: int):
+        self.nbytes += nbytes
+        if self._parent is not None:
+            self._parent._grow(nbytes)
+        elif self._cache is not None:
+            self._cache.charge(self, nbytes)
+
+
+class AttachmentCache:
+    """
+    Process-wide cache of attachments, addressed by the SHA-256 of their content.
+
+    Slack files are mapped to a digest by `(id, size)`, so a file referenced by many turns or threads is downloaded
+    and encoded once. Entries are evicted least-recently-used once `max_bytes` is exceeded; when a directory is
+    configured the raw bytes of evicted entries spill there and are read back instead of being downloaded again.
+    """
+
+    def __init__(self, max_bytes: int, directory: Optional[str] = None, max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, Attachment] = OrderedDict()
+        self._digests = LRUCache(maxsize=100_000)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def file_key(file: dict) -> tuple:
+        return file.get("id") or file.get("url_private"), file.get("size")
+
+    async def load(self, files: list, max_bytes: Optional[int] = max_download_bytes) -> dict:
+        """Returns the attachments of `files` keyed by `url_private`, downloading only what is not cached."""
+        attachments = {}
+        missing = []
+        for file in files:
+            url = file.get("url_private")
+            digest = self._digests.peek(self.file_key(file))
+            if digest and (attachment := self._lookup(digest)):
+                self.hits += 1
+                attachments[url] = attachment
+            elif digest and (data := await self._read_disk(digest)) is not None:
+                self.disk_hits += 1
+                attachments[url] = self._store(digest, data, file.get("mimetype"))
+            else:
+                missing.append(file)
+
+        if missing:
+            self.misses += len(missing)
+            downloads = await download_files(missing, max_bytes)
+            for file in missing:
+                if (data := downloads.get(file.get("url_private"))) is None:
+                    continue
+                digest = hashlib.sha256(data).hexdigest()
+                self._digests.set(self.file_key(file), digest)
+                attachments[file.get("url_private")] = self._lookup(digest) or self._store(
+                    digest, data, file.get("mimetype")
+                )
+        return attachments
+
+    def charge(self, attachment: Attachment, nbytes: int):
+        if attachment.digest in self._entries:
+            self.nbytes += nbytes
+            self._evict()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    def _lookup(self, digest: str) -> Optional[Attachment]:
+        if (attachment := self._entries.get(digest)) is not None:
+            self._entries.move_to_end(digest)
+        return attachment
+
+    def _store(self, digest: str, data: bytes, mimetype: Optional[str]) -> Attachment:
+        attachment = Attachment(digest, data, mimetype)
+        attachment._cache = self
+        self._entries[digest] = attachment
+        self.nbytes += attachment.nbytes
+        self._evict()
+        return attachment
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, attachment = self._entries.popitem(last=False)
+            attachment._cache = None
+            self.nbytes -= attachment.nbytes
+            if self.directory:
+                asyncio.get_running_loop().run_in_executor(None, self._write_disk, attachment.digest, attachment.data)
+
+    async def _read_disk(self, digest: str) -> Optional[bytes]:
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, digest)
+
+        def read():
+            try:
+                with open(path, "rb") as f:
+                    os.utime(path)
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+        return await asyncio.to_thread(read)
+
+    def _write_disk(self, digest: str, data: bytes):
+        try:
+            path = os.path.join(self.directory, digest)
+            if not os.path.exists(path):
+                with open(f"{path}.tmp", "wb") as f:
+                    f.write(data)
+                os.replace(f"{path}.tmp", path)
+            entries = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime, reverse=True)
+            used = 0
+            for entry in entries:
+                used += entry.stat().st_size
+                if used > self.max_disk_bytes:
+                    os.remove(entry.path)
+        except OSError as e:
+            logging.warning(f"Failed - attachment disk cache: {e}")
+
+
+attachment_cache = AttachmentCache(attachment_cache_bytes, attachment_cache_dir, attachment_cache_disk_bytes)
+
+
+async def load_attachments(files: list, max_bytes: Optional[int] = max_download_bytes) -> dict:
+    return await attachment_cache.load(files, max_bytes)
+
+
+async def load_images(files: list, llm_model: LLMModel) -> dict:
+    """Like `load_attachments`, but returns the images preprocessed for `llm_model`, skipping what isn't usable."""
+    attachments = await load_attachments([file for file in files if file.get("size", 0) <= max_download_bytes])
+    images = await asyncio.gather(*(attachment.image(llm_model) for attachment in attachments.values()))
+    return {url: image for url, image in zip(attachments, images) if image is not None}
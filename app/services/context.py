@@ -0,0 +1,86 @@
+import math
+
+from app.config.constants import (
+    LLMModel,
+    max_download_bytes,
+    GPT_VISION_MODELS,
+    gpt_model,
+    system_content,
+    number_of_messages_to_keep,
+    gpt_context_tokens,
+    gemini_context_tokens,
+    claude_context_tokens,
+)
+from app.utils.cache import LRUCache
+
+TOKEN_BUDGETS = {
+    LLMModel.GPT: gpt_context_tokens,
+    LLMModel.GEMINI: gemini_context_tokens,
+    LLMModel.CLAUDE: claude_context_tokens,
+}
+
+# Per-message overhead of the chat formats (role markers, separators).
+MESSAGE_OVERHEAD = 4
+
+# (ts, hash of text, model) -> tokens of a Slack message, so re-planning a thread only counts the new messages.
+_token_counts = LRUCache(maxsize=100_000)
+
+
+def estimate_text_tokens(text: str) -> int:
+    # All three tokenizers average roughly 4 characters per token for ASCII text, while Hangul and other non-ASCII
+    # characters come close to one token each. This errs on the side of counting too much.
+    if not text:
+        return 0
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return math.ceil((len(text) - non_ascii) / 4) + non_ascii
+
+
+def estimate_image_tokens(file: dict, llm_model: LLMModel) -> int:
+    width, height = file.get("original_w"), file.get("original_h")
+    if llm_model == LLMModel.GPT:
+        if not (width and height):
+            return 765
+        # https://platform.openai.com/docs/guides/vision/calculating-costs
+        scale = min(1, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1, 768 / min(width, height))
+        width, height = width * scale, height * scale
+        return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+    if llm_model == LLMModel.CLAUDE:
+        if not (width and height):
+            return 1600
+        # https://docs.anthropic.com/en/docs/build-with-claude/vision#calculate-image-costs
+        scale = min(1, 1568 / max(width, height))
+        return math.ceil(width * scale * height * scale / 750)
+    # Gemini charges a flat rate per image.
+    return 258
+
+
+def message_tokens(message: dict, llm_model: LLMModel) -> int:
+    key = (message.get("ts"), hash(message.get("text")), llm_model)
+    tokens = _token_counts.get(key)
+    if tokens is None:
+        tokens = MESSAGE_OVERHEAD + estimate_text_tokens(message.get("text"))
+        if "app_id" not in message and (llm_model != LLMModel.GPT or gpt_model in GPT_VISION_MODELS):
+            for file in message.get("files", []):
+                if file.get("size", 0) <= max_download_bytes:
+                    tokens += estimate_image_tokens(file, llm_model)
+        _token_counts.set(key, tokens)
+    return tokens
+
+
+def select_history(chat_history: list, llm_model: LLMModel) -> list:
+    """
+    Picks the most recent messages that fit in the input token budget of `llm_model`.
+
+    Messages are taken from newest to oldest, at most `number_of_messages_to_keep` of them. The newest message is
+    always kept so the question itself is never dropped.
+    """
+    budget = TOKEN_BUDGETS[llm_model] - estimate_text_tokens(system_content)
+    selected = 0
+    for message in reversed(chat_history[-1 * number_of_messages_to_keep :]):
+        budget -= message_tokens(message, llm_model)
+        if budget < 0 and selected:
+            break
+        selected += 1
+    return chat_history[len(chat_history) - selected :]
@@ -0,0 +1,37 @@
+from app.config.constants import dedup_ttl, dedup_max_entries
+from app.services.state import StateBackend, shared_state
+
+
+class EventDeduplicator:
+    def __init__(self, backend: StateBackend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.suppressed = 0
+
+    @staticmethod
+    def keys(slack_message: dict) -> list:
+        event = slack_message.get("event") or {}
+        keys = []
+        if event_id := slack_message.get("event_id"):
+            keys.append(f"event:{event_id}")
+        # The same user message can arrive as different events (e.g. app_mention and message), but keeps client_msg_id.
+        # Each route is its own Slack app, and a message that mentions two bots has to reach both of them.
+        if client_msg_id := event.get("client_msg_id"):
+            keys.append(f"client_msg:{slack_message.get('api_app_id')}:{client_msg_id}")
+        return keys
+
+    async def is_duplicate(self, slack_message: dict) -> bool:
+        duplicate = False
+        for key in self.keys(slack_message):
+            # With a shared backend, a delivery that went to another worker counts as well.
+            if not await self.backend.add(key, "1", self.ttl):
+                duplicate = True
+        if duplicate:
+            self.suppressed += 1
+        return duplicate
+
+    def stats(self) -> dict:
+        return {"suppressed": self.suppressed}
+
+
+deduplicator = EventDeduplicator(shared_state("dedup:", dedup_max_entries), dedup_ttl)
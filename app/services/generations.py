@@ -0,0 +1,139 @@
+import asyncio
+import itertools
+import logging
+import time
+from enum import Enum
+from typing import Awaitable, AsyncIterator, Optional
+
+from app.config.constants import LLMModel, superseded_policy
+from app.utils.metrics import Counter
+
+STOPPED = Counter("generations_stopped_total", "Generations stopped before they finished", ("policy", "reason"))
+
+
+class StopPolicy(Enum):
+    CANCEL = "cancel"  # Stop the stream and delete what was posted so far.
+    TRUNCATE = "truncate"  # Stop the stream and leave what was posted so far, marked as cut off.
+    NONE = "none"  # Let it finish.
+
+
+class Generation:
+    """
+    One answer being produced for a Slack thread, from the moment it is queued until it is posted.
+
+    Stopping it is cooperative: the task is only cancelled while it waits on the LLM (inside `run` or `iterate`),
+    never in the middle of a Slack call. A stop requested during a Slack call takes effect at the next chunk.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, channel: str, thread_ts: str, event_ts: Optional[str], llm_model: LLMModel):
+        self.id = next(self._ids)
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.event_ts = event_ts
+        self.llm_model = llm_model
+        self.created_at = time.time()
+        self.task: Optional[asyncio.Task] = None
+        self.stopped: Optional[StopPolicy] = None
+        self._cancellable = False
+
+    def stop(self, policy: StopPolicy, reason: str) -> bool:
+        if policy == StopPolicy.NONE or self.stopped is not None:
+            return False
+        self.stopped = policy
+        STOPPED.inc(policy=policy.value, reason=reason)
+        logging.info(f"[{self.thread_ts}] Stopping generation {self.id} ({policy.value}, {reason})")
+        if self._cancellable and self.task is not None and not self.task.done():
+            self.task.cancel()
+        return True
+
+    async def run(self, awaitable: Awaitable):
+        """Awaits `awaitable` (a request to the LLM) in a way that `stop` can interrupt."""
+        self._check()
+        self._cancellable = True
+        try:
+            return await awaitable
+        finally:
+            self._cancellable = False
+
+    async def iterate(self, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Iterates an LLM stream; a stopped generation closes it and raises CancelledError."""
+        try:
+            while True:
+                try:
+                    chunk = await self.run(stream.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "channel": self.channel,
+            "thread_ts": self.thread_ts,
+            "event_ts": self.event_ts,
+            "model": self.llm_model.value,
+            "state": "stopping" if self.stopped else "running" if self.task else "queued",
+            "age_seconds": round(time.time() - self.created_at, 1),
+        }
+
+    def _check(self):
+        if self.stopped is not None:
+            raise asyncio.CancelledError()
+
+
+class GenerationRegistry:
+    """
+    Generations that are queued or running, by thread.
+
+    When a newer message arrives in a thread, older generations of that thread are stopped according to `policy`,
+    so a correction or follow-up question doesn't get two interleaved answers.
+    """
+
+    def __init__(self, policy: StopPolicy):
+        self.policy = policy
+        self._generations: dict[int, Generation] = {}
+        self._threads: dict[tuple, list[Generation]] = {}
+
+    def register(self, generation: Generation):
+        older = self._threads.setdefault((generation.channel, generation.thread_ts), [])
+        for other in older:
+            if float(other.event_ts or 0) < float(generation.event_ts or 0):
+                other.stop(self.policy, reason="superseded")
+        older.append(generation)
+        self._generations[generation.id] = generation
+
+    def unregister(self, generation: Generation):
+        self._generations.pop(generation.id, None)
+        key = (generation.channel, generation.thread_ts)
+        if (thread := self._threads.get(key)) is not None:
+            thread[:] = [other for other in thread if other is not generation]
+            if not thread:
+                del self._threads[key]
+
+    async def wait_for_older(self, generation: Generation, timeout: float = 10):
+        # Let stopped generations clean up their messages first, so they don't end up in the new one's history.
+        tasks = [
+            other.task
+            for other in self._threads.get((generation.channel, generation.thread_ts), [])
+            if other is not generation and other.stopped and other.task is not None and not other.task.done()
+        ]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    def stop(self, generation_id: int, policy: StopPolicy) -> Optional[Generation]:
+        if (generation := self._generations.get(generation_id)) is not None:
+            generation.stop(policy, reason="admin")
+        return generation
+
+    def to_list(self) -> list:
+        return [generation.to_dict() for generation in self._generations.values()]
+
+    def __len__(self) -> int:
+        return len(self._generations)
+
+
+generations = GenerationRegistry(StopPolicy(superseded_policy))
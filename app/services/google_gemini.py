@@ -1,22 +1,28 @@
-import logging
-import re
-import tempfile
+import itertools
+from typing import Optional
 
 import vertexai
 
 from app.config.constants import (
-    number_of_messages_to_keep,
-    MAX_FILE_BYTES,
+    max_download_bytes,
     system_content,
     gemini_model,
     google_cloud_project_name,
     enable_grounding,
+    gemini_session_cache_size,
+    gemini_session_idle_seconds,
     max_token,
+    LLMModel,
 )
-from vertexai.generative_models import GenerativeModel, Content, Part, Image, Tool
+from vertexai.generative_models import ChatSession, GenerativeModel, Content, Part, Image, Tool
 import vertexai.preview.generative_models as generative_models
 
-from app.utils.file import download_file
+from app.services.attachments import load_images
+from app.services.context import select_history
+from app.services.slack_history import get_thread_history
+from app.services.usage import field, record_input_tokens
+from app.utils.cache import LRUCache
+from app.utils.metrics import Counter
 
 vertexai.init(project=google_cloud_project_name, location="us-central1")
 
@@ -49,62 +55,150 @@ safety_settings = {
 }
 
 
+def image_part(data: bytes) -> Part:
+    return Part.from_image(Image.from_bytes(data))
+
+
+def signature(message: dict) -> tuple:
+    # Answers are matched by position only, since the text Slack returns for them may differ from what was streamed.
+    if "app_id" in message:
+        return message.get("ts"), message.get("app_id")
+    return message.get("ts"), message.get("text"), tuple(file.get("id") for file in message.get("files", []))
+
+
+def _turn_sizes(messages: list) -> list:
+    # How many Slack messages each turn built by `_contents` holds, the empty turn before a leading answer included.
+    sizes = []
+    for role, group in itertools.groupby(messages, key=lambda message: "model" if "app_id" in message else "user"):
+        if role == "model" and not sizes:
+            sizes.append(0)
+        sizes.append(len(list(group)))
+    return sizes
+
+
+class ThreadSession:
+    """A Gemini chat session of one Slack thread, and the Slack messages its history was built from."""
+
+    def __init__(self, key: tuple, chat: ChatSession, messages: list):
+        self.key = key
+        self.chat = chat
+        self.messages = list(messages)
+        # Slack messages per turn of the chat history, the question about to be sent included.
+        self.sizes = _turn_sizes(messages)
+
+    def follow_up(self, thread: list) -> Optional[list]:
+        """
+        The user messages of the whole `thread` that are not in the session yet, or None when the thread no longer
+        matches it (an edited or deleted message, another bot).
+        """
+        first = self.messages[0].get("ts")
+        start = next((index for index, message in enumerate(thread) if message.get("ts") == first), None)
+        known = len(self.messages)
+        if start is None or list(map(signature, thread[start : start + known])) != list(map(signature, self.messages)):
+            return None
+        rest = thread[start + known :]
+        # Expect the answer to the last turn, possibly split over several Slack messages, and then new questions.
+        answer = list(itertools.takewhile(lambda message: "app_id" in message, rest))
+        question = rest[len(answer) :]
+        if not answer or not question or len({message.get("app_id") for message in answer}) > 1:
+            return None
+        if any("app_id" in message for message in question):
+            return None
+        self.messages.extend(rest)
+        self.sizes.extend((len(answer), len(question)))
+        return question
+
+    def slide(self):
+        """
+        Drops the oldest turns, a question and its answer at a time, until the session fits the context window the
+        way `select_history` would pick it, so a long thread keeps its session instead of falling out of the window.
+        """
+        excess = len(self.messages) - len(select_history(self.messages, LLMModel.GEMINI))
+        # The chat history always starts with a question and holds all turns but the one about to be sent.
+        while excess > 0 and len(self.sizes) > 2:
+            dropped = self.sizes[0] + self.sizes[1]
+            del self.chat.history[:2]
+            del self.sizes[:2]
+            del self.messages[:dropped]
+            excess -= dropped
+
+
+# (channel, thread_ts) -> ThreadSession whose last answer completed. Sessions are taken out while a turn is running.
+_sessions = LRUCache(maxsize=gemini_session_cache_size, ttl=gemini_session_idle_seconds)
+
+SESSIONS = Counter("gemini_sessions_total", "Gemini turns by whether the cached chat session was reused", ("result",))
+
+
+def _contents(chat_history: list, attachments: dict) -> list:
+    # The system expects strict alternation of user and model messages, so consecutive messages of the same role
+    # are merged into one turn.
+    contents = []
+    for role, group in itertools.groupby(chat_history, key=lambda message: "model" if "app_id" in message else "user"):
+        messages = list(group)
+        if role == "model":
+            if not contents:
+                contents.append(Content(role="user", parts=[Part.from_text("")]))
+            text = "\n".join(message.get("text") for message in messages)
+            contents.append(Content(role="model", parts=[Part.from_text(text)]))
+        else:
+            parts = [Part.from_text(". ".join(message.get("text") for message in messages).lstrip())]
+            for file in (file for message in messages for file in message.get("files", [])):
+                if (attachment := attachments.get(file.get("url_private"))) is not None:
+                    parts.append(attachment.encode(LLMModel.GEMINI, image_part))
+            contents.append(Content(role="user", parts=parts))
+    return contents
+
+
 async def build_gemini_message(slack_client, channel: str, thread_ts: str):
     # Get past chat history and fit it into the Gemini format.
-    conversations_replies = slack_client.conversations_replies(channel=channel, ts=thread_ts)
-    chat_history = conversations_replies.data.get("messages")[-1 * number_of_messages_to_keep :]
-    messages = []
-    images = []
-    content = ""
-    with tempfile.TemporaryDirectory() as dir_path:
-        for index, history in enumerate(chat_history, start=1):
-            role = "model" if "app_id" in history else "user"
-            # The system expects strict alternation of user and model messages.
-            # This handling ensures that order is maintained to prevent unexpected behavior.
-            if role == "user":
-                content = f"{content}. {history.get('text')}" if content else history.get("text")
-                if files := history.get("files", []):
-                    for file in files:
-                        if file.get("size") > MAX_FILE_BYTES:
-                            continue
-                        url = file.get("url_private")
-                        filename = f"{dir_path}/{file.get('name')}"
-                        if download_file(url, filename):
-                            images.append(filename)
-                        else:
-                            logging.warning("Failed - Download error")
-                if index == len(chat_history):
-                    if list(filter(lambda x: x["size"] > MAX_FILE_BYTES, files)):
-                        raise Exception(f"서버 비용 문제로 {MAX_FILE_BYTES/1000/1000}MB 이상되는 이미지는 처리할 수 없습니다")
-                    parts = [Part.from_text(re.sub(r"<@(.*?)>", "", content).lstrip())]
-                    if images:
-                        parts.extend([Part.from_image(Image.load_from_file(image)) for image in images])
-                    messages.append(Content(role="user", parts=parts))
-            else:
-                parts = [Part.from_text(content)]
-                if images:
-                    parts.extend([Part.from_image(Image.load_from_file(image)) for image in images])
-                messages.append(Content(role="user", parts=parts))
-                messages.append(Content(role="model", parts=[Part.from_text(history.get("text"))]))
-                content = ""
-                images.clear()
-
-    last_message = messages.pop()
-    chat = model.start_chat(history=messages, response_validation=False)
-    return chat, last_message
-
-
-async def get_gemini(chat, message):
-    responses = await chat.send_message_async(
+    thread = await get_thread_history(slack_client, channel, thread_ts)
+    if "app_id" not in thread[-1]:
+        if list(filter(lambda x: x["size"] > max_download_bytes, thread[-1].get("files", []))):
+            raise Exception(f"서버 비용 문제로 {max_download_bytes/1000/1000}MB 이상되는 이미지는 처리할 수 없습니다")
+
+    # Continue the thread's chat session when it still matches Slack, so only the new question is built. The session
+    # is matched against the whole thread, and slides along with it once it outgrows the context window.
+    key = (channel, thread_ts)
+    session = _sessions.pop(key)
+    if session is not None and (question := session.follow_up(thread)) is not None:
+        SESSIONS.inc(result="reused")
+        session.slide()
+        messages = question
+    else:
+        SESSIONS.inc(result="rebuilt")
+        session = None
+        messages = select_history(thread, LLMModel.GEMINI)
+
+    files = [file for history in messages if "app_id" not in history for file in history.get("files", [])]
+    contents = _contents(messages, await load_images(files, LLMModel.GEMINI))
+    last_message = contents.pop()
+    if session is None:
+        session = ThreadSession(key, model.start_chat(history=contents, response_validation=False), messages)
+    return session, last_message
+
+
+async def get_gemini(session: ThreadSession, message):
+    turns = len(session.chat.history)
+    responses = await session.chat.send_message_async(
         content=message,
         generation_config=generation_config,
         safety_settings=safety_settings,
         stream=True,
     )
 
+    usage = None
     async for chunk in responses:
+        usage = chunk.usage_metadata or usage
         try:
             chunk_message = chunk.text
             yield chunk_message
         except ValueError as e:
             ...
+
+    # Vertex AI context caching needs an explicitly created cache of at least 32k tokens, which doesn't suit chat
+    # threads, so Gemini input is always uncached.
+    record_input_tokens(LLMModel.GEMINI, uncached=field(usage, "prompt_token_count"))
+
+    # Only a session whose history holds the complete answer can be continued next turn.
+    if len(session.chat.history) == turns + 2:
+        _sessions.set(session.key, session)
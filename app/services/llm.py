@@ -0,0 +1,258 @@
+import asyncio
+import importlib
+import logging
+import sys
+import time
+from types import ModuleType
+from typing import AsyncIterator, Optional
+
+from app.config.constants import LLMModel, gpt_model, max_token, enable_hedging, hedge_deadline_seconds, enabled_models
+from app.services.context import estimate_text_tokens
+from app.services.provider_stats import provider_router
+from app.utils import tracing
+from app.utils.metrics import Counter, Histogram, current_model
+
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "llm_time_to_first_token_seconds", "Time from sending the request to the first chunk", ("model",)
+)
+STREAM_SECONDS = Histogram("llm_stream_seconds", "Time from sending the request to the last chunk", ("model",))
+CHUNKS = Counter("llm_chunks_total", "Chunks streamed from the LLM", ("model",))
+TOKENS = Counter("llm_output_tokens_total", "Estimated tokens streamed from the LLM", ("model",))
+TOKENS_PER_SECOND = Histogram(
+    "llm_tokens_per_second", "Estimated output tokens per second of a stream", ("model",), (5, 10, 20, 50, 100, 200, 500)
+)
+
+
+# Provider modules import heavy SDKs and create clients at import time, so they are only loaded when needed.
+PROVIDERS = {
+    LLMModel.GPT: "app.services.openai_chat",
+    LLMModel.GEMINI: "app.services.google_gemini",
+    LLMModel.CLAUDE: "app.services.anthropic_claude",
+}
+
+_provider_locks: dict[LLMModel, asyncio.Lock] = {}
+
+GPT_PARAMETERS = {
+    "max_tokens": max_token,
+    "temperature": 0.7,
+    "top_p": 1,
+    "presence_penalty": 0.5,
+    "frequency_penalty": 0.5,
+}
+
+
+async def load_provider(llm_model: LLMModel) -> ModuleType:
+    if llm_model not in enabled_models:
+        raise Exception(f"Error - {llm_model.value} is not enabled")
+    if (module := sys.modules.get(PROVIDERS[llm_model])) is not None:
+        return module
+    async with _provider_locks.setdefault(llm_model, asyncio.Lock()):
+        # Import in a thread so loading an SDK doesn't stall the streams already running on the event loop.
+        started = time.perf_counter()
+        module = await asyncio.to_thread(importlib.import_module, PROVIDERS[llm_model])
+        logging.info(f"Loaded {llm_model.value} provider in {time.perf_counter() - started:.2f}s")
+        return module
+
+
+async def preload_providers():
+    results = await asyncio.gather(*(load_provider(llm_model) for llm_model in enabled_models), return_exceptions=True)
+    for llm_model, result in zip(enabled_models, results):
+        if isinstance(result, Exception):
+            logging.error(f"Failed - loading {llm_model.value} provider: {result!r}")
+
+
+async def open_stream(llm_model: LLMModel, slack_client, channel: str, thread_ts: str) -> AsyncIterator[str]:
+    # Build the conversation for `llm_model` from the Slack thread. Errors raised here are about the request
+    # itself (e.g. an attachment that is too large), so they are not held against the provider.
+    token = current_model.set(llm_model.value)
+    try:
+        with tracing.span("build", model=llm_model.value):
+            return await _open_stream(llm_model, slack_client, channel, thread_ts)
+    finally:
+        current_model.reset(token)
+
+
+async def _open_stream(llm_model: LLMModel, slack_client, channel: str, thread_ts: str) -> AsyncIterator[str]:
+    provider = await load_provider(llm_model)
+    if llm_model == LLMModel.GPT:
+        # Set the data to send
+        messages = await provider.build_chatgpt_message(slack_client, channel, thread_ts)
+
+        # Send messages to the ChatGPT server and respond to Slack
+        return provider.get_chatgpt(
+            messages=messages,
+            gpt_model=gpt_model if gpt_model else provider.Model.GPT_3_5_TURBO.value,
+            **GPT_PARAMETERS,
+        )
+    elif llm_model == LLMModel.GEMINI:
+        chat, content = await provider.build_gemini_message(slack_client, channel, thread_ts)
+        return provider.get_gemini(chat, content)
+    elif llm_model == LLMModel.CLAUDE:
+        messages = await provider.build_claude_message(slack_client, channel, thread_ts)
+        return provider.get_claude(messages)
+    else:
+        raise Exception(f"Error - Unknown model: {llm_model}")
+
+
+async def _follow(llm_model: LLMModel, first_chunk: str, stream: AsyncIterator[str], started: float):
+    stats = provider_router.stats(llm_model)
+    tokens = estimate_text_tokens(first_chunk)
+    chunks = 1
+    try:
+        yield first_chunk
+        async for chunk in stream:
+            tokens += estimate_text_tokens(chunk)
+            chunks += 1
+            yield chunk
+    except Exception as e:
+        stats.record_failure(e)
+        raise
+    finally:
+        CHUNKS.inc(chunks, model=llm_model.value)
+        TOKENS.inc(tokens, model=llm_model.value)
+    duration = time.monotonic() - started
+    stats.record_stream(tokens, duration)
+    STREAM_SECONDS.observe(duration, model=llm_model.value)
+    if duration > 0:
+        TOKENS_PER_SECOND.observe(tokens / duration, model=llm_model.value)
+
+
+class HedgeStats:
+    def __init__(self):
+        self.fired = 0
+        self.won = 0
+
+    def to_dict(self) -> dict:
+        return {"fired": self.fired, "won": self.won}
+
+
+hedge_stats = HedgeStats()
+
+
+class _BuildError(Exception):
+    """A hedge whose request could not be built, which is not the provider's fault."""
+
+
+class _Racer:
+    """A provider racing for the first chunk, with the stream it answers on once its request is built."""
+
+    def __init__(self, llm_model: LLMModel, stream: Optional[AsyncIterator[str]] = None):
+        self.llm_model = llm_model
+        self.stream = stream
+        self.started = time.monotonic()
+
+    async def first_chunk(self, slack_client, channel: str, thread_ts: str) -> str:
+        if self.stream is None:
+            try:
+                self.stream = await open_stream(self.llm_model, slack_client, channel, thread_ts)
+            except Exception as e:
+                raise _BuildError(e) from e
+            self.started = time.monotonic()
+        try:
+            return await self.stream.__anext__()
+        except StopAsyncIteration:
+            return ""
+
+    async def abandon(self, task: asyncio.Task):
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # Closing the generator runs its cleanup, which closes the provider's HTTP stream.
+        if self.stream is not None:
+            await self.stream.aclose()
+
+
+async def _race(
+    llm_model: LLMModel,
+    stream: AsyncIterator[str],
+    slack_client,
+    channel: str,
+    thread_ts: str,
+    tried: list,
+    hedge: bool = False,
+):
+    """
+    Waits for the first chunk of `llm_model`. With `hedge`, a second provider is started once
+    `hedge_deadline_seconds` pass without a chunk, and whichever answers first wins while the other is cancelled.
+    The second provider's request is built in its own task, so building it never holds up the first chunk.
+    """
+    primary = _Racer(llm_model, stream)
+    task = asyncio.create_task(primary.first_chunk(slack_client, channel, thread_ts))
+    racers = {task: primary}
+    # Ended by hand: a racer's span lasts until it produces a chunk, fails or is abandoned.
+    spans = {task: tracing.start_span("first_token", model=llm_model.value)}
+    tried.append(llm_model)
+
+    if hedge:
+        await asyncio.wait({task}, timeout=hedge_deadline_seconds)
+        if not task.done() and (secondary := provider_router.choose(exclude=tuple(tried))) is not None:
+            hedge_stats.fired += 1
+            logging.info(f"[{thread_ts}] {llm_model.value} is slow to start, hedging with {secondary.value}")
+            tried.append(secondary)
+            racer = _Racer(secondary)
+            secondary_task = asyncio.create_task(racer.first_chunk(slack_client, channel, thread_ts))
+            racers[secondary_task] = racer
+            spans[secondary_task] = tracing.start_span("first_token", model=secondary.value, hedge=True)
+
+    error = None
+    pending = set(racers)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                racer = racers[finished]
+                stats = provider_router.stats(racer.llm_model)
+                if (exception := finished.exception()) is not None:
+                    spans[finished].fail(exception)
+                    spans[finished].end()
+                    if isinstance(exception, _BuildError):
+                        logging.warning(f"[{thread_ts}] Failed - hedge with {racer.llm_model.value}: {exception}")
+                        continue
+                    stats.record_failure(exception)
+                    error = error or exception
+                    continue
+                spans[finished].end()
+                stats.record_first_token(time.monotonic() - racer.started)
+                TIME_TO_FIRST_TOKEN_SECONDS.observe(time.monotonic() - racer.started, model=racer.llm_model.value)
+                for loser in pending:
+                    if racers[loser].stream is not None:
+                        loser_stats = provider_router.stats(racers[loser].llm_model)
+                        loser_stats.record_slow_start(time.monotonic() - racers[loser].started)
+                    spans[loser].set(abandoned=True)
+                pending, losers = set(), pending
+                await asyncio.gather(*(racers[loser].abandon(loser) for loser in losers))
+                if racer.llm_model != llm_model:
+                    hedge_stats.won += 1
+                return racer.llm_model, finished.result(), racer.stream, racer.started
+    finally:
+        # Only reached with pending streams when the generation itself is cancelled.
+        await asyncio.gather(*(racers[task].abandon(task) for task in pending))
+        for span in spans.values():
+            span.end()
+    raise error
+
+
+async def start_stream(
+    llm_model: LLMModel, slack_client, channel: str, thread_ts: str, failover: bool = False
+) -> tuple[LLMModel, AsyncIterator[str]]:
+    """
+    Starts generating an answer and waits for its first chunk.
+
+    With `failover`, a provider that fails before producing its first chunk is replaced by the next one the
+    provider router recommends, so the user only ever sees the answer of the provider that worked. The fallback runs in
+    the scheduler slot of the model the answer was routed to, not in one of its own. Only such routes, which may be
+    answered by any provider, are hedged.
+    """
+    tried = []
+    while True:
+        stream = await open_stream(llm_model, slack_client, channel, thread_ts)
+        try:
+            model, first_chunk, stream, started = await _race(
+                llm_model, stream, slack_client, channel, thread_ts, tried, hedge=enable_hedging and failover
+            )
+        except Exception as e:
+            if not failover or (fallback := provider_router.choose(exclude=tuple(tried))) is None:
+                raise
+            logging.warning(f"[{thread_ts}] {llm_model.value} failed before its first chunk, failing over: {e}")
+            llm_model = fallback
+            continue
+        return model, _follow(model, first_chunk, stream, started)
@@ -1,7 +1,6 @@
 import logging
-import re
-import tempfile
 from enum import Enum
+from functools import lru_cache
 
 from openai import AsyncOpenAI
 from fastapi import Query
@@ -13,7 +12,14 @@ from tenacity import (
     retry_if_exception_type,
 )  # for exponential backoff
 
-from app.config.constants import system_content, number_of_messages_to_keep, gpt_model, MAX_FILE_BYTES, openai_token
+from app.config.constants import (
+    system_content,
+    gpt_model,
+    max_download_bytes,
+    openai_token,
+    LLMModel,
+    GPT_VISION_MODELS,
+)
 from app.config.messages import (
     model_description,
     max_tokens_description,
@@ -22,7 +28,10 @@ from app.config.messages import (
     presence_penalty_description,
     frequency_penalty_description,
 )
-from app.utils.file import download_file, encode_image
+from app.services.attachments import load_images
+from app.services.context import select_history
+from app.services.slack_history import get_thread_history
+from app.services.usage import field, record_input_tokens
 
 
 class Model(Enum):
@@ -30,7 +39,10 @@ class Model(Enum):
     GPT_3_5_TURBO = "gpt-3.5-turbo"
 
 
-client = AsyncOpenAI(api_key=openai_token)
+@lru_cache(maxsize=None)
+def get_client() -> AsyncOpenAI:
+    # Created on first use, so deployments that never call OpenAI don't need a token.
+    return AsyncOpenAI(api_key=openai_token)
 
 
 @retry(
@@ -39,39 +51,19 @@ client = AsyncOpenAI(api_key=openai_token)
     retry=retry_if_exception_type(RateLimitError),
 )
 async def completions_with_backoff(**kwargs):
-    return await client.chat.completions.create(**kwargs)
-
+    return await get_client().chat.completions.create(**kwargs)
 
-async def get_chatgpt(
-    messages: list,
-    gpt_model: str = Query(Model.GPT_3_5_TURBO.value, description=model_description),
-    max_tokens: int = Query(2048, description=max_tokens_description),
-    temperature: float = Query(0.7, description=temperature_description),
-    top_p: float = Query(1, description=top_p_description),
-    presence_penalty: float = Query(0.5, description=presence_penalty_description),
-    frequency_penalty: float = Query(0.5, description=frequency_penalty_description),
-):
-    if system_content:
-        messages.insert(0, {"role": "system", "content": system_content})
 
+async def _create(**kwargs):
     # https://platform.openai.com/docs/api-reference/completions/create
     try:
-        response = await completions_with_backoff(
-            model=gpt_model,
-            stream=True,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            presence_penalty=presence_penalty,
-            frequency_penalty=frequency_penalty,
-            messages=messages,
-        )
+        return await completions_with_backoff(**kwargs)
     except AuthenticationError as e:
         logging.error(e)
         raise Exception("The token is invalid.")
     except BadRequestError as e:
         logging.error(e)
-        if "This model's maximum context length is 4097 tokens" in str(e):
+        if "maximum context length" in str(e):
             raise Exception("너무 긴 답변을 유도하셨습니다. 이미지를 첨부하셨다면 글자가 너무 많지 않은지 확인해주세요.")
         else:
             raise Exception("오류가 발생했습니다 :sob: 다시 시도해 주세요.")
@@ -82,9 +74,44 @@ async def get_chatgpt(
         logging.exception(e)
         raise Exception("오류가 발생했습니다 :sob: 다시 시도해 주세요.")
 
+
+def _record_usage(usage):
+    cached = field(field(usage, "prompt_tokens_details", None), "cached_tokens")
+    record_input_tokens(LLMModel.GPT, uncached=usage.prompt_tokens - cached, cache_read=cached)
+
+
+async def get_chatgpt(
+    messages: list,
+    gpt_model: str = Query(Model.GPT_3_5_TURBO.value, description=model_description),
+    max_tokens: int = Query(2048, description=max_tokens_description),
+    temperature: float = Query(0.7, description=temperature_description),
+    top_p: float = Query(1, description=top_p_description),
+    presence_penalty: float = Query(0.5, description=presence_penalty_description),
+    frequency_penalty: float = Query(0.5, description=frequency_penalty_description),
+):
+    if system_content:
+        messages.insert(0, {"role": "system", "content": system_content})
+
+    response = await _create(
+        model=gpt_model,
+        stream=True,
+        # The last chunk then carries the usage, including the prompt tokens served from OpenAI's prompt cache.
+        stream_options={"include_usage": True},
+        max_tokens=max_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        presence_penalty=presence_penalty,
+        frequency_penalty=frequency_penalty,
+        messages=messages,
+    )
+
     try:
         collected_messages = []
         async for chunk in response:
+            if chunk.usage is not None:
+                _record_usage(chunk.usage)
+            if not chunk.choices:
+                continue
             chunk_message = chunk.choices[0].delta.content
             collected_messages.append(chunk_message)
             yield chunk_message if chunk_message else " "
@@ -93,33 +120,62 @@ async def get_chatgpt(
         raise Exception("오류가 발생했습니다 :sob: 다시 시도해 주세요.")
 
 
+async def complete_chatgpt(
+    messages: list,
+    gpt_model: str = Model.GPT_3_5_TURBO.value,
+    max_tokens: int = 2048,
+    temperature: float = 0.7,
+    top_p: float = 1,
+    presence_penalty: float = 0.5,
+    frequency_penalty: float = 0.5,
+) -> dict:
+    """Same as `get_chatgpt`, but waits for the whole answer. Returns its text, finish reason and usage."""
+    if system_content:
+        messages.insert(0, {"role": "system", "content": system_content})
+
+    response = await _create(
+        model=gpt_model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        presence_penalty=presence_penalty,
+        frequency_penalty=frequency_penalty,
+        messages=messages,
+    )
+    if response.usage is not None:
+        _record_usage(response.usage)
+    choice = response.choices[0]
+    return {
+        "content": choice.message.content,
+        "finish_reason": choice.finish_reason,
+        "usage": response.usage.model_dump() if response.usage is not None else None,
+    }
+
+
 async def build_chatgpt_message(slack_client, channel: str, thread_ts: str):
     # Get past chat history and fit it into the ChatGPT format.
-    conversations_replies = slack_client.conversations_replies(channel=channel, ts=thread_ts)
-    chat_history = conversations_replies.data.get("messages")[-1 * number_of_messages_to_keep :]
+    chat_history = select_history(await get_thread_history(slack_client, channel, thread_ts), LLMModel.GPT)
+    vision = gpt_model in GPT_VISION_MODELS
+    attachments = {}
+    if vision:
+        files = [file for history in chat_history for file in history.get("files", [])]
+        attachments = await load_images(files, LLMModel.GPT)
     messages = []
-    with tempfile.TemporaryDirectory() as dir_path:
-        for index, history in enumerate(chat_history, start=1):
-            role = "assistant" if "app_id" in history else "user"
-            content = []
-            if gpt_model in ("gpt-4-turbo", "gpt-4o") and (files := history.get("files", [])):
-                for file in files:
-                    if file.get("size") > MAX_FILE_BYTES:
-                        continue
-                    url = file.get("url_private")
-                    filename = f"{dir_path}/{file.get('name')}"
-                    if download_file(url, filename):
-                        content.append(
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": f"data:{file.get('mimetype')};base64,{encode_image(filename)}"},
-                            }
-                        )
-                    else:
-                        logging.warning("Failed - Download error")
-                if index == len(chat_history):
-                    if list(filter(lambda x: x["size"] > MAX_FILE_BYTES, files)):
-                        raise Exception(f"서버 비용 문제로 {MAX_FILE_BYTES/1000/1000}MB 이상되는 이미지는 처리할 수 없습니다")
-            content.append({"type": "text", "text": re.sub(r"<@(.*?)>", "", history.get("text"))})
-            messages.append({"role": role, "content": content})
+    for index, history in enumerate(chat_history, start=1):
+        role = "assistant" if "app_id" in history else "user"
+        content = []
+        if vision and (files := history.get("files", [])):
+            for file in files:
+                if (attachment := attachments.get(file.get("url_private"))) is not None:
+                    content.append(
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": f"data:{attachment.mimetype};base64,{attachment.base64}"},
+                        }
+                    )
+            if index == len(chat_history):
+                if list(filter(lambda x: x["size"] > max_download_bytes, files)):
+                    raise Exception(f"서버 비용 문제로 {max_download_bytes/1000/1000}MB 이상되는 이미지는 처리할 수 없습니다")
+        content.append({"type": "text", "text": history.get("text")})
+        messages.append({"role": role, "content": content})
     return messages
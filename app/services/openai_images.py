@@ -1,13 +1,27 @@
+import asyncio
+import base64
 from enum import Enum
+from functools import lru_cache
 from typing import Optional, Literal
+
 from openai import AsyncOpenAI
 
+from app.config.constants import openai_token
+from app.utils.file import download_file
+
 
 class ResponseFormat(Enum):
     URL = "url"
     B64_JSON = "b64_json"
 
 
+@lru_cache(maxsize=None)
+def get_client() -> AsyncOpenAI:
+    # One client, and so one connection pool, for the configured key. Keys passed in by API callers get a client per
+    # request instead, so they aren't kept around.
+    return AsyncOpenAI(api_key=openai_token)
+
+
 async def generate_image(
     api_key: str,
     prompt: str,
@@ -15,13 +29,39 @@ async def generate_image(
     quality: Literal["standard", "hd"],
     model: str = "dall-e-3",
     n: int = 1,
-):
-    client = AsyncOpenAI(api_key=api_key)
-    response = await client.images.generate(
-        model=model,
-        prompt=prompt,
-        size=size,
-        quality=quality,
-        n=n,
-    )
+) -> str:
+    """Generates an image with the caller's `api_key` and returns its URL, for the HTTP API."""
+    async with AsyncOpenAI(api_key=api_key) as client:
+        response = await client.images.generate(
+            model=model, prompt=prompt, size=size, quality=quality, n=n, response_format=ResponseFormat.URL.value
+        )
     return response.data[0].url
+
+
+async def generate_images(
+    prompt: str,
+    size: Optional[Literal["256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"]],
+    quality: Literal["standard", "hd"],
+    model: str = "dall-e-3",
+    n: int = 1,
+    response_format: ResponseFormat = ResponseFormat.B64_JSON,
+) -> list[bytes]:
+    """Generates `n` images with the configured key and returns their contents, without touching the disk."""
+    client = get_client()
+    # DALL-E 3 only makes one image per request, so more are requested side by side.
+    counts = [1] * n if model == "dall-e-3" else [n]
+    responses = await asyncio.gather(
+        *(
+            client.images.generate(
+                model=model, prompt=prompt, size=size, quality=quality, n=count, response_format=response_format.value
+            )
+            for count in counts
+        )
+    )
+    images = [image for response in responses for image in response.data]
+    if response_format == ResponseFormat.B64_JSON:
+        return [base64.b64decode(image.b64_json) for image in images]
+    contents = await asyncio.gather(*(download_file(image.url, max_bytes=None) for image in images))
+    if any(content is None for content in contents):
+        raise Exception("Error - download_file failed")
+    return contents
@@ -0,0 +1,137 @@
+import random
+import time
+from enum import Enum
+from typing import Optional
+
+from app.config.constants import (
+    LLMModel,
+    provider_weights,
+    circuit_breaker_failures,
+    circuit_breaker_cooldown,
+    enabled_models,
+)
+
+# Weight of the latest sample in the rolling averages.
+ALPHA = 0.2
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+def is_rate_limit(error: BaseException) -> bool:
+    # Providers wrap their SDK errors, so look through the whole chain. Matching on names keeps the SDKs unimported.
+    while error is not None:
+        if type(error).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests"):
+            return True
+        if getattr(error, "status_code", None) == 429:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class ProviderStats:
+    def __init__(self, llm_model: LLMModel, weight: float):
+        self.llm_model = llm_model
+        self.weight = weight
+        self.ttft = 1.0  # seconds, a neutral prior until the first sample
+        self.tokens_per_second = 0.0
+        self.error_rate = 0.0
+        self.rate_limit_rate = 0.0
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+
+    def record_first_token(self, ttft: float):
+        self.ttft += ALPHA * (ttft - self.ttft)
+        self.error_rate -= ALPHA * self.error_rate
+        self.rate_limit_rate -= ALPHA * self.rate_limit_rate
+        self.consecutive_failures = 0
+        self.state = CircuitState.CLOSED
+
+    def record_slow_start(self, elapsed: float):
+        # A stream abandoned before its first chunk only tells us the first token would have taken longer than this.
+        if elapsed > self.ttft:
+            self.ttft += ALPHA * (elapsed - self.ttft)
+
+    def record_stream(self, tokens: int, duration: float):
+        if duration > 0:
+            self.tokens_per_second += ALPHA * (tokens / duration - self.tokens_per_second)
+
+    def record_failure(self, error: BaseException):
+        rate_limited = is_rate_limit(error)
+        self.error_rate += ALPHA * (1 - self.error_rate)
+        self.rate_limit_rate += ALPHA * ((1 if rate_limited else 0) - self.rate_limit_rate)
+        self.consecutive_failures += 1
+        if self.state != CircuitState.CLOSED or self.consecutive_failures >= circuit_breaker_failures:
+            self.state = CircuitState.OPEN
+            self.opened_at = time.monotonic()
+
+    @property
+    def circuit(self) -> CircuitState:
+        # Once the cooldown has passed, requests go through again to probe whether the provider recovered.
+        if self.state == CircuitState.OPEN and time.monotonic() - self.opened_at >= circuit_breaker_cooldown:
+            return CircuitState.HALF_OPEN
+        return self.state
+
+    def available(self) -> bool:
+        return self.circuit != CircuitState.OPEN
+
+    @property
+    def cost(self) -> float:
+        return self.ttft * (1 + 4 * self.error_rate + 4 * self.rate_limit_rate)
+
+    def to_dict(self) -> dict:
+        return {
+            "weight": self.weight,
+            "ttft": round(self.ttft, 3),
+            "tokens_per_second": round(self.tokens_per_second, 1),
+            "error_rate": round(self.error_rate, 3),
+            "rate_limit_rate": round(self.rate_limit_rate, 3),
+            "circuit": self.circuit.value,
+        }
+
+
+class ProviderRouter:
+    """
+    Picks a provider for /slack/random from rolling per-provider statistics.
+
+    Healthy providers are drawn with probability proportional to `weight / cost²`, where cost is the average
+    time-to-first-token inflated by recent error and rate-limit rates. Squaring favours the fastest provider
+    strongly while the others still receive enough traffic to keep their statistics fresh. Providers whose circuit
+    is open are skipped until the cooldown lets a probe through.
+    """
+
+    def __init__(self, weights: dict):
+        self.providers = {llm_model: ProviderStats(llm_model, weight) for llm_model, weight in weights.items()}
+
+    def stats(self, llm_model: LLMModel) -> ProviderStats:
+        return self.providers[llm_model]
+
+    def choose(self, exclude: tuple = ()) -> Optional[LLMModel]:
+        candidates = [
+            stats for stats in self.providers.values() if stats.llm_model not in exclude and stats.weight > 0
+        ]
+        healthy = [stats for stats in candidates if stats.available()]
+        if not healthy:
+            # Everything is failing: fall back to the provider that has been failing least.
+            return min(candidates, key=lambda stats: stats.cost).llm_model if candidates else None
+        weights = [stats.weight / stats.cost**2 for stats in healthy]
+        return random.choices(healthy, weights=weights)[0].llm_model
+
+    def to_dict(self) -> dict:
+        return {llm_model.value: stats.to_dict() for llm_model, stats in self.providers.items()}
+
+
+def parse_weights(value: str) -> dict:
+    weights = {llm_model: 1.0 for llm_model in LLMModel}
+    for item in filter(None, value.split(",")):
+        name, _, weight = item.partition("=")
+        weights[LLMModel(name.strip())] = float(weight)
+    # Disabled providers are never loaded, so they must never be chosen.
+    return {llm_model: weight if llm_model in enabled_models else 0.0 for llm_model, weight in weights.items()}
+
+
+provider_router = ProviderRouter(parse_weights(provider_weights))
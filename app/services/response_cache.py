@@ -0,0 +1,82 @@
+"""
+Exact-match cache of answers to one-shot questions.
+
+Only a top-level mention without attachments, outside the excluded channels, is looked up: its history is the
+message itself, so the key can be computed from the event without reading the thread. Follow-ups in a thread always
+go to the LLM.
+"""
+import hashlib
+import json
+from typing import AsyncIterator, Optional
+
+from app.config.constants import (
+    LLMModel,
+    claude_model,
+    enable_grounding,
+    enable_response_cache,
+    gemini_model,
+    gpt_model,
+    max_token,
+    response_cache_exclude_channels,
+    response_cache_size,
+    response_cache_ttl,
+    system_content,
+)
+from app.services.llm import GPT_PARAMETERS
+from app.services.state import shared_state
+from app.utils.message import strip_mentions
+from app.utils.metrics import Counter
+
+LOOKUPS = Counter("response_cache_lookups_total", "Response cache lookups", ("model", "result"))
+
+# Besides the messages, what decides an answer. Changing any of them starts from an empty cache.
+SETTINGS = {
+    LLMModel.GPT: {"model": gpt_model, **GPT_PARAMETERS},
+    LLMModel.GEMINI: {"model": gemini_model, "max_tokens": max_token, "grounding": bool(enable_grounding)},
+    LLMModel.CLAUDE: {"model": claude_model, "max_tokens": max_token},
+}
+
+
+class ResponseCache:
+    def __init__(self, enabled: bool, maxsize: int, ttl: float, excluded_channels: set):
+        self.enabled = enabled
+        self.excluded_channels = excluded_channels
+        self._answers = shared_state("response:", maxsize, ttl=ttl)
+
+    def key(self, event: dict, llm_model: LLMModel) -> Optional[str]:
+        """The cache key of the answer `llm_model` gives to `event`, or None when it must not be cached."""
+        if not self.enabled or event.get("thread_ts") or event.get("files"):
+            return None
+        if event.get("channel") in self.excluded_channels:
+            return None
+        if not (text := " ".join(strip_mentions(event.get("text")).split())):
+            return None
+        messages = [{"role": "user", "content": text}]
+        if system_content:
+            messages.insert(0, {"role": "system", "content": system_content})
+        payload = {"model": llm_model.value, "settings": SETTINGS[llm_model], "messages": messages}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    async def get(self, key: str, llm_model: LLMModel) -> Optional[str]:
+        answer = await self._answers.get(key)
+        LOOKUPS.inc(model=llm_model.value, result="miss" if answer is None else "hit")
+        return answer
+
+    async def set(self, key: str, answer: str):
+        if answer.strip():
+            await self._answers.set(key, answer)
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, **self._answers.stats()}
+
+
+async def replay(answer: str) -> AsyncIterator[str]:
+    yield answer
+
+
+response_cache = ResponseCache(
+    enable_response_cache,
+    response_cache_size,
+    response_cache_ttl,
+    {channel.strip() for channel in response_cache_exclude_channels.split(",") if channel.strip()},
+)
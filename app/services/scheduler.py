@@ -0,0 +1,220 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Optional
+
+from app.config.constants import (
+    LLMModel,
+    gpt_concurrency,
+    gemini_concurrency,
+    claude_concurrency,
+    enabled_models,
+    max_queue_depth,
+    queue_placeholder_seconds,
+    shutdown_grace_seconds,
+)
+from app.services.generations import Generation, generations
+from app.services.slack import message_process, get_slack_client
+from app.services.state import thread_locks
+from app.utils import tracing
+from app.utils.metrics import Histogram
+
+QUEUED_MESSAGE = "요청이 많아 답변을 기다리는 중입니다 :hourglass_flowing_sand: 순서가 되면 바로 답변드릴게요."
+BUSY_MESSAGE = "지금은 요청이 너무 많아 처리할 수 없습니다 :sob: 잠시 후 다시 시도해 주세요."
+
+QUEUE_WAIT_SECONDS = Histogram("queue_wait_seconds", "Time a generation waited for a worker", ("model",))
+
+# Direct messages are answered before channel mentions.
+PRIORITY_DM = 0
+PRIORITY_CHANNEL = 1
+
+
+class Job:
+    def __init__(self, slack_message: dict, llm_model: LLMModel, failover: bool = False):
+        self.slack_message = slack_message
+        self.llm_model = llm_model
+        self.failover = failover
+        self.event = slack_message.get("event") or {}
+        self.priority = PRIORITY_DM if self.event.get("channel_type") == "im" else PRIORITY_CHANNEL
+        self.enqueued_at = time.monotonic()
+        self.placeholder: Optional[asyncio.Task] = None
+        self.posting_placeholder = False
+        self.generation = Generation(self.channel, self.thread_ts, self.event.get("ts"), llm_model)
+        # The span of the Slack event, which the answer is traced under once a worker picks the job up.
+        self.span = tracing.current_span()
+        self.queued = tracing.NOOP
+
+    @property
+    def channel(self) -> str:
+        return self.event.get("channel")
+
+    @property
+    def thread_ts(self) -> str:
+        return self.event.get("thread_ts") or self.event.get("ts")
+
+    @property
+    def is_new_message(self) -> bool:
+        # Edits, deletions and bot posts don't replace the question being answered.
+        return self.event.get("subtype") not in ("message_changed", "message_deleted") and not self.event.get("bot_id")
+
+
+class JobScheduler:
+    """
+    Runs Slack generations on a fixed pool of workers per LLM.
+
+    Each model has its own priority queue bounded by `max_queue_depth`. A job that waits longer than
+    `placeholder_seconds` gets a "queued" message right away, which the answer later replaces. On shutdown the
+    scheduler stops accepting jobs and lets queued and running ones finish for up to `grace_seconds`.
+
+    Concurrency is counted per routed model: a /slack/random job that fails over or hedges to another provider keeps
+    the worker of the model it was routed to, so a provider can briefly serve more streams than its own limit.
+    """
+
+    def __init__(self, concurrency: dict, max_depth: int, placeholder_seconds: float, grace_seconds: float):
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.placeholder_seconds = placeholder_seconds
+        self.grace_seconds = grace_seconds
+        self.rejected = 0
+        self._queues: dict[LLMModel, asyncio.PriorityQueue] = {}
+        self._workers: list[asyncio.Task] = []
+        self._sequence = itertools.count()
+        self._closing = False
+        self._background: set[asyncio.Task] = set()
+
+    def submit(self, slack_message: dict, llm_model: LLMModel, failover: bool = False) -> bool:
+        job = Job(slack_message, llm_model, failover)
+        if self._closing or not job.event:
+            return False
+        self._start()
+        queue = self._queues[llm_model]
+        if queue.qsize() >= self.max_depth:
+            self.rejected += 1
+            logging.warning(f"[{job.thread_ts}] {llm_model.value} queue is full, rejecting the request")
+            task = asyncio.create_task(self._post(job, BUSY_MESSAGE))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+            return False
+        job.queued = tracing.start_span("queue", model=llm_model.value, depth=queue.qsize(), priority=job.priority)
+        job.placeholder = asyncio.create_task(self._placeholder(job))
+        if job.is_new_message:
+            generations.register(job.generation)
+        queue.put_nowait((job.priority, next(self._sequence), job))
+        return True
+
+    async def shutdown(self):
+        self._closing = True
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues.values())), timeout=self.grace_seconds
+            )
+        except asyncio.TimeoutError:
+            logging.warning("Shutdown grace period exceeded, cancelling the remaining generations")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for queue in self._queues.values():
+            # Jobs that never got a worker still end their traces.
+            while not queue.empty():
+                _, _, job = queue.get_nowait()
+                job.queued.set(cancelled=True)
+                job.queued.end()
+        self._workers.clear()
+        self._queues.clear()
+
+    def stats(self) -> dict:
+        return {
+            "queued": {model.value: queue.qsize() for model, queue in self._queues.items()},
+            "concurrency": {model.value: workers for model, workers in self.concurrency.items()},
+            "rejected": self.rejected,
+        }
+
+    def _start(self):
+        # Workers are started lazily because they need the running event loop.
+        if self._workers:
+            return
+        for llm_model, workers in self.concurrency.items():
+            self._queues[llm_model] = asyncio.PriorityQueue()
+            self._workers.extend(asyncio.create_task(self._work(llm_model)) for _ in range(workers))
+
+    async def _work(self, llm_model: LLMModel):
+        queue = self._queues[llm_model]
+        while True:
+            _, _, job = await queue.get()
+            QUEUE_WAIT_SECONDS.observe(time.monotonic() - job.enqueued_at, model=job.llm_model.value)
+            try:
+                await self._answer(job)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                generations.unregister(job.generation)
+                queue.task_done()
+
+    async def _answer(self, job: Job):
+        # The answer span starts before the queue span ends, so the trace stays open in between.
+        with tracing.span("answer", parent=job.span, model=job.llm_model.value, generation=job.generation.id):
+            job.queued.end()
+            placeholder_ts = await self._take_placeholder(job)
+            if job.generation.stopped:
+                # A newer message in the thread replaced this one while it was waiting.
+                if placeholder_ts:
+                    await get_slack_client().chat_delete(channel=job.channel, ts=placeholder_ts)
+                return
+            await generations.wait_for_older(job.generation)
+            # Other workers may be answering the same thread; superseding only applies within this one.
+            async with thread_locks.hold(job.channel, job.thread_ts):
+                # A task per job gives every generation its own context (metric labels, current span) and makes it
+                # cancellable.
+                job.generation.task = asyncio.create_task(
+                    message_process(
+                        job.slack_message,
+                        job.llm_model,
+                        placeholder_ts=placeholder_ts,
+                        failover=job.failover,
+                        generation=job.generation,
+                    )
+                )
+                await job.generation.task
+
+    async def _placeholder(self, job: Job) -> Optional[str]:
+        await asyncio.sleep(self.placeholder_seconds)
+        job.posting_placeholder = True
+        return await self._post(job, QUEUED_MESSAGE)
+
+    async def _take_placeholder(self, job: Job) -> Optional[str]:
+        if job.placeholder is None:
+            return None
+        if not job.posting_placeholder:
+            job.placeholder.cancel()
+            return None
+        return await job.placeholder
+
+    @staticmethod
+    async def _post(job: Job, text: str) -> Optional[str]:
+        try:
+            result = await get_slack_client().chat_postMessage(
+                channel=job.channel, text=text, thread_ts=job.thread_ts, attachments=[]
+            )
+        except Exception as e:
+            logging.warning(f"Failed - {text}: {e}")
+            return None
+        return result["ts"]
+
+
+scheduler = JobScheduler(
+    concurrency={
+        llm_model: workers
+        for llm_model, workers in (
+            (LLMModel.GPT, gpt_concurrency),
+            (LLMModel.GEMINI, gemini_concurrency),
+            (LLMModel.CLAUDE, claude_concurrency),
+        )
+        if llm_model in enabled_models
+    },
+    max_depth=max_queue_depth,
+    placeholder_seconds=queue_placeholder_seconds,
+    grace_seconds=shutdown_grace_seconds,
+)
@@ -1,116 +1,167 @@
+import asyncio
 import logging
 import re
-import tempfile
+from typing import Optional
 from uuid import uuid4
 
 from openai import BadRequestError
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
-
-from app.config.constants import (
-    slack_token,
-    gpt_model,
-    LLMModel,
-    openai_token,
-    max_token,
-)
-from app.services.anthropic_claude import build_claude_message, get_claude
-from app.services.google_gemini import build_gemini_message, get_gemini
-from app.services.openai_chat import get_chatgpt, Model, build_chatgpt_message
-from app.services.openai_images import generate_image
-from app.utils.file import download_file
-from app.utils.message import async_generator
-
-
-async def message_process(slack_message: dict, llm_model: LLMModel):
-    slack_client = WebClient(token=slack_token)
+from slack_sdk.web.async_client import AsyncWebClient
+
+from app.config.constants import slack_token, slack_api_url, LLMModel, dalle_model, dalle_max_images
+from app.services import slack_history
+from app.services.generations import Generation, StopPolicy
+from app.services.llm import start_stream
+from app.services.openai_images import generate_images
+from app.services.response_cache import replay, response_cache
+from app.services.slack_rate_limit import RateLimitedWebClient
+from app.services.slack_stream import SlackStreamPublisher
+from app.utils import tracing
+from app.utils.http import get_http_session
+from app.utils.message import async_generator, strip_mentions
+from app.utils.metrics import current_model
+
+_slack_client: Optional[AsyncWebClient] = None
+
+STOPPED_MESSAGE = "\n\n_(답변이 중단되었습니다)_"
+GENERATING_IMAGE_MESSAGE = "이미지를 생성하고 있습니다 :art:"
+
+# "!a cat" asks DALL-E for one image, "!3 a cat" for three. The count needs a space after it, so "!1980s style"
+# is a prompt.
+IMAGE_COMMAND = re.compile(r"!(?:(\d+)\s+)?(.*)", re.DOTALL)
+
+
+def get_slack_client() -> AsyncWebClient:
+    # Share a single client (and its pooled HTTP session) across every message in the process.
+    global _slack_client
+    session = get_http_session()
+    if _slack_client is None or _slack_client.session is not session:
+        _slack_client = RateLimitedWebClient(token=slack_token, base_url=slack_api_url, session=session)
+    return _slack_client
+
+
+async def message_process(
+    slack_message: dict,
+    llm_model: LLMModel,
+    placeholder_ts: Optional[str] = None,
+    failover: bool = False,
+    generation: Optional[Generation] = None,
+):
+    slack_client = get_slack_client()
     event = slack_message.get("event")
     channel = event.get("channel")
     thread_ts = event.get("thread_ts") if event.get("thread_ts") else event.get("ts")
-    user = event.get("user")
     api_app_id = slack_message.get("api_app_id")
+    # The question and the answer are recorded (cut to `trace_payload_chars`) on the span of the answer.
+    span = tracing.current_span()
+    span.set_payload(request=event.get("text"))
+
+    await slack_history.record_event(channel, thread_ts, event)
 
+    # Generations that don't come through the scheduler are not registered, so nothing can stop them.
+    generation = generation or Generation(channel, thread_ts, event.get("ts"), llm_model)
+    publisher = SlackStreamPublisher(slack_client, channel, thread_ts, ts=placeholder_ts)
+    cache_key = None  # Set once the answer comes from the LLM and may be cached.
     try:
-        if llm_model == LLMModel.GPT:
-            content = re.sub(r"<@(.*?)>", "", event.get("text")).lstrip()
-            if content.startswith("!"):
-                image_url_link = await generate_image(
-                    api_key=openai_token, prompt=content, size="1024x1024", quality="standard"
-                )
-                with tempfile.TemporaryDirectory() as dir_path:
-                    filename = f"{dir_path}/{uuid4()}"
-                    if download_file(image_url_link, filename):
-                        return slack_client.files_upload_v2(
-                            channel=channel,
-                            thread_ts=thread_ts,
-                            title="DALL-E",
-                            file=filename,
+        try:
+            content = strip_mentions(event.get("text")).lstrip()
+            if llm_model == LLMModel.GPT and content.startswith("!"):
+                count, prompt = IMAGE_COMMAND.match(content).groups()
+                # Generating takes a while, so let the user know right away.
+                await publisher.placeholder(GENERATING_IMAGE_MESSAGE)
+                n = max(1, min(int(count or 1), dalle_max_images))
+                with tracing.span("image.generate", model=dalle_model, n=n):
+                    images = await generation.run(
+                        generate_images(
+                            prompt=prompt,
+                            size="1024x1024",
+                            quality="standard",
+                            model=dalle_model,
+                            n=n,
                         )
-                    else:
-                        raise Exception(f"Error - download_file failed")
+                    )
+                with tracing.span("image.upload", n=len(images)):
+                    await _upload_images(slack_client, channel, thread_ts, images)
+                await slack_history.invalidate(channel, thread_ts)
+                return await publisher.discard()
+            elif (key := response_cache.key(event, llm_model)) and (cached := await response_cache.get(key, llm_model)):
+                # Replayed through the same publisher, so it looks like any other answer.
+                response_message = replay(cached)
+                span.set(cached=True)
             else:
-                # Set the data to send
-                messages = await build_chatgpt_message(slack_client, channel, thread_ts)
-
-                # Send messages to the ChatGPT server and respond to Slack
-                response_message = get_chatgpt(
-                    messages=messages,
-                    gpt_model=gpt_model if gpt_model else Model.GPT_3_5_TURBO.value,
-                    max_tokens=max_token,
-                    temperature=0.7,
-                    top_p=1,
-                    presence_penalty=0.5,
-                    frequency_penalty=0.5,
+                llm_model, response_message = await generation.run(
+                    start_stream(llm_model, slack_client, channel, thread_ts, failover=failover)
                 )
-        elif llm_model == LLMModel.GEMINI:
-            chat, content = await build_gemini_message(slack_client, channel, thread_ts)
-            response_message = get_gemini(chat, content)
-        elif llm_model == LLMModel.CLAUDE:
-            messages = await build_claude_message(slack_client, channel, thread_ts)
-            response_message = get_claude(messages)
-        else:
-            raise Exception(f"Error - Unknown model: {llm_model}")
-    except BadRequestError as e:
-        if e.code == "content_policy_violation":
-            response_message = async_generator(
-                f"{e.body.get('message')}: 이미지 생성 요청에 부적합한 단어가 사용됐습니다. 표현을 변경해서 다시 시도해 주세요."
-            )
-        else:
+                cache_key = response_cache.key(event, llm_model)
+        except BadRequestError as e:
+            span.fail(e)
+            if e.code == "content_policy_violation":
+                response_message = async_generator(
+                    f"{e.body.get('message')}: 이미지 생성 요청에 부적합한 단어가 사용됐습니다. 표현을 변경해서 다시 시도해 주세요."
+                )
+            else:
+                response_message = async_generator(e.__str__())
+        except Exception as e:
+            span.fail(e)
             response_message = async_generator(e.__str__())
-    except Exception as e:
-        response_message = async_generator(e.__str__())
 
-    logging.info(f"[{thread_ts}][{api_app_id}:{channel}:{user}] request_message: {event.get('text')}")
-    message = ts = ""
-    try:
-        async for chunk in response_message:
-            message += chunk
-            post_message = False
-            api_error = False
-            if not ts:
-                post_message = True
+        # Label everything done for this answer (Slack updates included) with the provider that produced it.
+        current_model.set(llm_model.value)
+        span.set(model=llm_model.value)
+        try:
+            with tracing.span("stream", model=llm_model.value) as stream_span:
+                chunks = 0
+                async for chunk in generation.iterate(response_message):
+                    chunks += 1
+                    await publisher.append(chunk)
+                await publisher.close()
+                stream_span.set(chunks=chunks, pages=len(publisher.pages()))
+            for ts, text in publisher.pages():
+                await slack_history.record_reply(channel, thread_ts, ts, text, api_app_id)
+            if cache_key is not None and publisher.text:
+                await response_cache.set(cache_key, publisher.text)
+        except Exception as e:
+            span.fail(e)
+            await slack_history.invalidate(channel, thread_ts)
+            if publisher.ts and not publisher.text:
+                await slack_client.chat_update(channel=channel, text=str(e), ts=publisher.ts, as_user=True)
             else:
-                # Logic to avoid Slack rate limits.
-                if len(message) % 10 == 0:
-                    try:
-                        slack_client.chat_update(channel=channel, text=message, ts=ts, as_user=True)
-                    except SlackApiError as e:
-                        if e.response["error"] == "msg_too_long":
-                            post_message = True
-                            api_error = True
-                        else:
-                            raise
-            if post_message:
-                if api_error:
-                    message = chunk
-                result = slack_client.chat_postMessage(
-                    channel=channel, text=message, thread_ts=thread_ts, attachments=[]
-                )
-                ts = result["ts"]
+                await slack_client.chat_postMessage(channel=channel, text=str(e), thread_ts=thread_ts, attachments=[])
+    except asyncio.CancelledError:
+        if generation.stopped is None:
+            raise
+        await _stop_answer(generation, publisher)
+        span.set(stopped=generation.stopped.value)
+        span.set_payload(response=publisher.text)
+        return
+
+    span.set_payload(response=publisher.text)
 
-        # Handle the last message from the generator
-        slack_client.chat_update(channel=channel, text=message, ts=ts, as_user=True)
-    except Exception as e:
-        slack_client.chat_postMessage(channel=channel, text=str(e), thread_ts=thread_ts, attachments=[])
 
-    logging.info(f"[{thread_ts}][{api_app_id}:{channel}:{user}] response_message: {message}")
+async def _upload_images(slack_client: AsyncWebClient, channel: str, thread_ts: str, images: list[bytes]):
+    # files_upload_v2 of the pinned SDK sends the bytes with blocking urllib, so the three steps are done here: every
+    # image gets an upload URL and is sent to it concurrently from memory, then all of them are shared in one message.
+    async def upload(image: bytes) -> str:
+        filename = f"{uuid4()}.png"
+        response = await slack_client.files_getUploadURLExternal(filename=filename, length=len(image))
+        async with get_http_session().post(response["upload_url"], data=image) as upload_response:
+            if upload_response.status != 200:
+                raise Exception(f"Error - uploading {filename} failed with {upload_response.status}")
+        return response["file_id"]
+
+    file_ids = await asyncio.gather(*(upload(image) for image in images))
+    await slack_client.files_completeUploadExternal(
+        files=[{"id": file_id, "title": "DALL-E"} for file_id in file_ids], channel_id=channel, thread_ts=thread_ts
+    )
+
+
+async def _stop_answer(generation: Generation, publisher: SlackStreamPublisher):
+    # The provider stream is already closed; what is left is the part of the answer that reached Slack.
+    await slack_history.invalidate(publisher.channel, publisher.thread_ts)
+    try:
+        if generation.stopped == StopPolicy.TRUNCATE and publisher.text:
+            await publisher.append(STOPPED_MESSAGE)
+            await publisher.close()
+        else:
+            await publisher.discard()
+    except Exception as e:
+        logging.warning(f"Failed - stopping the answer: {e}")
@@ -0,0 +1,111 @@
+import json
+from typing import Optional
+
+from slack_sdk.web.async_client import AsyncWebClient
+
+from app.config.constants import thread_cache_size, thread_cache_ttl
+from app.services.state import shared_state
+from app.utils import tracing
+from app.utils.message import strip_mentions
+from app.utils.metrics import Histogram, current_model
+
+# "channel:thread_ts" -> JSON of the normalized messages of the thread, oldest first. Shared by the workers, since
+# the next message of a thread may be answered by a different one than the last.
+_threads = shared_state("thread:", thread_cache_size, ttl=thread_cache_ttl)
+
+CONVERSATIONS_REPLIES_SECONDS = Histogram(
+    "slack_conversations_replies_seconds", "Latency of conversations.replies on a history cache miss", ("model",)
+)
+
+MESSAGE_KEYS = ("ts", "user", "app_id", "bot_id")
+# Subtypes of message events that add a message to a thread, as opposed to editing, deleting or announcing one.
+POSTED_SUBTYPES = (None, "file_share", "thread_broadcast", "bot_message")
+FILE_KEYS = ("id", "name", "mimetype", "size", "url_private", "original_w", "original_h")
+
+
+def _normalize(message: dict) -> dict:
+    normalized = {key: message[key] for key in MESSAGE_KEYS if key in message}
+    normalized["text"] = strip_mentions(message.get("text"))
+    if files := message.get("files"):
+        normalized["files"] = [{key: file[key] for key in FILE_KEYS if key in file} for file in files]
+    return normalized
+
+
+def _append(messages: list, message: dict):
+    # Slack may deliver the same message twice (retries, our own reply); the last write wins.
+    for index, existing in enumerate(messages):
+        if existing["ts"] == message["ts"]:
+            messages[index] = message
+            return
+    messages.append(message)
+    messages.sort(key=lambda item: float(item["ts"]))
+
+
+async def get_thread_history(slack_client: AsyncWebClient, channel: str, thread_ts: str) -> list:
+    # Every call decodes a fresh copy, so builders are free to modify what they get back.
+    with tracing.span("history") as span:
+        cached = await _threads.get(f"{channel}:{thread_ts}")
+        if cached is not None:
+            messages = json.loads(cached)
+            span.set(cache="hit", messages=len(messages))
+            return messages
+        with CONVERSATIONS_REPLIES_SECONDS.time(model=current_model.get()):
+            conversations_replies = await slack_client.conversations_replies(channel=channel, ts=thread_ts)
+        messages = [_normalize(message) for message in conversations_replies.data.get("messages")]
+        await _threads.set(f"{channel}:{thread_ts}", json.dumps(messages))
+        span.set(cache="miss", messages=len(messages))
+        return messages
+
+
+def _appended(cached: str, message: dict) -> str:
+    messages = json.loads(cached)
+    _append(messages, message)
+    return json.dumps(messages)
+
+
+async def _update(channel: str, thread_ts: str, message: dict):
+    # Only threads that are already cached are kept up to date; the others are read from Slack when needed. Other
+    # workers may update the same thread at once, so the read and the write are one atomic step.
+    await _threads.update(f"{channel}:{thread_ts}", lambda cached: _appended(cached, message))
+
+
+async def record_event(channel: str, thread_ts: str, event: dict):
+    if event.get("ts"):
+        await _update(channel, thread_ts, _normalize(event))
+
+
+async def record_reply(channel: str, thread_ts: str, ts: str, text: str, app_id: str):
+    await _update(channel, thread_ts, {"ts": ts, "app_id": app_id, "text": strip_mentions(text)})
+
+
+async def invalidate(channel: str, thread_ts: Optional[str]):
+    await _threads.delete(f"{channel}:{thread_ts}")
+
+
+async def observe_event(event: dict, app_id: Optional[str]) -> bool:
+    """
+    Keeps cached threads in step with a message event that isn't a question for the app, and tells whether it was
+    one. Those are channel messages without a mention, edits, deletions and the app's own messages.
+    """
+    if event.get("type") != "message":
+        return False
+    channel = event.get("channel")
+    subtype = event.get("subtype")
+    if subtype in ("message_changed", "message_deleted"):
+        message = event.get("message") or event.get("previous_message") or {}
+        # The app edits its answers on every flush and records them with `record_reply` once they are done. Other
+        # edits and deletions can touch any message of a thread, so drop the whole thread and refetch it next time.
+        if subtype == "message_deleted" or app_id is None or message.get("app_id") != app_id:
+            await invalidate(channel, message.get("thread_ts") or message.get("ts"))
+        return True
+    if app_id is not None and event.get("app_id") == app_id:
+        return True
+    if event.get("channel_type") == "im":
+        return False  # Direct messages are questions.
+    if subtype in POSTED_SUBTYPES:
+        await record_event(channel, event.get("thread_ts") or event.get("ts"), event)
+    return True
+
+
+def history_cache_stats() -> dict:
+    return _threads.stats()
@@ -0,0 +1,137 @@
+"""
+Process-wide pacing of Slack Web API calls.
+
+Slack limits every method per workspace by tier, and chat.postMessage additionally to about one message per
+second per channel. Calls wait for a token of their method (and channel) instead of failing, and a 429 blocks the
+method for its Retry-After before the call is retried. https://api.slack.com/apis/rate-limits
+"""
+import asyncio
+import contextvars
+import logging
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+
+from app.config.constants import slack_rate_limits, slack_channel_update_interval, slack_max_retries
+from app.utils import tracing
+from app.utils.metrics import Counter
+from app.utils.rate_limit import TokenBucket
+
+THROTTLED = Counter("slack_throttled_total", "Slack calls delayed to stay within the rate limits", ("method",))
+THROTTLED_SECONDS = Counter(
+    "slack_throttled_seconds_total", "Time Slack calls spent waiting for the rate limiter", ("method",)
+)
+RATE_LIMITED = Counter("slack_rate_limited_total", "429 responses received from Slack", ("method",))
+
+# Requests per minute per workspace; "50+" in Slack's documentation is taken as 50, and a burst of up to a minute's
+# worth is allowed. Methods that aren't listed are treated as tier 3.
+TIER_3 = 50
+METHOD_LIMITS = {
+    "chat.postMessage": 600,  # Special tier, limited per channel below.
+    "chat.update": TIER_3,
+    "chat.delete": TIER_3,
+    "conversations.replies": TIER_3,
+    "files.getUploadURLExternal": 20,
+    "files.completeUploadExternal": 20,
+}
+
+# (requests per second, burst) per channel.
+CHANNEL_LIMITS = {
+    "chat.postMessage": (1.0, 3),
+    "chat.update": (1 / slack_channel_update_interval, 1),
+}
+
+# The method whose token the current task already holds (see `SlackRateLimiter.reserve`).
+_reserved: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("slack_reserved_method", default=None)
+
+
+def parse_limits(value: str) -> dict:
+    limits = dict(METHOD_LIMITS)
+    for item in filter(None, value.split(",")):
+        method, _, per_minute = item.partition("=")
+        limits[method.strip()] = float(per_minute)
+    return limits
+
+
+class SlackRateLimiter:
+    def __init__(self, limits: dict):
+        self.limits = limits
+        self._methods: dict[str, TokenBucket] = {}
+        self._channels: dict[tuple, TokenBucket] = {}
+
+    async def acquire(self, method: str, channel: Optional[str] = None):
+        delay = self._method_bucket(method).reserve()
+        if channel and method in CHANNEL_LIMITS:
+            delay = max(delay, self._channel_bucket(method, channel).reserve())
+        if delay > 0:
+            THROTTLED.inc(method=method)
+            THROTTLED_SECONDS.inc(delay, method=method)
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def reserve(self, method: str, channel: Optional[str] = None):
+        """
+        Waits for a token before the body runs, so the body can build its request from the latest state (e.g. the
+        text of a streaming answer) instead of sending what it had when it started waiting.
+        """
+        await self.acquire(method, channel)
+        token = _reserved.set(method)
+        try:
+            yield
+        finally:
+            _reserved.reset(token)
+
+    def rate_limited(self, method: str, channel: Optional[str], retry_after: float):
+        RATE_LIMITED.inc(method=method)
+        logging.warning(f"Slack rate limited {method}, retrying after {retry_after}s")
+        self._method_bucket(method).block(retry_after)
+        if channel and method in CHANNEL_LIMITS:
+            self._channel_bucket(method, channel).block(retry_after)
+
+    def _method_bucket(self, method: str) -> TokenBucket:
+        if (bucket := self._methods.get(method)) is None:
+            per_minute = self.limits.get(method, TIER_3)
+            bucket = self._methods[method] = TokenBucket(per_minute / 60, per_minute)
+        return bucket
+
+    def _channel_bucket(self, method: str, channel: str) -> TokenBucket:
+        if (bucket := self._channels.get((method, channel))) is None:
+            if len(self._channels) > 1000:
+                for key in [key for key, bucket in self._channels.items() if bucket.idle]:
+                    del self._channels[key]
+            bucket = self._channels[(method, channel)] = TokenBucket(*CHANNEL_LIMITS[method])
+        return bucket
+
+
+rate_limiter = SlackRateLimiter(parse_limits(slack_rate_limits))
+
+
+def _retry_after(error: SlackApiError) -> float:
+    headers = {key.lower(): value for key, value in (error.response.headers or {}).items()}
+    try:
+        return float(headers.get("retry-after", 1))
+    except ValueError:
+        return 1.0
+
+
+class RateLimitedWebClient(AsyncWebClient):
+    """An AsyncWebClient whose calls go through `rate_limiter` and are retried on 429."""
+
+    async def api_call(self, api_method: str, *, json: Optional[dict] = None, data=None, params=None, **kwargs):
+        bodies = (body for body in (json, data, params) if isinstance(body, dict))
+        channel = next((body["channel"] for body in bodies if body.get("channel")), None)
+        with tracing.span(f"slack.{api_method}") as span:
+            attempt = 0
+            while True:
+                if attempt or _reserved.get() != api_method:
+                    await rate_limiter.acquire(api_method, channel)
+                try:
+                    return await super().api_call(api_method, json=json, data=data, params=params, **kwargs)
+                except SlackApiError as e:
+                    if e.response.status_code != 429 or attempt >= slack_max_retries:
+                        raise
+                    rate_limiter.rate_limited(api_method, channel, _retry_after(e))
+                attempt += 1
+                span.set(retries=attempt)
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import aiohttp
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+
+from app.config.constants import slack_update_interval, slack_update_chars, slack_page_chars
+from app.services.slack_rate_limit import rate_limiter
+from app.utils.metrics import Counter, current_model
+
+CHAT_UPDATES = Counter("slack_chat_update_total", "chat.update calls made while streaming", ("model",))
+CHAT_UPDATE_FAILURES = Counter("slack_chat_update_failures_total", "Failed chat.update calls", ("model", "error"))
+
+# Consecutive failed updates after which the answer is given up.
+MAX_UPDATE_FAILURES = 5
+
+FENCE = "```"
+
+
+def _fence_after(text: str, fence: str) -> str:
+    """Returns the opening line of the code block `text` ends in ("" if none), given the one it starts in."""
+    for line in text.split("\n"):
+        if line.lstrip().startswith(FENCE):
+            fence = "" if fence else line.strip()
+    return fence
+
+
+def _split_point(text: str, fence: str, budget: int) -> int:
+    """
+    Where to end a page of `text` (starting inside `fence`) so that it fits in `budget` characters: after a blank
+    line or the end of a code block, else after any line, else after a word, in the second half of the page.
+    """
+    window = text[:budget]
+    boundary = line = position = 0
+    for raw in window.split("\n")[:-1]:
+        position += len(raw) + 1
+        closed = _fence_after(raw, fence)
+        if not closed and (fence or not raw.strip()):
+            boundary = position
+        fence = closed
+        line = position
+    for split in (boundary, line, window.rfind(" ") + 1):
+        if split > budget // 2:
+            return split
+    return budget
+
+
+class SlackStreamPublisher:
+    """
+    Streams an answer into a Slack thread.
+
+    Chunks are coalesced in memory and flushed with chat_update when `slack_update_interval` seconds have passed
+    or `slack_update_chars` characters are pending, whichever comes first. At most one update per message is in
+    flight. When Slack's rate limits hold an update back, the text keeps accumulating and goes out with it. A failed
+    update is retried with the latest text, so only the final text has to get through.
+
+    Before a message reaches `slack_page_chars`, the answer continues in a new message of the thread, split at a
+    paragraph or code block boundary where possible. A code block cut by a split is closed at the end of the page
+    and reopened at the start of the next one. Only the last message is ever updated.
+    """
+
+    def __init__(self, slack_client: AsyncWebClient, channel: str, thread_ts: str, ts: Optional[str] = None):
+        self.slack_client = slack_client
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.text = ""
+        self.ts = ts  # An already posted message (e.g. a "queued" placeholder) to stream into.
+        self._offset = 0  # Where the current Slack message starts in `text`.
+        self._fence = ""  # The opening line of the code block the current Slack message starts in.
+        self._flushed = 0  # How much of `text` Slack has already seen.
+        self._last_flush = 0.0
+        self._failures = 0
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        # (ts, offset, fence) of every message of the answer.
+        self._pages: list[tuple[str, int, str]] = [(ts, 0, "")] if ts else []
+
+    async def append(self, chunk: str):
+        self.text += chunk
+        if self._task and self._task.done():
+            self._task.result()  # Surface errors raised by the previous flush.
+            self._task = None
+        if self._task is not None:
+            # The flush in progress picks the new text up, also while it continues the answer in a new message
+            # (when `ts` is briefly None).
+            if len(self.text) - self._flushed >= slack_update_chars:
+                self._wakeup.set()
+        elif self.ts is None:
+            await self._post()
+        else:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def close(self):
+        # Let the pending flush run immediately instead of cancelling it, so updates never overlap.
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            task, self._task = self._task, None
+            await task
+        if not self.text:
+            # Nothing to replace the placeholder with, so don't leave it saying the answer is on its way.
+            await self.discard()
+        elif self.ts is None:
+            await self._post()
+        else:
+            await self._flush_later()
+
+    async def placeholder(self, text: str):
+        """Shows `text` in the thread until the answer, which replaces it, starts."""
+        if self.ts is None:
+            result = await self.slack_client.chat_postMessage(
+                channel=self.channel, text=text, thread_ts=self.thread_ts, attachments=[]
+            )
+            self.ts = result["ts"]
+            self._pages.append((self.ts, self._offset, self._fence))
+        else:
+            await self.slack_client.chat_update(channel=self.channel, text=text, ts=self.ts, as_user=True)
+
+    async def discard(self):
+        """Stops streaming and deletes every message of the answer, the placeholder it was streamed into included."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        pages, self._pages, self.ts = self.pages(), [], None
+        for ts, _ in pages:
+            await self.slack_client.chat_delete(channel=self.channel, ts=ts)
+
+    def pages(self) -> list[tuple[str, str]]:
+        """The (ts, text) of every message of the answer, as posted to Slack."""
+        ends = [offset for _, offset, _ in self._pages[1:]] + [len(self.text)]
+        return [
+            (ts, self._render(self.text, offset, end, fence)) for (ts, offset, fence), end in zip(self._pages, ends)
+        ]
+
+    @staticmethod
+    def _render(text: str, offset: int, end: int, fence: str) -> str:
+        page = text[offset:end]
+        if end < len(text) and _fence_after(page, fence):
+            page += FENCE if page.endswith("\n") else "\n" + FENCE
+        return f"{fence}\n{page}" if fence else page
+
+    def _page_end(self, text: str) -> int:
+        """Where the current Slack message has to end for it to stay under `slack_page_chars`."""
+        prefix = len(self._fence) + 1 if self._fence else 0
+        if prefix + len(text) - self._offset <= slack_page_chars:
+            return len(text)
+        budget = max(1, slack_page_chars - prefix - len(FENCE) - 1)
+        return self._offset + _split_point(text[self._offset :], self._fence, budget)
+
+    def _next_page(self, text: str, end: int):
+        self._fence = _fence_after(text[self._offset : end], self._fence)
+        self._offset = end
+        self.ts = None
+
+    async def _flush_later(self):
+        while self._flushed < len(self.text):
+            if not self._closing and len(self.text) - self._flushed < slack_update_chars:
+                delay = self._last_flush + slack_update_interval - time.monotonic()
+                if delay > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+            async with rate_limiter.reserve("chat.update", self.channel):
+                await self._update()
+
+    async def _post(self):
+        while True:
+            text = self.text
+            end = self._page_end(text)
+            result = await self.slack_client.chat_postMessage(
+                channel=self.channel,
+                text=self._render(text, self._offset, end, self._fence),
+                thread_ts=self.thread_ts,
+                attachments=[],
+            )
+            self.ts = result["ts"]
+            self._pages.append((self.ts, self._offset, self._fence))
+            self._flushed = end
+            self._last_flush = time.monotonic()
+            if end == len(text):
+                return
+            self._next_page(text, end)
+
+    async def _update(self):
+        text = self.text
+        end = self._page_end(text)
+        CHAT_UPDATES.inc(model=current_model.get())
+        try:
+            await self.slack_client.chat_update(
+                channel=self.channel, text=self._render(text, self._offset, end, self._fence), ts=self.ts, as_user=True
+            )
+        except (SlackApiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e.response["error"] if isinstance(e, SlackApiError) else type(e).__name__
+            CHAT_UPDATE_FAILURES.inc(model=current_model.get(), error=error)
+            if error == "msg_too_long":
+                if self._flushed == self._offset:
+                    raise
+                # Slack counted more characters than we did (e.g. escaped entities). Keep the message as it was last
+                # accepted and continue the answer in a new one.
+                self._next_page(text, self._flushed)
+                await self._post()
+                return
+            self._failures += 1
+            if self._failures >= MAX_UPDATE_FAILURES:
+                raise
+            # The next update sends the whole text again, so a lost one only delays it.
+            logging.warning(f"Failed - chat.update ({error}), retrying")
+            self._last_flush = time.monotonic()
+            await asyncio.sleep(min(2**self._failures, 10))
+            return
+        self._failures = 0
+        self._flushed = end
+        self._last_flush = time.monotonic()
+        if end < len(text):
+            self._next_page(text, end)
+            await self._post()
@@ -0,0 +1,226 @@
+"""
+State that every worker serving the Slack apps has to agree on: event dedup keys, per-thread locks and caches.
+
+By default each process keeps its own in memory, which is only correct with a single worker. With `state_url`
+pointing at Redis (or anything speaking its protocol), workers and replicas share one store, so Slack events can be
+spread over all of them.
+"""
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+from uuid import uuid4
+
+from app.config.constants import state_url, thread_lock_ttl, thread_lock_timeout
+from app.utils.cache import LRUCache
+from app.utils.metrics import Counter, Histogram
+
+THREAD_LOCK_WAIT_SECONDS = Histogram("thread_lock_wait_seconds", "Time a generation waited for its thread's lock")
+THREAD_LOCK_TIMEOUTS = Counter("thread_lock_timeouts_total", "Generations that gave up waiting for a thread lock")
+
+LOCK_POLL_SECONDS = 0.1
+
+# Attempts of an optimistic `update` that keeps losing to concurrent writers before the key is dropped instead.
+MAX_UPDATE_ATTEMPTS = 5
+
+# Deletes a key only while it still holds the caller's value, so a lock that expired and was taken over by another
+# worker isn't released by the one that lost it.
+COMPARE_AND_DELETE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class StateBackend(ABC):
+    """String keys and values with a time-to-live. Implementations must make `add` atomic."""
+
+    @abstractmethod
+    async def add(self, key: str, value: str, ttl: float) -> bool:
+        """Sets `key` unless it is already set, and returns whether it did."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def peek(self, key: str) -> Optional[str]:
+        """Same as get(), but not counted as a cache hit or miss."""
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    async def update(self, key: str, function: Callable[[str], str]):
+        """
+        Replaces the value of `key` with `function(value)` (resetting its time-to-live) if it is set, atomically:
+        a concurrent write is never lost, at worst the key is deleted.
+        """
+
+    @abstractmethod
+    async def delete(self, key: str, value: Optional[str] = None) -> bool:
+        """Deletes `key`; with `value`, only while it still holds it."""
+
+    @abstractmethod
+    def stats(self) -> dict:
+        ...
+
+
+class InMemoryStateBackend(StateBackend):
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self._data = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    async def add(self, key: str, value: str, ttl: float) -> bool:
+        if self._data.peek(key) is not None:
+            return False
+        self._data.set(key, value, ttl)
+        return True
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._data.get(key)
+
+    async def peek(self, key: str) -> Optional[str]:
+        return self._data.peek(key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        self._data.set(key, value, ttl)
+
+    async def update(self, key: str, function: Callable[[str], str]):
+        # Nothing else runs between the read and the write.
+        if (value := self._data.peek(key)) is not None:
+            self._data.set(key, function(value))
+
+    async def delete(self, key: str, value: Optional[str] = None) -> bool:
+        if value is not None and self._data.peek(key) != value:
+            return False
+        return self._data.delete(key)
+
+    def stats(self) -> dict:
+        return {"backend": "memory", **self._data.stats()}
+
+
+class RedisStateBackend(StateBackend):
+    def __init__(self, client, prefix: str, ttl: Optional[float] = None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def add(self, key: str, value: str, ttl: float) -> bool:
+        return bool(await self.client.set(self.prefix + key, value, px=_milliseconds(ttl), nx=True))
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def peek(self, key: str) -> Optional[str]:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        await self.client.set(self.prefix + key, value, px=_milliseconds(ttl) if ttl is not None else None)
+
+    async def update(self, key: str, function: Callable[[str], str]):
+        from redis.exceptions import WatchError
+
+        # WATCH makes the write fail if anyone else wrote the key after it was read; then it is read again.
+        key = self.prefix + key
+        async with self.client.pipeline(transaction=True) as pipe:
+            for _ in range(MAX_UPDATE_ATTEMPTS):
+                try:
+                    await pipe.watch(key)
+                    if (value := await pipe.get(key)) is None:
+                        return
+                    pipe.multi()
+                    pipe.set(key, function(value), px=_milliseconds(self.ttl) if self.ttl is not None else None)
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    continue
+        await self.client.delete(key)
+
+    async def delete(self, key: str, value: Optional[str] = None) -> bool:
+        if value is None:
+            return bool(await self.client.delete(self.prefix + key))
+        return bool(await self.client.eval(COMPARE_AND_DELETE, 1, self.prefix + key, value))
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+
+def _milliseconds(seconds: float) -> int:
+    return max(1, int(seconds * 1000))
+
+
+_redis = None
+
+
+def _redis_client():
+    global _redis
+    if _redis is None:
+        # Only needed when the state is shared.
+        import redis.asyncio
+
+        _redis = redis.asyncio.Redis.from_url(state_url, decode_responses=True)
+    return _redis
+
+
+def shared_state(prefix: str, maxsize: int, ttl: Optional[float] = None) -> StateBackend:
+    """
+    The store for one kind of state: a `prefix` namespace of the shared Redis when `state_url` is set, otherwise an
+    in-process LRU of `maxsize` keys. `ttl` is the default time-to-live of `set`.
+    """
+    if state_url:
+        return RedisStateBackend(_redis_client(), prefix, ttl)
+    return InMemoryStateBackend(maxsize, ttl)
+
+
+async def close_state():
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+    _redis = None
+
+
+class ThreadLocks:
+    """
+    Makes sure only one worker at a time answers a given thread, so answers to consecutive messages don't interleave
+    when they land on different workers. A lock expires after `ttl` seconds in case its worker dies; a generation
+    that can't get it within `timeout` seconds goes ahead anyway.
+    """
+
+    def __init__(self, backend: StateBackend, ttl: float, timeout: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.timeout = timeout
+
+    @asynccontextmanager
+    async def hold(self, channel: str, thread_ts: str):
+        key = f"{channel}:{thread_ts}"
+        token = uuid4().hex
+        started = time.monotonic()
+        acquired = await self.backend.add(key, token, self.ttl)
+        while not acquired and time.monotonic() - started < self.timeout:
+            await asyncio.sleep(LOCK_POLL_SECONDS)
+            acquired = await self.backend.add(key, token, self.ttl)
+        THREAD_LOCK_WAIT_SECONDS.observe(time.monotonic() - started)
+        if not acquired:
+            THREAD_LOCK_TIMEOUTS.inc()
+            logging.warning(f"[{thread_ts}] Timed out waiting for the thread lock, answering anyway")
+        try:
+            yield
+        finally:
+            if acquired:
+                await self.backend.delete(key, token)
+
+
+thread_locks = ThreadLocks(shared_state("lock:", maxsize=10_000), thread_lock_ttl, thread_lock_timeout)
@@ -0,0 +1,138 @@
+"""
+Sends sampled traces to an OpenTelemetry collector over OTLP/HTTP with the JSON encoding.
+
+Spans are batched in memory and posted through the shared HTTP session every `EXPORT_INTERVAL` seconds, or as soon
+as `BATCH_SPANS` are pending. When the collector is down or slow, at most `MAX_PENDING_SPANS` are kept and the
+rest are dropped, so tracing never holds up or grows with the answers. https://opentelemetry.io/docs/specs/otlp/
+"""
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from app.config.constants import otlp_endpoint, otlp_headers, otlp_service_name
+from app.utils import tracing
+from app.utils.http import get_http_session
+from app.utils.metrics import Counter
+
+EXPORTED_SPANS = Counter("trace_spans_exported_total", "Spans accepted by the OTLP collector")
+DROPPED_SPANS = Counter("trace_spans_dropped_total", "Spans that were not exported", ("reason",))
+
+EXPORT_INTERVAL = 5.0
+BATCH_SPANS = 512
+MAX_PENDING_SPANS = 8192
+
+SPAN_KIND_INTERNAL = 1
+STATUS_CODE_ERROR = 2
+
+
+def parse_headers(value: str) -> dict:
+    headers = {}
+    for item in filter(None, value.split(",")):
+        name, _, header = item.partition("=")
+        headers[name.strip()] = header.strip()
+    return headers
+
+
+def _value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _value(value)} for key, value in attributes.items()]
+
+
+def encode_span(span: tracing.Span) -> dict:
+    encoded = {
+        "traceId": span.trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": SPAN_KIND_INTERNAL,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": _attributes(span.attributes),
+    }
+    if span.parent_id:
+        encoded["parentSpanId"] = span.parent_id
+    if span.error is not None:
+        encoded["status"] = {"code": STATUS_CODE_ERROR, "message": span.error}
+    return encoded
+
+
+class OTLPExporter:
+    def __init__(self, endpoint: str, headers: dict, service_name: str):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.headers = headers
+        self.resource = {"attributes": _attributes({"service.name": service_name, "process.pid": os.getpid()})}
+        self.exported = 0
+        self.failures = 0
+        self._pending: list[dict] = []
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._closing = False
+
+    def export(self, trace: tracing.Trace):
+        room = MAX_PENDING_SPANS - len(self._pending)
+        if room < len(trace.spans):
+            DROPPED_SPANS.inc(len(trace.spans) - max(room, 0), reason="queue_full")
+        self._pending.extend(encode_span(span) for span in trace.spans[: max(room, 0)])
+        # Started lazily because it needs the running event loop.
+        if not self._closing and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+        if len(self._pending) >= BATCH_SPANS:
+            self._wakeup.set()
+
+    async def close(self):
+        # Let a batch that is being sent finish, then send what is left.
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._pending:
+            await self._send()
+
+    def stats(self) -> dict:
+        return {"url": self.url, "pending": len(self._pending), "exported": self.exported, "failures": self.failures}
+
+    async def _run(self):
+        while not self._closing:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=EXPORT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            while self._pending and not self._closing:
+                await self._send()
+
+    async def _send(self):
+        batch, self._pending = self._pending[:BATCH_SPANS], self._pending[BATCH_SPANS:]
+        scope_spans = [{"scope": {"name": "app"}, "spans": batch}]
+        body = {"resourceSpans": [{"resource": self.resource, "scopeSpans": scope_spans}]}
+        try:
+            async with get_http_session().post(self.url, json=body, headers=self.headers) as response:
+                if response.status >= 300:
+                    raise Exception(f"{response.status} {await response.text()}")
+        except Exception as e:
+            self.failures += 1
+            DROPPED_SPANS.inc(len(batch), reason="export_failed")
+            logging.warning(f"Failed - exporting {len(batch)} spans to {self.url}: {e!r}")
+            return
+        self.exported += len(batch)
+        EXPORTED_SPANS.inc(len(batch))
+
+
+otlp_exporter = OTLPExporter(otlp_endpoint, parse_headers(otlp_headers), otlp_service_name) if otlp_endpoint else None
+if otlp_exporter is not None:
+    tracing.exporters.append(otlp_exporter.export)
+
+
+async def close_trace_export():
+    if otlp_exporter is not None:
+        await otlp_exporter.close()
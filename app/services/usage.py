@@ -0,0 +1,30 @@
+import logging
+from typing import Any
+
+from app.config.constants import LLMModel
+from app.utils.metrics import Counter
+
+INPUT_TOKENS = Counter(
+    "llm_input_tokens_total",
+    "Input tokens reported by the LLM, by how the provider's prompt cache served them",
+    ("model", "cache"),
+)
+
+
+def field(value: Any, name: str, default: Any = 0) -> Any:
+    # Usage objects carry fields the pinned SDKs don't declare yet; those come back as plain attributes or dicts.
+    if value is None:
+        return default
+    result = value.get(name) if isinstance(value, dict) else getattr(value, name, None)
+    return default if result is None else result
+
+
+def record_input_tokens(llm_model: LLMModel, uncached: int, cache_read: int = 0, cache_write: int = 0):
+    """Records the input tokens of one request, split by how the provider's prompt cache handled them."""
+    INPUT_TOKENS.inc(uncached, model=llm_model.value, cache="uncached")
+    INPUT_TOKENS.inc(cache_read, model=llm_model.value, cache="read")
+    INPUT_TOKENS.inc(cache_write, model=llm_model.value, cache="write")
+    logging.info(
+        f"[{llm_model.value}] input tokens: {uncached} uncached, {cache_read} read from cache, "
+        f"{cache_write} written to cache"
+    )
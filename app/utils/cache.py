@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """Bounded mapping with least-recently-used eviction and an optional time-to-live per entry."""
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        # Same as get(), but without touching the counters or the recency order.
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            return default
+        return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        # `ttl` overrides the cache's own for this entry.
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else float("inf")
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        # Same as get(), but takes the entry out of the cache.
+        item = self._data.pop(key, None)
+        if item is None or item[0] < time.monotonic():
+            self.misses += 1
+            return default
+        self.hits += 1
+        return item[1]
+
+    def delete(self, key: Hashable) -> bool:
+        """Removes `key` without touching the counters, and tells whether it held an entry that had not expired."""
+        item = self._data.pop(key, None)
+        return item is not None and item[0] >= time.monotonic()
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+    def __len__(self) -> int:
+        return len(self._data)
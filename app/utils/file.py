@@ -1,19 +1,62 @@
+import asyncio
 import base64
-import requests
-from app.config.constants import slack_token
+import logging
+import time
+from typing import Optional
 
+from app.config.constants import slack_token, MAX_FILE_BYTES, download_concurrency
+from app.utils import tracing
+from app.utils.http import get_http_session
+from app.utils.metrics import Counter, Histogram, current_model
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+CHUNK_SIZE = 64 * 1024
 
+DOWNLOAD_BYTES = Counter("attachment_download_bytes_total", "Bytes of attachments downloaded", ("model",))
+DOWNLOAD_SECONDS = Histogram("attachment_download_seconds", "Time to download one attachment", ("model",))
 
-def download_file(url: str, filename):
+# Bounds how many downloads run at once across the whole process.
+_download_slots = asyncio.Semaphore(download_concurrency)
+
+
+def encode_image(data: bytes) -> str:
+    return base64.b64encode(data).decode("utf-8")
+
+
+async def download_file(url: str, max_bytes: Optional[int] = MAX_FILE_BYTES) -> Optional[bytes]:
     headers = {"Authorization": f"Bearer {slack_token}"} if "slack" in url else {}
-    r = requests.get(url, headers=headers)
-    if r.status_code == 200:
-        with open(filename, "wb") as f:
-            f.write(r.content)
-        return True
-    else:
-        return False
+    # The span includes the wait for a download slot.
+    with tracing.span("attachment.download") as span:
+        async with _download_slots:
+            started = time.perf_counter()
+            async with get_http_session().get(url, headers=headers) as response:
+                span.set(status=response.status)
+                if response.status != 200:
+                    logging.warning(f"Failed - Download error: {url} returned {response.status}")
+                    return None
+                if max_bytes is not None and (response.content_length or 0) > max_bytes:
+                    logging.warning(f"Skipped - {url} is larger than {max_bytes} bytes")
+                    return None
+                # The `size` reported by Slack is not trusted, the limit is enforced on what is actually read.
+                data = bytearray()
+                async for block in response.content.iter_chunked(CHUNK_SIZE):
+                    data.extend(block)
+                    if max_bytes is not None and len(data) > max_bytes:
+                        logging.warning(f"Skipped - {url} is larger than {max_bytes} bytes")
+                        return None
+                span.set(bytes=len(data))
+                DOWNLOAD_BYTES.inc(len(data), model=current_model.get())
+                DOWNLOAD_SECONDS.observe(time.perf_counter() - started, model=current_model.get())
+                return bytes(data)
+
+
+async def download_files(files: list, max_bytes: Optional[int] = MAX_FILE_BYTES) -> dict:
+    """Downloads Slack files concurrently and returns their contents keyed by `url_private`."""
+    urls = list(dict.fromkeys(file.get("url_private") for file in files if file.get("url_private")))
+    results = await asyncio.gather(*(download_file(url, max_bytes) for url in urls), return_exceptions=True)
+    downloads = {}
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Failed - Download error: {result!r}")
+        elif result is not None:
+            downloads[url] = result
+    return downloads
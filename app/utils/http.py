@@ -0,0 +1,25 @@
+from typing import Optional
+
+import aiohttp
+
+from app.config.constants import http_pool_size, http_timeout
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    # One pooled session per process. It is created lazily because aiohttp binds it to the running event loop.
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=http_pool_size, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=http_timeout),
+        )
+    return _session
+
+
+async def close_http_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -0,0 +1,90 @@
+import asyncio
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, NamedTuple
+
+from PIL import ExifTags, Image, ImageOps
+
+from app.config.constants import image_workers, image_quality
+
+# Pillow releases the GIL while decoding, resizing and encoding, so a few threads keep this off the event loop.
+_pool = ThreadPoolExecutor(max_workers=image_workers, thread_name_prefix="image")
+
+MAX_ROUNDS = 3
+
+# Formats every provider accepts as they are.
+PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+class ImageLimits(NamedTuple):
+    """The largest image a provider makes use of; anything bigger is downsampled by the provider anyway."""
+
+    max_side: int
+    max_short_side: Optional[int] = None
+    max_pixels: Optional[int] = None
+
+
+def target_size(width: int, height: int, limits: ImageLimits) -> tuple[int, int]:
+    scale = min(1, limits.max_side / max(width, height))
+    if limits.max_short_side:
+        scale = min(scale, limits.max_short_side / min(width, height))
+    if limits.max_pixels:
+        scale = min(scale, (limits.max_pixels / (width * height)) ** 0.5)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _preprocess(data: bytes, limits: ImageLimits, max_bytes: int) -> tuple[bytes, str]:
+    image = Image.open(io.BytesIO(data))
+    size = target_size(*image.size, limits)
+    # Phone photos are often rotated through EXIF only, which is about to be stripped.
+    oriented = image.getexif().get(ExifTags.Base.Orientation, 1) == 1
+    if (
+        size == image.size
+        and len(data) <= max_bytes
+        and oriented
+        and image.format in PASSTHROUGH_FORMATS
+        and not image.info.get("exif")
+    ):
+        # Already small enough and clean: re-encoding would only lose quality.
+        return data, PASSTHROUGH_FORMATS[image.format]
+
+    # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale directly, which is much cheaper than decoding in full.
+    image.draft("RGB", size)
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("P", "LA", "PA"):
+        image = image.convert("RGBA")
+    alpha = image.mode == "RGBA" and image.getextrema()[3][0] < 255
+    image = image.convert("RGBA" if alpha else "RGB")
+    if image.size != size:
+        size = target_size(*image.size, limits)
+        image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    # Saving without `exif` or `icc_profile` drops the metadata. Images that still don't fit in `max_bytes` are made
+    # smaller in proportion to how far off they are; a few rounds are enough even for noisy photos.
+    for _ in range(MAX_ROUNDS):
+        output = io.BytesIO()
+        if alpha:
+            image.save(output, format="WEBP", quality=image_quality)
+        else:
+            image.save(output, format="JPEG", quality=image_quality, optimize=True)
+        if output.tell() <= max_bytes:
+            break
+        scale = (max_bytes / output.tell()) ** 0.5 * 0.9
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+    return output.getvalue(), "image/webp" if alpha else "image/jpeg"
+
+
+async def preprocess_image(data: bytes, limits: ImageLimits, max_bytes: int) -> Optional[tuple[bytes, str]]:
+    """
+    Downscales `data` to `limits`, strips its metadata and re-encodes it as JPEG (WebP when it has transparency).
+    Images that are within `limits` and `max_bytes` and carry no metadata are returned as they are.
+
+    Returns the new bytes and their mimetype, or None if `data` is not an image Pillow can read.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_pool, _preprocess, data, limits, max_bytes)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        logging.warning(f"Failed - image preprocessing: {e!r}")
+        return None
@@ -1,4 +1,13 @@
+import re
+
+MENTION_PATTERN = re.compile(r"<@(.*?)>")
+
+
 async def async_generator(message):
     for char in message:
         yield char
     yield " "
+
+
+def strip_mentions(text: str) -> str:
+    return MENTION_PATTERN.sub("", text or "")
@@ -0,0 +1,34 @@
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` operations per second with bursts of up to `burst`.
+
+    Callers reserve a token and sleep for the returned delay, so waiting callers are served in order and spaced
+    evenly instead of all retrying at once. `block` stops handing out tokens for a while (e.g. a Retry-After).
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how many seconds to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self.tokens -= 1
+        return max(0.0, self.blocked_until - now) + max(0.0, -self.tokens / self.rate)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        # Callers queued behind the block are spaced out after it instead of all going at once.
+        self.tokens = min(self.tokens, 0.0)
+
+    @property
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self._updated) * self.rate >= self.burst
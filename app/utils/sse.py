@@ -0,0 +1,53 @@
+import asyncio
+import json
+from typing import AsyncIterator, Optional
+
+
+async def coalesce(stream: AsyncIterator[str], interval: float, max_chars: int) -> AsyncIterator[str]:
+    """
+    Merges chunks that arrive within `interval` seconds of the first pending one, or until `max_chars` characters
+    are pending, so a client receives a few larger events instead of one per token.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = stream.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    buffer = []
+    size = 0
+    deadline = 0.0
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                finished, pending = pending, None
+                try:
+                    chunk = finished.result()
+                except StopAsyncIteration:
+                    break
+                if not buffer:
+                    deadline = loop.time() + interval
+                buffer.append(chunk)
+                size += len(chunk)
+                if size < max_chars:
+                    continue
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        if hasattr(stream, "aclose"):
+            await stream.aclose()
+
+
+def event(data, name: Optional[str] = None) -> str:
+    """Formats one server-sent event; `data` that isn't a string is sent as JSON."""
+    lines = [f"event: {name}"] if name else []
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+    lines.extend(f"data: {line}" for line in payload.split("\n"))
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,209 @@
+"""
+Lightweight tracing of Slack events: one trace per event, with a span for each step of its answer.
+
+The current span lives in a context variable, so code called while answering (history, downloads, Slack calls) adds
+its spans without being handed anything, and tasks started from it inherit it. Outside a trace, `span` does nothing.
+A trace is written out once all of its spans have ended: as one compact JSON log line, and to the exporters
+registered in `exporters` (e.g. OTLP). Traces are kept with probability `trace_sample_rate`, or always when a span
+failed. Payloads (question, answer) are cut to `trace_payload_chars`, so a long answer costs the same as a short one.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+from app.config.constants import trace_sample_rate, trace_payload_chars
+from app.utils.metrics import Counter
+
+TRACES = Counter("traces_total", "Finished traces, by whether they were sampled", ("sampled",))
+
+# Bounds what a single trace can hold, e.g. a long answer with many chat.update calls.
+MAX_SPANS = 256
+MAX_ATTRIBUTE_CHARS = 256
+
+# Called with every sampled trace.
+exporters: list[Callable[["Trace"], None]] = []
+
+
+def truncate(text: str, limit: int) -> str:
+    return text if len(text) <= limit else f"{text[:limit]}…(+{len(text) - limit})"
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.spans: list["Span"] = []  # Ended spans, in the order they ended.
+        self.dropped = 0
+        self.failed = False
+        self.finished = False
+        self._open = 0
+
+    def _start(self):
+        self._open += 1
+
+    def _end(self, span: "Span"):
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+        self.failed = self.failed or span.error is not None
+        self._open -= 1
+        if self._open == 0:
+            self._finish()
+
+    def _finish(self):
+        self.finished = True
+        sampled = self.failed or random.random() < trace_sample_rate
+        TRACES.inc(sampled=str(sampled).lower())
+        if not sampled:
+            return
+        self.spans.sort(key=lambda span: span.start_ns)
+        logging.info(f"trace {json.dumps(self.to_dict(), ensure_ascii=False, separators=(',', ':'))}")
+        for export in exporters:
+            try:
+                export(self)
+            except Exception as e:
+                logging.warning(f"Failed - exporting trace {self.trace_id}: {e!r}")
+
+    def to_dict(self) -> dict:
+        # Spans refer to their parent by position, which is enough to rebuild the tree and much shorter than an id.
+        started = self.spans[0].start_ns if self.spans else 0
+        positions = {span.span_id: index for index, span in enumerate(self.spans)}
+        spans = []
+        for span in self.spans:
+            record = {
+                "name": span.name,
+                "start": round((span.start_ns - started) / 1e6, 1),
+                "ms": round(span.duration_ns / 1e6, 1),
+            }
+            if span.parent_id in positions:
+                record["parent"] = positions[span.parent_id]
+            if span.attributes:
+                record["attrs"] = span.attributes
+            if span.error is not None:
+                record["error"] = span.error
+            spans.append(record)
+        result = {"trace_id": self.trace_id, "spans": spans}
+        if self.dropped:
+            result["dropped"] = self.dropped
+        return result
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attributes: dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self.start_ns = time.time_ns()
+        self.duration_ns = 0
+        self._started = time.perf_counter_ns()
+        self._ended = False
+        self.set(**attributes)
+        trace._start()
+
+    @property
+    def end_ns(self) -> int:
+        return self.start_ns + self.duration_ns
+
+    def set(self, **attributes):
+        for name, value in attributes.items():
+            if value is None:
+                continue
+            if not isinstance(value, (bool, int, float)):
+                value = truncate(str(value), MAX_ATTRIBUTE_CHARS)
+            self.attributes[name] = value
+
+    def set_payload(self, **payloads):
+        """Records the length of each text and, unless `trace_payload_chars` is 0, its beginning."""
+        for name, text in payloads.items():
+            text = text or ""
+            self.attributes[f"{name}_chars"] = len(text)
+            if trace_payload_chars > 0:
+                self.attributes[name] = truncate(text, trace_payload_chars)
+
+    def fail(self, error: BaseException):
+        self.error = truncate(f"{type(error).__name__}: {error}", MAX_ATTRIBUTE_CHARS)
+
+    def end(self):
+        if self._ended:
+            return
+        self._ended = True
+        self.duration_ns = time.perf_counter_ns() - self._started
+        self.trace._end(self)
+
+
+class _NoopSpan:
+    """Stands in for a span outside of any trace, so callers never have to check."""
+
+    trace = None
+
+    def set(self, **attributes):
+        pass
+
+    def set_payload(self, **payloads):
+        pass
+
+    def fail(self, error: BaseException):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP = _NoopSpan()
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+def current_span():
+    return _current.get() or NOOP
+
+
+def start_span(name: str, parent=None, **attributes):
+    """Starts a span that the caller ends, for steps that don't fit in a `with` block (e.g. waiting in a queue)."""
+    parent = parent or current_span()
+    # Tasks started from a trace (e.g. a "busy" reply) inherit its context and may outlive it. A trace is written
+    # out exactly once, so what they do after it finished is not traced.
+    if parent.trace is None or parent.trace.finished:
+        return NOOP
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+@contextmanager
+def span(name: str, parent=None, **attributes):
+    """A child of `parent` (by default the current span) that is the current span until the block exits."""
+    with _activate(start_span(name, parent, **attributes)) as current:
+        yield current
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """Starts a new trace whose root span lasts for the block."""
+    with _activate(Span(Trace(), name, None, attributes)) as current:
+        yield current
+
+
+@contextmanager
+def _activate(current):
+    if current is NOOP:
+        yield current
+        return
+    token = _current.set(current)
+    try:
+        yield current
+    except asyncio.CancelledError:
+        current.set(cancelled=True)
+        raise
+    except Exception as e:
+        current.fail(e)
+        raise
+    finally:
+        _current.reset(token)
+        current.end()
@@ -0,0 +1,89 @@
+"""
+Measures how concurrent Slack answers share the event loop.
+
+Slack and the LLM are replaced by fakes that only sleep, so the numbers show how `message_process`
+schedules I/O: with a non-blocking Slack path, N streams finish in roughly the time of one.
+
+    python -m benchmarks.concurrent_streams --streams 20 --chunks 50
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("slack_token", "xoxb-benchmark")
+os.environ.setdefault("openai_token", "sk-benchmark")
+os.environ.setdefault("google_cloud_project_name", "benchmark")
+
+from app.config.constants import LLMModel  # noqa: E402
+from app.services import openai_chat, slack  # noqa: E402
+
+
+class FakeSlackClient:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def _call(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return {"ok": True, "ts": f"{time.time():.6f}"}
+
+    async def chat_postMessage(self, **kwargs):
+        return await self._call(**kwargs)
+
+    async def chat_update(self, **kwargs):
+        return await self._call(**kwargs)
+
+
+async def fake_build_message(slack_client, channel, thread_ts):
+    return [{"role": "user", "content": [{"type": "text", "text": "hello"}]}]
+
+
+def fake_provider(chunks: int, interval: float):
+    async def get_chatgpt(messages, **kwargs):
+        for _ in range(chunks):
+            await asyncio.sleep(interval)
+            yield "0123456789"
+
+    return get_chatgpt
+
+
+def slack_event(index: int) -> dict:
+    return {
+        "api_app_id": "A0BENCH",
+        "event": {"channel": f"C{index}", "ts": f"{index}.000001", "user": "U0BENCH", "text": "<@U0BOT> hello"},
+    }
+
+
+async def run(streams: int, chunks: int, interval: float, latency: float):
+    fake_client = FakeSlackClient(latency)
+    slack.get_slack_client = lambda: fake_client
+    openai_chat.build_chatgpt_message = fake_build_message
+    openai_chat.get_chatgpt = fake_provider(chunks, interval)
+
+    started = time.perf_counter()
+    await slack.message_process(slack_event(0), LLMModel.GPT)
+    single = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await asyncio.gather(*(slack.message_process(slack_event(i), LLMModel.GPT) for i in range(streams)))
+    concurrent = time.perf_counter() - started
+
+    print(f"single stream       : {single:.3f}s")
+    print(f"{streams} concurrent streams: {concurrent:.3f}s ({concurrent / single:.2f}x single, serial would be {streams}x)")
+    print(f"slack calls         : {fake_client.calls} ({fake_client.calls / (streams + 1):.1f} per answer)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=20)
+    parser.add_argument("--chunks", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between LLM chunks")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per Slack API call")
+    args = parser.parse_args()
+    asyncio.run(run(args.streams, args.chunks, args.interval, args.latency))
+
+
+if __name__ == "__main__":
+    main()
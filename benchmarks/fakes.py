@@ -0,0 +1,217 @@
+"""
+Local stand-ins for the Slack Web API, an OpenTelemetry collector and the LLM providers, so benchmarks run offline.
+The Redis stand-in lives in tests.fake_redis, which the tests share.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+
+class FakeSlack:
+    """
+    An in-process Slack Web API: threads live in memory, chat.* calls append to or edit them, and
+    conversations.replies reads them back. Every call is delayed by `latency` seconds and recorded. `first_answer`
+    keeps when each thread first showed text of the fake providers' answers (see `ANSWER_TEXT`), so "queued" and
+    other status messages don't count as answers.
+
+    It also stands in for Socket Mode: apps.connections.open hands out its /socket websocket, and `push_event`
+    sends an events_api envelope over one of the open connections and waits for the app to acknowledge it.
+    """
+
+    def __init__(self, latency: float = 0.05, files: dict = None):
+        self.latency = latency
+        self.files = files or {}
+        self.uploads: dict[str, bytes] = {}
+        self.threads: dict[tuple, list] = defaultdict(list)
+        self.calls: dict[str, int] = defaultdict(int)
+        self.first_answer: dict[tuple, float] = {}
+        self.url = ""
+        self.sockets: list[web.WebSocketResponse] = []
+        self._ts = itertools.count(1)
+        self._envelopes = itertools.count(1)
+        self._acks: dict[str, asyncio.Future] = {}
+        self._runner = None
+
+    def next_ts(self) -> str:
+        return f"{time.time():.0f}.{next(self._ts):06d}"
+
+    def add_user_message(self, channel: str, thread_ts: str, ts: str, text: str, files: list = None):
+        message = {"ts": ts, "user": "U0BENCH", "text": text}
+        if files:
+            message["files"] = files
+        self.threads[(channel, thread_ts)].append(message)
+
+    async def start(self, port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_route("*", "/api/{method}", self._api)
+        app.router.add_get("/files/{name}", self._file)
+        app.router.add_post("/upload/{file_id}", self._upload)
+        app.router.add_get("/socket", self._socket)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self):
+        for socket in list(self.sockets):
+            await socket.close()
+        await self._runner.cleanup()
+
+    async def push_event(self, payload: dict) -> float:
+        """Delivers an Events API payload over Socket Mode and returns the seconds until it was acknowledged."""
+        number = next(self._envelopes)
+        envelope_id = f"envelope-{number}"
+        self._acks[envelope_id] = asyncio.get_running_loop().create_future()
+        envelope = {
+            "envelope_id": envelope_id,
+            "type": "events_api",
+            "accepts_response_payload": False,
+            "retry_attempt": 0,
+            "retry_reason": "",
+            "payload": payload,
+        }
+        started = time.perf_counter()
+        await self.sockets[number % len(self.sockets)].send_str(json.dumps(envelope))
+        await self._acks[envelope_id]
+        return time.perf_counter() - started
+
+    async def refresh_sockets(self):
+        """Asks every connection to reconnect, like Slack does a few times an hour."""
+        for socket in list(self.sockets):
+            await socket.send_str(json.dumps({"type": "disconnect", "reason": "refresh_requested"}))
+
+    async def _file(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.files[request.match_info["name"]])
+
+    async def _upload(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        self.uploads[request.match_info["file_id"]] = await request.read()
+        return web.Response(text="OK")
+
+    async def _socket(self, request: web.Request) -> web.WebSocketResponse:
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        self.sockets.append(socket)
+        await socket.send_str(json.dumps({"type": "hello", "num_connections": len(self.sockets)}))
+        try:
+            async for message in socket:
+                envelope_id = json.loads(message.data).get("envelope_id")
+                if (ack := self._acks.pop(envelope_id, None)) is not None:
+                    ack.set_result(None)
+        finally:
+            self.sockets.remove(socket)
+        return socket
+
+    async def _api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls[method] + 1
+        params = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        else:
+            params.update(await request.post())
+        await asyncio.sleep(self.latency)
+
+        channel = params.get("channel")
+        if method == "apps.connections.open":
+            return web.json_response({"ok": True, "url": self.url.replace("http", "ws", 1) + "/socket"})
+        if method == "files.getUploadURLExternal":
+            file_id = f"F{next(self._ts):08d}"
+            return web.json_response({"ok": True, "upload_url": f"{self.url}/upload/{file_id}", "file_id": file_id})
+        if method == "files.completeUploadExternal":
+            files = [{"id": file["id"], "title": file.get("title")} for file in json.loads(params["files"])]
+            message = {"ts": self.next_ts(), "bot_id": "B0BENCH", "text": "", "files": files}
+            self.threads[(params.get("channel_id"), params.get("thread_ts"))].append(message)
+            return web.json_response({"ok": True, "files": files})
+        if method == "conversations.replies":
+            return web.json_response({"ok": True, "messages": self.threads.get((channel, params.get("ts")), [])})
+        if method == "chat.postMessage":
+            ts = self.next_ts()
+            key = (channel, params.get("thread_ts"))
+            self._record_answer(key, params.get("text"))
+            self.threads[key].append({"ts": ts, "app_id": "A0BENCH", "bot_id": "B0BENCH", "text": params.get("text")})
+            return web.json_response({"ok": True, "channel": channel, "ts": ts})
+        if method == "chat.update":
+            for key, messages in self.threads.items():
+                for message in messages:
+                    if message["ts"] == params.get("ts"):
+                        message["text"] = params.get("text")
+                        self._record_answer(key, params.get("text"))
+            return web.json_response({"ok": True, "channel": channel, "ts": params.get("ts")})
+        if method == "chat.delete":
+            for messages in self.threads.values():
+                messages[:] = [message for message in messages if message["ts"] != params.get("ts")]
+            return web.json_response({"ok": True})
+        return web.json_response({"ok": False, "error": "unknown_method"})
+
+    def _record_answer(self, key: tuple, text: str):
+        if text and ANSWER_TEXT in text:
+            self.first_answer.setdefault(key, time.perf_counter())
+
+
+class FakeCollector:
+    """An OTLP/HTTP collector that accepts JSON-encoded traces on /v1/traces and counts the spans it receives."""
+
+    def __init__(self):
+        self.spans: dict[str, int] = defaultdict(int)  # span name -> count
+        self.traces: set[str] = set()
+        self.requests = 0
+        self.url = ""
+        self._runner = None
+
+    async def start(self, port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/traces", self._traces)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self.url
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def _traces(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        for resource_spans in body["resourceSpans"]:
+            for scope_spans in resource_spans["scopeSpans"]:
+                for span in scope_spans["spans"]:
+                    self.spans[span["name"]] += 1
+                    self.traces.add(span["traceId"])
+        return web.json_response({})
+
+
+# Every fake answer starts with ANSWER_TEXT and ends with ANSWER_END, unlike the app's own status messages.
+ANSWER_TEXT = "Lorem"
+ANSWER_END = "(end)"
+
+# Rough chunk timing of each provider's streaming API: (time to first token, seconds between chunks, chunk text).
+PROFILES = {
+    "gpt": (0.4, 0.02, "Lorem "),
+    "gemini": (0.8, 0.15, "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor. " * 2),
+    "claude": (0.6, 0.03, "Lorem ipsum "),
+}
+
+
+def fake_stream(profile: str, answer_chars: int):
+    ttft, interval, chunk = PROFILES[profile]
+
+    async def stream(*args, **kwargs):
+        await asyncio.sleep(ttft)
+        sent = 0
+        while sent < answer_chars:
+            yield chunk
+            sent += len(chunk)
+            await asyncio.sleep(interval)
+        yield ANSWER_END
+
+    return stream
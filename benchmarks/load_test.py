@@ -0,0 +1,196 @@
+"""
+End-to-end load test of the Slack path.
+
+Drives the real FastAPI app through /slack/{gpt,gemini,claude,random} against an in-process fake Slack Web API
+and fake streaming providers, so it runs offline (e.g. in CI). Reports webhook latency, time until the answer
+starts showing in Slack, Slack API calls per answer and memory per in-flight conversation. With --socket-mode,
+events are delivered over the fake Slack's Socket Mode websockets instead, and the latency is until the ack. With
+--shared-state, dedup keys, thread locks and caches go to a local Redis stand-in, as they do with several workers.
+With --otlp, sampled traces are exported to a local collector stand-in, which reports what it received.
+
+    python -m benchmarks.load_test --requests 200 --concurrency 50 --route random
+    python -m benchmarks.load_test --requests 200 --socket-mode --socket-connections 4
+    python -m benchmarks.load_test --requests 200 --shared-state
+    python -m benchmarks.load_test --requests 200 --otlp
+"""
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+import statistics
+import time
+import tracemalloc
+
+from benchmarks.fakes import ANSWER_END, FakeCollector, FakeSlack, fake_stream
+from tests.fake_redis import FakeRedis
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def slack_event(index: int, channel: str, ts: str) -> dict:
+    return {
+        "token": "benchmark",
+        "api_app_id": "A0BENCH",
+        "event_id": f"Ev{index:08d}",
+        "event": {
+            "type": "app_mention",
+            "client_msg_id": f"benchmark-{index}",
+            "channel": channel,
+            "channel_type": "channel",
+            "user": "U0BENCH",
+            "ts": ts,
+            "text": "<@U0BOT> Summarize the history of the printing press in a few paragraphs.",
+        },
+    }
+
+
+def install_fake_providers(answer_chars: int):
+    # Keep the real builders (history, attachments, context window) and only replace the network calls.
+    importlib.import_module("app.services.openai_chat").get_chatgpt = fake_stream("gpt", answer_chars)
+    importlib.import_module("app.services.google_gemini").get_gemini = fake_stream("gemini", answer_chars)
+    importlib.import_module("app.services.anthropic_claude").get_claude = fake_stream("claude", answer_chars)
+
+
+def _answered(messages: list) -> bool:
+    # Only a finished answer ends with the last chunk of the fake provider's text, even when it spans several messages.
+    replies = [message.get("text") or "" for message in messages if message.get("bot_id")]
+    return bool(replies) and replies[-1].rstrip().endswith(ANSWER_END)
+
+
+async def run(args):
+    fake_slack = FakeSlack(latency=args.slack_latency)
+    url = await fake_slack.start()
+    fake_redis = FakeRedis() if args.shared_state else None
+    state_url = await fake_redis.start() if fake_redis else ""
+    collector = FakeCollector() if args.otlp else None
+    otlp_endpoint = await collector.start() if collector else ""
+    os.environ.update(
+        {
+            "slack_token": "xoxb-benchmark",
+            "openai_token": "sk-benchmark",
+            "google_cloud_project_name": "benchmark",
+            "slack_api_url": f"{url}/api/",
+            "gpt_concurrency": str(args.workers),
+            "gemini_concurrency": str(args.workers),
+            "claude_concurrency": str(args.workers),
+            "max_queue_depth": str(args.requests),
+            "shutdown_grace_seconds": str(args.grace_seconds),
+            "slack_app_tokens": f"{args.route}=xapp-benchmark" if args.socket_mode else "",
+            "slack_socket_connections": str(args.socket_connections),
+            "state_url": state_url,
+            "otlp_endpoint": otlp_endpoint,
+        }
+    )
+
+    import httpx
+    from app.main import app
+    from app.routers.slack_socket import socket_mode
+    from app.services.scheduler import scheduler
+    from app.services.state import close_state
+    from app.services.trace_export import close_trace_export
+    from app.utils.http import close_http_session
+
+    install_fake_providers(args.answer_chars)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    sent_at = {}
+    webhook_latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def send(client, index: int):
+        channel = f"C{index % args.channels:04d}"
+        ts = fake_slack.next_ts()
+        fake_slack.add_user_message(channel, ts, ts, "<@U0BOT> question")
+        async with semaphore:
+            started = time.perf_counter()
+            sent_at[(channel, ts)] = started
+            if args.socket_mode:
+                webhook_latencies.append(await fake_slack.push_event(slack_event(index, channel, ts)))
+                return
+            response = await client.post(f"/slack/{args.route}", json=slack_event(index, channel, ts))
+            webhook_latencies.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    if args.socket_mode:
+        await socket_mode.start()
+        while len(fake_slack.sockets) < args.socket_connections:
+            await asyncio.sleep(0.01)
+    transport = httpx.ASGITransport(app=app)
+    started = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        await asyncio.gather(*(send(client, index) for index in range(args.requests)))
+    await socket_mode.stop()
+    await scheduler.shutdown()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await close_trace_export()
+    await close_http_session()
+    await close_state()
+    await fake_slack.stop()
+    if fake_redis:
+        await fake_redis.stop()
+    if collector:
+        await collector.stop()
+
+    first_answers = [
+        fake_slack.first_answer[key] - sent for key, sent in sent_at.items() if key in fake_slack.first_answer
+    ]
+    answers = sum(1 for key in sent_at if _answered(fake_slack.threads[key]))
+    in_flight = min(args.requests, args.workers * (3 if args.route == "random" else 1))
+    slack_calls = sum(fake_slack.calls.values())
+    if args.socket_mode:
+        target, latency = f"{args.route} over {args.socket_connections} Socket Mode connections", "ack latency"
+    else:
+        target, latency = f"/slack/{args.route}", "webhook latency"
+    print(f"requests                 : {args.requests} to {target} in {elapsed:.2f}s")
+    print(
+        f"{latency:<25}: p50 {percentile(webhook_latencies, 50) * 1000:.1f}ms"
+        f"  p99 {percentile(webhook_latencies, 99) * 1000:.1f}ms"
+    )
+    print(
+        f"time to first answer text: p50 {percentile(first_answers, 50):.2f}s"
+        f"  p99 {percentile(first_answers, 99):.2f}s"
+        f"  mean {statistics.fmean(first_answers) if first_answers else 0:.2f}s"
+    )
+    print(f"answers posted           : {answers} of {args.requests}")
+    print(f"Slack calls per answer   : {slack_calls / max(1, answers):.1f} {dict(fake_slack.calls)}")
+    if fake_redis:
+        print(f"state commands per answer: {sum(fake_redis.commands.values()) / max(1, answers):.1f}"
+              f" {dict(fake_redis.commands)}")
+    if collector:
+        spans = sum(collector.spans.values())
+        print(f"traces exported          : {len(collector.traces)} in {collector.requests} requests,"
+              f" {spans / max(1, len(collector.traces)):.1f} spans per trace {dict(collector.spans)}")
+    print(f"memory per conversation  : {(peak - baseline) / in_flight / 1024:.1f} KiB (peak over {in_flight} in flight)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20, help="webhooks in flight at once")
+    parser.add_argument("--route", choices=("gpt", "gemini", "claude", "random"), default="random")
+    parser.add_argument("--workers", type=int, default=8, help="scheduler workers per model")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--answer-chars", type=int, default=1500)
+    parser.add_argument("--slack-latency", type=float, default=0.05, help="seconds per fake Slack API call")
+    parser.add_argument("--socket-mode", action="store_true", help="deliver events over Socket Mode")
+    parser.add_argument("--socket-connections", type=int, default=2)
+    parser.add_argument("--shared-state", action="store_true", help="keep the shared state in a Redis stand-in")
+    parser.add_argument("--otlp", action="store_true", help="export traces to a local collector stand-in")
+    parser.add_argument(
+        "--grace-seconds", type=float, default=600, help="how long answers may take to finish after the last request"
+    )
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
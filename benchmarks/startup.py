@@ -0,0 +1,70 @@
+"""
+Measures the cold-start cost of the app: time and peak RSS of a fresh interpreter importing `app.main`, and its
+peak RSS once the lifespan has started up (preloading providers, if `preload_providers` is set) and shut down again,
+which is what an idle worker settles at.
+
+Each sample runs in a new process so nothing is cached between runs. Pass --max-seconds / --max-rss-mb to fail
+(exit code 1) when startup regresses past a budget, e.g. in CI.
+
+    python -m benchmarks.startup --runs 5 --max-seconds 2
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import asyncio, json, resource, sys, time
+started = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - started
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+async def serve():
+    async with app.main.app.router.lifespan_context(app.main.app):
+        pass
+
+asyncio.run(serve())
+serving_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+heavy = [name for name in ("vertexai", "anthropic", "google.cloud.aiplatform") if name in sys.modules]
+result = {"seconds": elapsed, "rss_mb": rss_kb / 1024, "serving_rss_mb": serving_kb / 1024, "heavy_modules": heavy}
+print(json.dumps(result))
+"""
+
+
+def sample(env: dict) -> dict:
+    output = subprocess.run([sys.executable, "-c", PROBE], env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, help="fail when the median import time exceeds this")
+    parser.add_argument("--max-rss-mb", type=float, help="fail when the median peak RSS of a worker exceeds this")
+    args = parser.parse_args()
+
+    env = {
+        "slack_token": "xoxb-benchmark",
+        "openai_token": "sk-benchmark",
+        "google_cloud_project_name": "benchmark",
+        **os.environ,
+    }
+    samples = [sample(env) for _ in range(args.runs)]
+    seconds = statistics.median(item["seconds"] for item in samples)
+    rss_mb = statistics.median(item["rss_mb"] for item in samples)
+    serving_rss_mb = statistics.median(item["serving_rss_mb"] for item in samples)
+    print(f"import app.main : median {seconds:.3f}s over {args.runs} runs")
+    print(f"peak RSS        : median {rss_mb:.1f} MB after import, {serving_rss_mb:.1f} MB after the lifespan")
+    print(f"heavy modules   : {', '.join(samples[0]['heavy_modules']) or 'none'} after the lifespan")
+
+    failed = (args.max_seconds is not None and seconds > args.max_seconds) or (
+        args.max_rss_mb is not None and serving_rss_mb > args.max_rss_mb
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
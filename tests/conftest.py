@@ -0,0 +1,6 @@
+import os
+
+# The app reads its settings from the environment when it is imported.
+os.environ.setdefault("slack_token", "xoxb-test")
+os.environ.setdefault("openai_token", "sk-test")
+os.environ.setdefault("google_cloud_project_name", "test")
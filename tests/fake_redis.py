@@ -0,0 +1,124 @@
+"""A Redis server stand-in for the shared state, used by the tests and by the load test's --shared-state."""
+import asyncio
+import time
+from collections import defaultdict
+
+
+class FakeRedis:
+    """
+    A Redis stand-in that speaks just enough of the protocol for the shared state: PING, GET, SET (with NX, EX and PX),
+    DEL, EVAL of the compare-and-delete script and WATCH/MULTI/EXEC transactions. Keys expire like they do in Redis,
+    and every command is counted.
+    """
+
+    def __init__(self):
+        self.data: dict[str, tuple[str, float]] = {}  # key -> (value, expires at)
+        self.versions: dict[str, int] = defaultdict(int)  # key -> writes so far, for WATCH
+        self.commands: dict[str, int] = defaultdict(int)
+        self.url = ""
+        self._server = None
+
+    async def start(self, port: int = 0) -> str:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", port)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"redis://127.0.0.1:{port}/0"
+        return self.url
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        watched: dict[str, int] = {}  # key -> version when it was watched
+        queued = None  # Commands of an open MULTI.
+        try:
+            while (command := await self._read_command(reader)) is not None:
+                name = command[0].upper()
+                if name in ("WATCH", "UNWATCH", "MULTI", "DISCARD", "EXEC"):
+                    self.commands[name] += 1
+                if name == "WATCH":
+                    watched.update({key: self.versions[key] for key in command[1:]})
+                    reply = b"+OK\r\n"
+                elif name == "UNWATCH":
+                    watched.clear()
+                    reply = b"+OK\r\n"
+                elif name == "MULTI":
+                    queued = []
+                    reply = b"+OK\r\n"
+                elif name == "DISCARD":
+                    queued = None
+                    watched.clear()
+                    reply = b"+OK\r\n"
+                elif name == "EXEC":
+                    if any(self.versions[key] != version for key, version in watched.items()):
+                        reply = b"*-1\r\n"
+                    else:
+                        reply = f"*{len(queued)}\r\n".encode() + b"".join(self._execute(args) for args in queued)
+                    queued = None
+                    watched.clear()
+                elif queued is not None:
+                    queued.append(command)
+                    reply = b"+QUEUED\r\n"
+                else:
+                    reply = self._execute(command)
+                writer.write(reply)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader):
+        if not (line := await reader.readline()):
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(length + 2))[:-2].decode())
+        return args
+
+    def _get(self, key: str):
+        value, expires_at = self.data.get(key, (None, 0.0))
+        if value is not None and expires_at < time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def _execute(self, args: list) -> bytes:
+        name = args[0].upper()
+        self.commands[name] += 1
+        if name == "PING":
+            return b"+PONG\r\n"
+        if name in ("CLIENT", "SELECT"):
+            return b"+OK\r\n"
+        if name == "GET":
+            value = self._get(args[1])
+            return b"$-1\r\n" if value is None else f"${len(value.encode())}\r\n{value}\r\n".encode()
+        if name == "SET":
+            key, value, options = args[1], args[2], [option.upper() for option in args[3:]]
+            expires_at = float("inf")
+            if "EX" in options:
+                expires_at = time.monotonic() + float(options[options.index("EX") + 1])
+            if "PX" in options:
+                expires_at = time.monotonic() + float(options[options.index("PX") + 1]) / 1000
+            if "NX" in options and self._get(key) is not None:
+                return b"$-1\r\n"
+            self.data[key] = (value, expires_at)
+            self.versions[key] += 1
+            return b"+OK\r\n"
+        if name == "DEL":
+            deleted = [key for key in args[1:] if self._get(key) is not None]
+            for key in deleted:
+                del self.data[key]
+                self.versions[key] += 1
+            return f":{len(deleted)}\r\n".encode()
+        if name == "EVAL":
+            # Only the compare-and-delete script of app.services.state: KEYS[1] is deleted if it holds ARGV[1].
+            key, value = args[3], args[4]
+            if self._get(key) != value:
+                return b":0\r\n"
+            del self.data[key]
+            self.versions[key] += 1
+            return b":1\r\n"
+        return f"-ERR unknown command '{args[0]}'\r\n".encode()
@@ -0,0 +1,37 @@
+"""A Slack Web API client stand-in for the tests of the answer path."""
+import asyncio
+import itertools
+
+
+class SlowSlack:
+    """Keeps the messages of every thread and answers every call after `latency` seconds, like a slow Slack."""
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.messages: dict[str, str] = {}  # ts -> text, in the order they were posted
+        self.threads: dict[str, str] = {}  # ts -> thread_ts
+        self.posts = 0
+        self.deleted: list[str] = []
+        self._ts = itertools.count(1)
+
+    def thread(self, thread_ts: str) -> list[str]:
+        """The texts of the messages still in `thread_ts`."""
+        return [text for ts, text in self.messages.items() if self.threads[ts] == thread_ts]
+
+    async def chat_postMessage(self, channel: str, text: str, thread_ts: str, attachments: list):
+        await asyncio.sleep(self.latency)
+        self.posts += 1
+        ts = f"{next(self._ts)}.000000"
+        self.messages[ts] = text
+        self.threads[ts] = thread_ts
+        return {"ts": ts}
+
+    async def chat_update(self, channel: str, text: str, ts: str, as_user: bool):
+        await asyncio.sleep(self.latency)
+        self.messages[ts] = text
+        return {"ts": ts}
+
+    async def chat_delete(self, channel: str, ts: str):
+        await asyncio.sleep(self.latency)
+        del self.messages[ts]
+        self.deleted.append(ts)
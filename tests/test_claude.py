@@ -0,0 +1,36 @@
+from app.services.anthropic_claude import CACHE_BREAKPOINTS, mark_cache_breakpoints
+
+
+def cached(messages: list) -> list:
+    return [
+        index
+        for index, message in enumerate(messages)
+        if isinstance(message["content"], list) and "cache_control" in message["content"][-1]
+    ]
+
+
+def test_the_last_user_turns_are_marked():
+    messages = [
+        {"role": "user", "content": "first"},
+        {"role": "assistant", "content": "answer"},
+        {"role": "user", "content": "second"},
+        {"role": "assistant", "content": "answer"},
+        {"role": "user", "content": "third"},
+    ]
+
+    mark_cache_breakpoints(messages)
+
+    assert cached(messages) == [2, 4] and CACHE_BREAKPOINTS == 2
+    assert messages[4]["content"] == [{"type": "text", "text": "third", "cache_control": {"type": "ephemeral"}}]
+    assert messages[0]["content"] == "first"
+    assert all(isinstance(message["content"], str) for message in messages if message["role"] == "assistant")
+
+
+def test_a_turn_with_images_marks_its_last_block():
+    image = {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": "AAAA"}}
+    messages = [{"role": "user", "content": [image, {"type": "text", "text": "what is this?"}]}]
+
+    mark_cache_breakpoints(messages)
+
+    assert "cache_control" not in messages[0]["content"][0]
+    assert messages[0]["content"][1]["cache_control"] == {"type": "ephemeral"}
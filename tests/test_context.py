@@ -0,0 +1,61 @@
+import pytest
+
+from app.config.constants import LLMModel
+from app.services import context
+from app.services.context import estimate_image_tokens, message_tokens, select_history
+
+
+@pytest.fixture(autouse=True)
+def window(monkeypatch):
+    monkeypatch.setattr(context, "number_of_messages_to_keep", 20)
+    monkeypatch.setattr(context, "_token_counts", context.LRUCache(maxsize=100))
+
+
+def messages(count: int, chars: int = 400) -> list:
+    # 400 ASCII characters are 100 tokens, plus the per-message overhead.
+    return [{"ts": f"{index}.0", "user": "U1", "text": "a" * chars} for index in range(count)]
+
+
+@pytest.mark.parametrize(
+    "width, height, llm_model, tokens",
+    [
+        (1024, 1024, LLMModel.GPT, 765),  # Scaled to 768x768: 2x2 tiles.
+        (2048, 4096, LLMModel.GPT, 1105),  # Scaled to 768x1536: 2x3 tiles.
+        (None, None, LLMModel.GPT, 765),
+        (1000, 1000, LLMModel.CLAUDE, 1334),
+        (3136, 3136, LLMModel.CLAUDE, 3279),  # Scaled to 1568x1568.
+        (None, None, LLMModel.CLAUDE, 1600),
+        (4096, 4096, LLMModel.GEMINI, 258),
+    ],
+)
+def test_image_tokens_follow_each_providers_cost(width, height, llm_model, tokens):
+    assert estimate_image_tokens({"original_w": width, "original_h": height}, llm_model) == tokens
+
+
+def test_images_count_only_for_models_that_see_them(monkeypatch):
+    message = {"ts": "1.0", "text": "", "files": [{"size": 1000, "original_w": 1000, "original_h": 1000}]}
+    monkeypatch.setattr(context, "gpt_model", "gpt-3.5-turbo")
+
+    assert message_tokens(message, LLMModel.GPT) == context.MESSAGE_OVERHEAD
+    assert message_tokens(message, LLMModel.CLAUDE) == context.MESSAGE_OVERHEAD + 1334
+
+
+def test_history_is_trimmed_to_the_token_budget(monkeypatch):
+    monkeypatch.setitem(context.TOKEN_BUDGETS, LLMModel.GPT, 350)
+    thread = messages(5)
+
+    assert select_history(thread, LLMModel.GPT) == thread[-3:]
+
+
+def test_the_question_is_kept_even_over_the_budget(monkeypatch):
+    monkeypatch.setitem(context.TOKEN_BUDGETS, LLMModel.GPT, 10)
+    thread = messages(3)
+
+    assert select_history(thread, LLMModel.GPT) == thread[-1:]
+
+
+def test_history_is_capped_at_number_of_messages_to_keep(monkeypatch):
+    monkeypatch.setattr(context, "number_of_messages_to_keep", 2)
+    thread = messages(5)
+
+    assert select_history(thread, LLMModel.CLAUDE) == thread[-2:]
@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import pytest
+
+from app.routers import slack as slack_router
+from app.services.dedup import EventDeduplicator
+from app.services.state import InMemoryStateBackend
+
+
+def delivery(event_id: str, client_msg_id: str, app_id: str = "A0GPT") -> dict:
+    event = {"type": "app_mention", "client_msg_id": client_msg_id, "channel": "C1", "ts": "1.0", "text": "question"}
+    return {"api_app_id": app_id, "event_id": event_id, "event": event}
+
+
+@pytest.fixture
+def deduplicator(monkeypatch):
+    deduplicator = EventDeduplicator(InMemoryStateBackend(maxsize=100), ttl=60)
+    monkeypatch.setattr(slack_router, "deduplicator", deduplicator)
+    return deduplicator
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    messages = []
+    monkeypatch.setattr(
+        slack_router.scheduler, "submit", lambda message, llm_model, failover=False: messages.append(message)
+    )
+    return messages
+
+
+def dispatch(message: dict):
+    asyncio.run(slack_router.dispatch(message, slack_router.LLMModel.GPT))
+
+
+def test_a_retried_event_starts_one_generation(deduplicator, submitted):
+    dispatch(delivery("Ev1", "m1"))
+    dispatch(delivery("Ev1", "m1"))
+
+    assert len(submitted) == 1
+    assert deduplicator.suppressed == 1
+
+
+def test_the_same_message_under_another_event_id_starts_one_generation(deduplicator, submitted):
+    dispatch(delivery("Ev1", "m1"))
+    dispatch(delivery("Ev2", "m1"))
+
+    assert len(submitted) == 1
+
+
+def test_a_message_mentioning_two_bots_reaches_both(deduplicator, submitted):
+    dispatch(delivery("Ev1", "m1", app_id="A0GPT"))
+    dispatch(delivery("Ev2", "m1", app_id="A0CLAUDE"))
+
+    assert [message["api_app_id"] for message in submitted] == ["A0GPT", "A0CLAUDE"]
+
+
+def test_delivered_events_are_forgotten_after_the_ttl():
+    deduplicator = EventDeduplicator(InMemoryStateBackend(maxsize=100), ttl=0.05)
+
+    async def deliver_twice():
+        first = await deduplicator.is_duplicate(delivery("Ev1", "m1"))
+        second = await deduplicator.is_duplicate(delivery("Ev1", "m1"))
+        time.sleep(0.06)
+        return first, second, await deduplicator.is_duplicate(delivery("Ev1", "m1"))
+
+    assert asyncio.run(deliver_twice()) == (False, True, False)
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import pytest
+from vertexai.generative_models import Content, Part
+
+from app.services import context, google_gemini, slack_history
+from app.utils.cache import LRUCache
+
+APP_ID = "A0GEMINI"
+
+
+class Slack:
+    def __init__(self):
+        self.messages = []
+
+    async def conversations_replies(self, channel: str, ts: str):
+        return type("Response", (), {"data": {"messages": [dict(message) for message in self.messages]}})
+
+    def post(self, text: str, **fields):
+        self.messages.append({"ts": f"{len(self.messages) + 1}.0", "text": text, **fields})
+
+
+@pytest.fixture(autouse=True)
+def sessions(monkeypatch):
+    monkeypatch.setattr(google_gemini, "_sessions", LRUCache(maxsize=10, ttl=60))
+    monkeypatch.setattr(context, "number_of_messages_to_keep", 5)
+    return google_gemini._sessions
+
+
+def turn(slack: Slack, question: str) -> google_gemini.ThreadSession:
+    """Asks `question` in the thread and answers it the way a finished `get_gemini` does."""
+
+    async def ask():
+        slack.post(question, user="U1")
+        await slack_history.invalidate("CGEMINI", "1.0")
+        session, message = await google_gemini.build_gemini_message(slack, "CGEMINI", "1.0")
+        session.chat.history.extend([message, Content(role="model", parts=[Part.from_text(f"answer to {question}")])])
+        google_gemini._sessions.set(session.key, session)
+        slack.post(f"answer to {question}", app_id=APP_ID, bot_id="B1")
+        return session
+
+    return asyncio.run(ask())
+
+
+def sessions_by_result() -> dict:
+    return {labels[0]: value for labels, value in google_gemini.SESSIONS._values.items()}
+
+
+def test_long_threads_keep_their_session_as_it_slides():
+    slack = Slack()
+    first = turn(slack, "question 0")
+    before = sessions_by_result()
+
+    for index in range(1, 8):
+        session = turn(slack, f"question {index}")
+        assert session is first
+        # The window of 5 messages is applied at turn boundaries, so the session holds at most 2 whole turns.
+        assert len(session.messages) <= 5
+        assert len(session.chat.history) == len(session.sizes) + 1
+
+    after = sessions_by_result()
+    assert after.get("reused", 0) - before.get("reused", 0) == 7
+    assert after.get("rebuilt", 0) == before.get("rebuilt", 0)
+    assert session.messages[-1]["text"] == "question 7"
+
+
+def test_idle_sessions_expire(sessions):
+    slack = Slack()
+    first = turn(slack, "question 0")
+    sessions.ttl = 0.01
+    sessions.set(first.key, first)
+    time.sleep(0.02)
+
+    assert turn(slack, "question 1") is not first
@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+import pytest
+
+from app.config.constants import LLMModel
+from app.services import llm
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    """Fake providers: (seconds to build the request, seconds to the first chunk) by model."""
+    timings = {LLMModel.GPT: (0, 0.2), LLMModel.CLAUDE: (0.5, 0)}
+    built = []
+
+    async def open_stream(llm_model, slack_client, channel, thread_ts):
+        build, first_chunk = timings[llm_model]
+        built.append(llm_model)
+        await asyncio.sleep(build)
+
+        async def stream():
+            await asyncio.sleep(first_chunk)
+            yield f"{llm_model.value} answer"
+
+        return stream()
+
+    monkeypatch.setattr(llm, "open_stream", open_stream)
+    monkeypatch.setattr(llm, "enable_hedging", True)
+    monkeypatch.setattr(llm, "hedge_deadline_seconds", 0.05)
+    monkeypatch.setattr(llm.provider_router, "choose", lambda exclude=(): LLMModel.CLAUDE)
+    return built
+
+
+async def answer(failover: bool):
+    started = time.monotonic()
+    model, stream = await llm.start_stream(LLMModel.GPT, None, "C1", "1.0", failover=failover)
+    chunks = [chunk async for chunk in stream]
+    return model, chunks, time.monotonic() - started
+
+
+def test_a_slow_hedge_build_does_not_hold_up_the_first_provider(providers):
+    model, chunks, elapsed = asyncio.run(answer(failover=True))
+
+    assert providers == [LLMModel.GPT, LLMModel.CLAUDE]
+    assert (model, chunks) == (LLMModel.GPT, ["gpt answer"])
+    assert elapsed < 0.4
+
+
+def test_routes_for_one_provider_are_not_hedged(providers):
+    model, _, _ = asyncio.run(answer(failover=False))
+
+    assert providers == [LLMModel.GPT]
+    assert model == LLMModel.GPT
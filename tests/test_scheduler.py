@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+
+from app.config.constants import LLMModel
+from app.services import scheduler as scheduler_module, slack as slack_service, slack_rate_limit, slack_stream
+from app.services.generations import StopPolicy, generations
+from app.services.scheduler import BUSY_MESSAGE, QUEUED_MESSAGE, JobScheduler
+from app.services.slack import STOPPED_MESSAGE
+from tests.fake_slack import SlowSlack
+
+ANSWER = ["Lorem ", "ipsum ", "dolor ", "sit ", "amet."]
+
+
+@pytest.fixture
+def slack(monkeypatch):
+    slack = SlowSlack(latency=0.005)
+    monkeypatch.setattr(slack_rate_limit, "CHANNEL_LIMITS", {})
+    monkeypatch.setattr(slack_stream, "slack_update_interval", 0.01)
+    monkeypatch.setattr(slack_service, "get_slack_client", lambda: slack)
+    monkeypatch.setattr(scheduler_module, "get_slack_client", lambda: slack)
+    return slack
+
+
+@pytest.fixture
+def answered(monkeypatch):
+    """Replaces the LLM with one that streams `ANSWER` a chunk every `answered.delay` seconds."""
+    threads = []
+
+    async def start_stream(llm_model, slack_client, channel, thread_ts, failover=False):
+        threads.append(thread_ts)
+
+        async def stream():
+            for chunk in ANSWER:
+                await asyncio.sleep(answered.delay)
+                yield chunk
+
+        return llm_model, stream()
+
+    answered = type("Answered", (), {"threads": threads, "delay": 0.01})
+    monkeypatch.setattr(slack_service, "start_stream", start_stream)
+    return answered
+
+
+def message(ts: str, thread_ts: str = None, channel_type: str = "channel") -> dict:
+    event = {"type": "app_mention", "channel": "C1", "channel_type": channel_type, "user": "U1", "ts": ts, "text": "q"}
+    if thread_ts:
+        event["thread_ts"] = thread_ts
+    return {"api_app_id": "A0GPT", "event": event}
+
+
+def scheduler(max_depth: int = 10, placeholder_seconds: float = 10) -> JobScheduler:
+    # A single worker, so jobs queue up behind each other.
+    return JobScheduler({LLMModel.GPT: 1}, max_depth, placeholder_seconds, grace_seconds=10)
+
+
+def test_a_full_queue_rejects_with_a_busy_message(slack, answered):
+    async def run():
+        jobs = scheduler(max_depth=1)
+        submitted = [jobs.submit(message("1.0"), LLMModel.GPT)]
+        await asyncio.sleep(0.001)  # The worker takes the first job, which empties the queue.
+        submitted += [jobs.submit(message(ts), LLMModel.GPT) for ts in ("2.0", "3.0")]
+        await jobs.shutdown()
+        return submitted, jobs.rejected
+
+    assert asyncio.run(run()) == ([True, True, False], 1)
+    assert slack.thread("3.0") == [BUSY_MESSAGE]
+    assert answered.threads == ["1.0", "2.0"]
+
+
+def test_direct_messages_are_answered_first(slack, answered):
+    async def run():
+        jobs = scheduler()
+        jobs.submit(message("1.0"), LLMModel.GPT)
+        await asyncio.sleep(0.001)
+        jobs.submit(message("2.0"), LLMModel.GPT)
+        jobs.submit(message("3.0", channel_type="im"), LLMModel.GPT)
+        await jobs.shutdown()
+
+    asyncio.run(run())
+
+    assert answered.threads == ["1.0", "3.0", "2.0"]
+
+
+def test_a_waiting_job_streams_into_its_queued_placeholder(slack, answered):
+    async def run():
+        jobs = scheduler(placeholder_seconds=0.01)
+        jobs.submit(message("1.0"), LLMModel.GPT)
+        await asyncio.sleep(0.001)
+        jobs.submit(message("2.0"), LLMModel.GPT)
+        await asyncio.sleep(0.03)
+        placeholder = slack.thread("2.0")
+        await jobs.shutdown()
+        return placeholder
+
+    assert asyncio.run(run()) == [QUEUED_MESSAGE]
+    assert slack.thread("2.0") == ["".join(ANSWER)]
+    assert slack.deleted == []
+
+
+def test_a_job_superseded_while_queued_cleans_up_its_placeholder(slack, answered):
+    async def run():
+        jobs = scheduler(placeholder_seconds=0.01)
+        jobs.submit(message("1.0"), LLMModel.GPT)
+        await asyncio.sleep(0.001)
+        jobs.submit(message("2.1", thread_ts="2.0"), LLMModel.GPT)
+        await asyncio.sleep(0.03)  # Its "queued" message is posted.
+        jobs.submit(message("2.2", thread_ts="2.0"), LLMModel.GPT)
+        await jobs.shutdown()
+
+    asyncio.run(run())
+
+    assert answered.threads == ["1.0", "2.0"]
+    assert slack.thread("2.0") == ["".join(ANSWER)]
+    assert len(slack.deleted) == 1
+    assert len(generations) == 0
+
+
+def stop_answer_in_progress(answered):
+    answered.delay = 0.05
+
+    async def run():
+        jobs = scheduler()
+        jobs.submit(message("1.1", thread_ts="1.0"), LLMModel.GPT)
+        await asyncio.sleep(0.12)  # A couple of chunks are out.
+        jobs.submit(message("1.2", thread_ts="1.0"), LLMModel.GPT)
+        await jobs.shutdown()
+
+    asyncio.run(run())
+
+
+def test_truncate_leaves_the_stopped_answer_marked_as_cut_off(slack, answered, monkeypatch):
+    monkeypatch.setattr(generations, "policy", StopPolicy.TRUNCATE)
+
+    stop_answer_in_progress(answered)
+
+    stopped, answer = slack.thread("1.0")
+    assert stopped.startswith("Lorem ") and stopped.endswith(STOPPED_MESSAGE)
+    assert len(stopped) < len("".join(ANSWER) + STOPPED_MESSAGE)
+    assert answer == "".join(ANSWER)
+
+
+def test_cancel_deletes_the_stopped_answer(slack, answered, monkeypatch):
+    monkeypatch.setattr(generations, "policy", StopPolicy.CANCEL)
+
+    stop_answer_in_progress(answered)
+
+    assert slack.thread("1.0") == ["".join(ANSWER)]
+    assert len(slack.deleted) == 1
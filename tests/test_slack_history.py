@@ -0,0 +1,63 @@
+import asyncio
+
+from app.services import slack_history
+
+APP_ID = "A0APP"
+
+
+class Slack:
+    def __init__(self, messages: list):
+        self.messages = messages
+        self.replies = 0
+
+    async def conversations_replies(self, channel: str, ts: str):
+        self.replies += 1
+        return type("Response", (), {"data": {"messages": [dict(message) for message in self.messages]}})
+
+
+def message_event(ts: str, text: str, **fields) -> dict:
+    event = {"type": "message", "channel": "C1", "channel_type": "channel", "thread_ts": "1.0", "ts": ts, "text": text}
+    return {**event, **fields}
+
+
+def history(slack: Slack) -> list:
+    return asyncio.run(slack_history.get_thread_history(slack, "C1", "1.0"))
+
+
+def observe(event: dict) -> bool:
+    return asyncio.run(slack_history.observe_event(event, APP_ID))
+
+
+def test_plain_messages_in_a_cached_thread_are_recorded():
+    slack = Slack([{"ts": "1.0", "user": "U1", "text": "question"}])
+    history(slack)
+
+    assert observe(message_event("2.0", "a reply without a mention", user="U2"))
+
+    assert [message["text"] for message in history(slack)] == ["question", "a reply without a mention"]
+    assert slack.replies == 1
+    asyncio.run(slack_history.invalidate("C1", "1.0"))
+
+
+def test_edits_drop_the_thread_unless_the_app_made_them():
+    slack = Slack([{"ts": "1.0", "user": "U1", "text": "question"}])
+    history(slack)
+
+    own_edit = {"type": "message", "subtype": "message_changed", "channel": "C1",
+                "message": {"ts": "2.0", "thread_ts": "1.0", "app_id": APP_ID, "text": "streaming"}}
+    assert observe(own_edit)
+    assert slack.replies == 1 and history(slack)
+
+    user_edit = {"type": "message", "subtype": "message_changed", "channel": "C1",
+                 "message": {"ts": "1.0", "thread_ts": "1.0", "user": "U1", "text": "edited question"}}
+    assert observe(user_edit)
+    slack.messages[0]["text"] = "edited question"
+    assert history(slack)[0]["text"] == "edited question"
+    assert slack.replies == 2
+    asyncio.run(slack_history.invalidate("C1", "1.0"))
+
+
+def test_questions_are_left_to_answer():
+    assert not observe({**message_event("3.0", "<@U0BOT> question", user="U1"), "type": "app_mention"})
+    assert not observe({**message_event("3.0", "question", user="U1"), "channel_type": "im"})
+    assert observe(message_event("4.0", "answer", app_id=APP_ID, bot_id="B1"))
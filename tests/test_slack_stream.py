@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from app.services import slack_rate_limit, slack_stream
+from app.services.slack_stream import FENCE, SlackStreamPublisher
+from tests.fake_slack import SlowSlack
+
+
+@pytest.fixture(autouse=True)
+def fast_limits(monkeypatch):
+    # Only the publisher's own pacing is under test, not Slack's rate limits.
+    monkeypatch.setattr(slack_rate_limit, "CHANNEL_LIMITS", {})
+    monkeypatch.setattr(slack_stream, "slack_update_interval", 0.05)
+
+
+async def stream(publisher: SlackStreamPublisher, text: str):
+    # Slower than Slack answers, so words keep arriving while a full page is being continued in a new message.
+    for word in text.split(" "):
+        await publisher.append(word + " ")
+        await asyncio.sleep(0.001)
+    await publisher.close()
+
+
+def test_pages_match_slack_when_pages_roll_over_during_updates():
+    slack = SlowSlack()
+    answer = " ".join(f"word{index}" for index in range(2000))  # About 16k characters, 5 pages.
+    publisher = SlackStreamPublisher(slack, "C1", "1.000000")
+
+    asyncio.run(stream(publisher, answer))
+
+    pages = publisher.pages()
+    assert [ts for ts, _ in pages] == list(slack.messages)
+    assert [text for _, text in pages] == list(slack.messages.values())
+    assert slack.posts == len(pages) == 5
+    assert "".join(slack.messages.values()) == publisher.text == answer + " "
+
+
+def test_code_blocks_are_balanced_on_every_page():
+    slack = SlowSlack()
+    block = "\n".join(f"print({index})" for index in range(100))
+    answer = "\n\n".join(f"Step {step}:\n{FENCE}python\n{block}\n{FENCE}" for step in range(8))
+    publisher = SlackStreamPublisher(slack, "C1", "1.000000")
+
+    asyncio.run(stream(publisher, answer))
+
+    assert [text for _, text in publisher.pages()] == list(slack.messages.values())
+    assert len(slack.messages) > 1
+    for text in slack.messages.values():
+        assert text.count(FENCE) % 2 == 0
+
+
+def test_empty_answer_deletes_the_placeholder():
+    slack = SlowSlack()
+
+    async def answer_nothing():
+        placeholder = await slack.chat_postMessage("C1", "queued", "1.000000", [])
+        publisher = SlackStreamPublisher(slack, "C1", "1.000000", ts=placeholder["ts"])
+        await publisher.close()
+        return publisher
+
+    publisher = asyncio.run(answer_nothing())
+
+    assert slack.messages == {}
+    assert publisher.pages() == []
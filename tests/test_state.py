@@ -0,0 +1,133 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+import redis.asyncio
+
+from app.services import state
+from app.services.dedup import EventDeduplicator
+from app.services.state import RedisStateBackend, ThreadLocks
+from tests.fake_redis import FakeRedis
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(state, "LOCK_POLL_SECONDS", 0.01)
+
+
+@asynccontextmanager
+async def workers(count: int = 2):
+    """`count` Redis clients on one fake server, the way separate worker processes share it."""
+    server = FakeRedis()
+    url = await server.start()
+    clients = [redis.asyncio.Redis.from_url(url, decode_responses=True) for _ in range(count)]
+    try:
+        yield server, clients
+    finally:
+        for client in clients:
+            await client.aclose()
+        await server.stop()
+
+
+def test_the_thread_lock_is_handed_over_between_workers():
+    events = []
+
+    async def answer(locks: ThreadLocks, name: str):
+        async with locks.hold("C1", "1.0"):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.05)
+            events.append(f"{name} end")
+
+    async def run():
+        async with workers() as (_, clients):
+            first, second = (ThreadLocks(RedisStateBackend(client, "lock:"), ttl=10, timeout=5) for client in clients)
+            await asyncio.gather(answer(first, "first"), answer(second, "second"))
+
+    asyncio.run(run())
+
+    assert events == ["first start", "first end", "second start", "second end"]
+
+
+def test_a_lock_left_by_a_dead_worker_expires():
+    async def run():
+        async with workers() as (server, clients):
+            dead, alive = (RedisStateBackend(client, "lock:") for client in clients)
+            await dead.add("C1:1.0", "dead-worker", ttl=0.1)
+            locks = ThreadLocks(alive, ttl=10, timeout=5)
+            started = time.monotonic()
+            async with locks.hold("C1", "1.0"):
+                waited = time.monotonic() - started
+                holder = server.data["lock:C1:1.0"][0]
+            return waited, holder
+
+    waited, holder = asyncio.run(run())
+
+    assert 0.1 <= waited < 1
+    assert holder != "dead-worker"
+
+
+def test_concurrent_updates_are_never_lost():
+    async def run():
+        async with workers() as (_, clients):
+            backends = [RedisStateBackend(client, "thread:", ttl=60) for client in clients]
+            await backends[0].set("C1:1.0", "")
+            updates = [
+                backend.update("C1:1.0", lambda value, item=f"{index}.{turn}": value + item + ",")
+                for index, backend in enumerate(backends)
+                for turn in range(3)
+            ]
+            await asyncio.gather(*updates)
+            return await backends[0].peek("C1:1.0")
+
+    value = asyncio.run(run())
+
+    # At worst a writer that kept losing drops the key, but a write is never silently overwritten.
+    assert value is None or sorted(filter(None, value.split(","))) == ["0.0", "0.1", "0.2", "1.0", "1.1", "1.2"]
+
+
+def test_an_update_retries_after_a_conflicting_write():
+    async def run():
+        async with workers() as (server, clients):
+            backend = RedisStateBackend(clients[0], "thread:", ttl=60)
+            await backend.set("key", "a")
+            conflicts = iter([True])
+
+            def append_b(value: str) -> str:
+                # Another worker writes between this one's read and its write, once.
+                if next(conflicts, False):
+                    server.data["thread:key"] = ("a,c", float("inf"))
+                    server.versions["thread:key"] += 1
+                return value + ",b"
+
+            await backend.update("key", append_b)
+            return await backend.peek("key"), server.commands["EXEC"]
+
+    assert asyncio.run(run()) == ("a,c,b", 2)
+
+
+def test_an_update_that_keeps_losing_drops_the_key():
+    async def run():
+        async with workers() as (server, clients):
+            backend = RedisStateBackend(clients[0], "thread:", ttl=60)
+            await backend.set("key", "a")
+
+            def always_conflicting(value: str) -> str:
+                server.versions["thread:key"] += 1
+                return value + ",b"
+
+            await backend.update("key", always_conflicting)
+            return await backend.peek("key"), server.commands["EXEC"]
+
+    assert asyncio.run(run()) == (None, state.MAX_UPDATE_ATTEMPTS)
+
+
+def test_workers_share_the_dedup_keys():
+    delivery = {"api_app_id": "A0GPT", "event_id": "Ev1", "event": {"client_msg_id": "m1"}}
+
+    async def run():
+        async with workers() as (_, clients):
+            first, second = (EventDeduplicator(RedisStateBackend(client, "dedup:"), ttl=60) for client in clients)
+            return await first.is_duplicate(delivery), await second.is_duplicate(delivery)
+
+    assert asyncio.run(run()) == (False, True)
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+from app.utils import tracing
+
+
+@pytest.fixture
+def exported(monkeypatch):
+    traces = []
+    monkeypatch.setattr(tracing, "exporters", [traces.append])
+    monkeypatch.setattr(tracing, "trace_sample_rate", 1.0)
+    return traces
+
+
+def test_a_task_outliving_its_trace_does_not_export_it_again(exported):
+    async def reply_later():
+        await asyncio.sleep(0.01)
+        with tracing.span("slack.chat.postMessage") as span:
+            return span
+
+    async def handle_event():
+        with tracing.trace("slack.event"):
+            task = asyncio.create_task(reply_later())
+        return await task
+
+    late = asyncio.run(handle_event())
+
+    assert late is tracing.NOOP
+    assert len(exported) == 1
+    assert [span.name for span in exported[0].spans] == ["slack.event"]
+
+
+def test_spans_started_before_the_end_keep_the_trace_open(exported):
+    with tracing.trace("slack.event") as root:
+        queued = tracing.start_span("queue", parent=root)
+    assert exported == []
+
+    queued.end()
+
+    assert [[span.name for span in trace.spans] for trace in exported] == [["slack.event", "queue"]]